@@ -1,4 +1,5 @@
 from preprocess import Preprocessor
+from dataloader import DEFAULT_TEXT2VEC_PATH
 import os
 from loguru import logger
 from typing import List
@@ -67,6 +68,25 @@ def main():
     logger.info("building tables...")
     preprocessor.build_table(persist=True)
 
+    # binary texts
+    logger.info("compiling pdf texts...")
+    preprocessor.compile_pdf_texts(num_processors=num_processors)
+
+    # cleaned text lines
+    logger.info("building chunk stores...")
+    preprocessor.build_chunk_stores(num_processors=num_processors)
+
+    # bm25 indexes
+    logger.info("building bm25 indexes...")
+    preprocessor.build_bm25_indexes(num_processors=num_processors)
+
+    # 向量索引, 推理时dense_retrieval=True才会用到
+    if os.path.exists(DEFAULT_TEXT2VEC_PATH):
+        logger.info("building dense indexes...")
+        preprocessor.build_dense_index()
+    else:
+        logger.info(f"{DEFAULT_TEXT2VEC_PATH} not found, skip dense indexes")
+
 
 if __name__ == "__main__":
     main()
@@ -13,19 +13,26 @@ def main():
     """
     运行前需设置环境变量
     - MODEL_CACHE_DIR: 模型缓存目录
+    - RESPONSE_CACHE_PATH: (可选)模型输出缓存的sqlite文件路径, 设置后重复运行时相同prompt不再推理
+    - RESUME_SAMPLE_DIR: (可选)沿用已有的推理结果目录名, 从中断处继续, 只重算未完成或输入变化的问题
     """
 
     load_dotenv()
     model_cache_dir = os.environ.get("MODEL_CACHE_DIR")
+    response_cache_path = os.environ.get("RESPONSE_CACHE_PATH")
+    response_cache = (
+        ResponseCache(path=response_cache_path) if response_cache_path else None
+    )
 
-    sdn = get_sample_dir_name()
+    sdn = os.environ.get("RESUME_SAMPLE_DIR") or get_sample_dir_name()
 
     # 分类模型
     cls_model = HFModelForClassification(
         model_name="Blackoutta/bert-base-chinese-sft-intention",
+        response_cache=response_cache,
     )
 
-    # 关键词及nl2sql模型
+    # 关键词及nl2sql模型与通用模型基座相同, 共享同一个vllm engine
     lora_model = VllmModel(
         lora_adapters={
             "keywords": os.path.join(
@@ -35,10 +42,12 @@ def main():
                 model_cache_dir, "Blackoutta/Qwen2.5-3B-Instruct-sft-nl2sql-lora"
             ),
         },
+        response_cache=response_cache,
+        prefix_stats=True,
     )
 
     # 通用模型
-    generic_model = VllmModel()
+    generic_model = VllmModel(response_cache=response_cache, prefix_stats=True)
 
     inferenced_dir = Path(file_dir, "resources/inferenced", sdn)
 
@@ -56,6 +65,7 @@ def main():
         generic_model=generic_model,
         ctx_dir=Path(file_dir, "resources", "processed_data"),
         inference_dir=inferenced_dir,
+        fingerprint=True,
     )
     questions = evaluator.load_questions()
     questions = [q.model_dump() for q in questions]
@@ -64,21 +74,11 @@ def main():
     # questions = [questions[47]]
     # questions = questions[:20]
 
-    # 问题分类推理
-    inferencer.do_classification(questions=questions, persist=True)
-
-    # 关键词推理
-    inferencer.do_keywords_generation(
-        questions=questions, persist=True, lora_name="keywords"
-    )
-
-    # NL2SQl推理
-    inferencer.do_sql_generation(
-        questions=questions, persist=True, lora_name="nl2sql", unload_on_done=True
-    )
-
-    # 生成答案
-    inferencer.do_answer_generation(questions=questions, persist=True)
+    # 分类 -> 关键词 -> NL2SQL -> 生成答案, 结果持久化供评估使用
+    pipeline = QAPipeline(inferencer, unload_cls_model=True)
+    pipeline.answer_batch(questions, persist=True)
+    lora_model.unload()
+    generic_model.unload()
 
     # 评估分数
     evaluator.do_evaluation(persist=True)
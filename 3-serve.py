@@ -0,0 +1,65 @@
+from inferencer import *
+import os
+from pathlib import Path
+from dotenv import load_dotenv
+
+file_dir = os.path.dirname(__file__)
+
+
+def main():
+    """
+    启动在线问答服务, 运行前需设置环境变量
+    - MODEL_CACHE_DIR: 模型缓存目录
+    - INFERENCE_DIR: 推理中间结果目录, 默认resources/inferenced/online
+    - SERVE_HOST / SERVE_PORT: (可选)监听地址, 默认0.0.0.0:8000
+    - USE_MOCK_MODEL: (可选)设置后使用MockModel, 便于无GPU时本地调试
+
+    调用示例:
+    curl -X POST http://127.0.0.1:8000/answer -d '{"question": "xxx"}'
+    """
+
+    load_dotenv()
+    model_cache_dir = os.environ.get("MODEL_CACHE_DIR")
+    inference_dir = os.environ.get(
+        "INFERENCE_DIR", os.path.join(file_dir, "resources/inferenced/online")
+    )
+    os.makedirs(inference_dir, exist_ok=True)
+
+    if os.environ.get("USE_MOCK_MODEL"):
+        # 分类仍先走规则, 规则无法确定的问题由MockModel给出(未知类别)
+        cls_model = MockModel()
+        lora_model = MockModel()
+        generic_model = MockModel()
+    else:
+        cls_model = HFModelForClassification(
+            model_name="Blackoutta/bert-base-chinese-sft-intention"
+        )
+        lora_model = VllmModel(
+            lora_adapters={
+                "keywords": os.path.join(
+                    model_cache_dir, "Blackoutta/Qwen2.5-3B-Instruct-sft-keyword-lora"
+                ),
+                "nl2sql": os.path.join(
+                    model_cache_dir, "Blackoutta/Qwen2.5-3B-Instruct-sft-nl2sql-lora"
+                ),
+            },
+        )
+        generic_model = VllmModel()
+
+    inferencer = Inferencer(
+        cls_model=cls_model,
+        default_model=lora_model,
+        generic_model=generic_model,
+        ctx_dir=Path(file_dir, "resources", "processed_data"),
+        inference_dir=inference_dir,
+    )
+    service = QAService(
+        pipeline=QAPipeline(inferencer),
+        host=os.environ.get("SERVE_HOST", "0.0.0.0"),
+        port=int(os.environ.get("SERVE_PORT", 8000)),
+    )
+    service.run()
+
+
+if __name__ == "__main__":
+    main()
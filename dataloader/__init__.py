@@ -1 +1,5 @@
 from .dataloader import DataLoader
+from ._sql_store import build_company_db
+from ._table_store import CompanyTableStore
+from ._row_name_index import RowNameIndex
+from ._dense_store import DenseChunkStore, Text2VecEncoder, DEFAULT_TEXT2VEC_PATH
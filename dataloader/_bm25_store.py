@@ -0,0 +1,213 @@
+from loguru import logger
+from typing import *
+from collections import OrderedDict
+from fastbm25 import fastbm25
+from importlib.metadata import version
+import pickle
+import time
+import sys
+import os
+
+BM25_FORMAT_VERSION = 2
+# pickle保存的是fastbm25对象, 升级fastbm25后旧文件不再可靠, 版本不一致时重新构建
+FASTBM25_VERSION = version("fastbm25")
+
+
+def build_bm25(text_lines: List[str]) -> fastbm25:
+    """
+    以每行文本为一个文档建立bm25模型
+    top_k_sentence只用到document_score和corpus, 去掉按行的词频统计以减小体积
+    """
+    model = fastbm25(text_lines)
+    model.doc_freqs = []
+    model.nd = {}
+    return model
+
+
+def estimate_nbytes(text_lines: List[str], model: Optional[fastbm25]) -> int:
+    """
+    文本行和bm25模型在内存中的大致字节数, 只统计文本行, 倒排得分表和idf
+    反序列化后倒排表中的行号和得分各自是一个对象
+    """
+    float_size = sys.getsizeof(0.0)
+    int_size = sys.getsizeof(1 << 20)
+    nbytes = sys.getsizeof(text_lines) + sum([sys.getsizeof(l) for l in text_lines])
+    if model is None:
+        return nbytes
+    nbytes += sys.getsizeof(model.document_score)
+    for word, scores in model.document_score.items():
+        nbytes += sys.getsizeof(word) + sys.getsizeof(scores)
+        nbytes += len(scores) * (int_size + float_size)
+    nbytes += sys.getsizeof(model.idf) + len(model.idf) * float_size
+    nbytes += sys.getsizeof(model.doc_len)
+    return nbytes
+
+
+class Bm25Store:
+    """
+    年报逐行bm25模型的缓存
+    - 预处理时为每份年报建好模型, 序列化到bm25/{key}.pkl: 先是记录格式版本和fastbm25版本的头部, 再是文本行和模型
+    - 推理时按需加载, 放入按字节数(按内存占用估算)限制的LRU, 同一份年报的多个问题共用一个模型
+    - 缓存文件不存在, 比alltxts旧或版本不一致时重新构建
+    """
+
+    def __init__(self, ctx_dir: str, max_bytes: int = 256 * 1024 * 1024):
+        self.ctx_dir = ctx_dir
+        self.max_bytes = max_bytes
+        # {key: (text_lines, model, nbytes)}
+        self.cache: OrderedDict = OrderedDict()
+        self.total_bytes = 0
+        self.stats = {"hit": 0, "load": 0, "build": 0, "evict": 0, "seconds": 0.0}
+
+    def index_path(self, key: str) -> str:
+        return os.path.join(self.ctx_dir, "bm25", "{}.pkl".format(key))
+
+    def source_path(self, key: str) -> str:
+        return os.path.join(self.ctx_dir, "alltxts", "{}.txt".format(key))
+
+    def get(
+        self, key: str, load_lines: Callable[[str], List[str]]
+    ) -> Tuple[List[str], Optional[fastbm25]]:
+        """
+        load_lines: 缓存文件失效时用于读取年报文本行
+        return: (文本行, bm25模型), 没有文本时模型为None
+        """
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.stats["hit"] += 1
+            text_lines, model, _ = self.cache[key]
+            return text_lines, model
+
+        start = time.perf_counter()
+        payload = self._load(key)
+        if payload is None:
+            payload = self.build(key, load_lines(key))
+            self.stats["build"] += 1
+        else:
+            self.stats["load"] += 1
+        self.stats["seconds"] += time.perf_counter() - start
+
+        text_lines, model, nbytes = payload
+        self.cache[key] = payload
+        self.total_bytes += nbytes
+        while self.total_bytes > self.max_bytes and len(self.cache) > 1:
+            _, (_, _, evicted_bytes) = self.cache.popitem(last=False)
+            self.total_bytes -= evicted_bytes
+            self.stats["evict"] += 1
+        return text_lines, model
+
+    def build(self, key: str, text_lines: List[str]) -> Tuple[List, fastbm25, int]:
+        """
+        构建并持久化一份年报的bm25模型
+        """
+        model = build_bm25(text_lines) if len(text_lines) > 0 else None
+        path = self.index_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                {"version": BM25_FORMAT_VERSION, "fastbm25": FASTBM25_VERSION}, f
+            )
+            pickle.dump(
+                {"lines": text_lines, "model": model},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, path)
+        return text_lines, model, estimate_nbytes(text_lines, model)
+
+    def _load(self, key: str) -> Optional[Tuple[List, fastbm25, int]]:
+        path = self.index_path(key)
+        if not os.path.exists(path):
+            return None
+        source = self.source_path(key)
+        if os.path.exists(source) and os.path.getmtime(path) < os.path.getmtime(source):
+            return None
+        try:
+            with open(path, "rb") as f:
+                header = pickle.load(f)
+                # 头部只含内置类型, 先检查版本, 不一致时不反序列化模型
+                if (
+                    not isinstance(header, dict)
+                    or header.get("version") != BM25_FORMAT_VERSION
+                    or header.get("fastbm25") != FASTBM25_VERSION
+                ):
+                    return None
+                payload = pickle.load(f)
+        except Exception as e:
+            logger.warning("{}损坏, 重新构建: {}".format(path, e))
+            return None
+        text_lines, model = payload["lines"], payload["model"]
+        return text_lines, model, estimate_nbytes(text_lines, model)
+
+    def report(self) -> Dict:
+        logger.info(
+            "bm25缓存命中{hit}次, 加载{load}次, 构建{build}次, 淘汰{evict}次, 加载和构建共耗时{seconds:.2f}s".format(
+                **self.stats
+            )
+            + ", 当前缓存{}份, {:.1f}MB".format(
+                len(self.cache), self.total_bytes / 1024 / 1024
+            )
+        )
+        return self.stats
+
+
+def test_bm25_store():
+    import tempfile
+    import random
+
+    random.seed(0)
+    chars = "营业收入利润总额研发投入员工人数社会责任客户集中度现金流量资产负债"
+    docs = {
+        f"doc{i}": [
+            "".join(random.choices(chars, k=random.randint(5, 40))) for _ in range(2000)
+        ]
+        for i in range(3)
+    }
+    with tempfile.TemporaryDirectory() as ctx_dir:
+        store = Bm25Store(ctx_dir, max_bytes=1)
+        for key, lines in docs.items():
+            store.build(key, lines)
+
+        query = "研发投入的员工人数"
+        for key, lines in docs.items():
+            _, model = store.get(key, lambda k: docs[k])
+            assert model.top_k_sentence(query, k=3) == fastbm25(lines).top_k_sentence(
+                query, k=3
+            )
+        # 字节上限很小时只保留最近使用的一份
+        assert list(store.cache.keys()) == ["doc2"]
+        assert store.stats["load"] == 3 and store.stats["evict"] == 2
+
+        start = time.perf_counter()
+        fastbm25(docs["doc2"]).top_k_sentence(query, k=3)
+        rebuild_cost = time.perf_counter() - start
+        start = time.perf_counter()
+        store.get("doc2", lambda k: docs[k])[1].top_k_sentence(query, k=3)
+        cached_cost = time.perf_counter() - start
+        logger.info(
+            "2000行文档, 每次重建检索{:.1f}ms, 缓存命中检索{:.2f}ms".format(
+                rebuild_cost * 1000, cached_cost * 1000
+            )
+        )
+
+        # total_bytes与缓存中各模型的估算大小一致, 超出上限时淘汰最久未使用的
+        nbytes = {key: store._load(key)[2] for key in docs}
+        lru = Bm25Store(ctx_dir, max_bytes=sum(nbytes.values()) - 1)
+        lru.get("doc0", lambda k: docs[k])
+        lru.get("doc1", lambda k: docs[k])
+        assert lru.total_bytes == nbytes["doc0"] + nbytes["doc1"]
+        lru.get("doc0", lambda k: docs[k])
+        lru.get("doc2", lambda k: docs[k])
+        assert list(lru.cache.keys()) == ["doc0", "doc2"]
+        assert lru.stats == {**lru.stats, "hit": 1, "load": 3, "evict": 1}
+        assert lru.total_bytes == sum([v[2] for v in lru.cache.values()])
+        assert lru.total_bytes == nbytes["doc0"] + nbytes["doc2"]
+        assert lru.total_bytes <= lru.max_bytes
+
+        # fastbm25版本不一致的文件不反序列化, 重新构建
+        with open(store.index_path("doc0"), "wb") as f:
+            pickle.dump({"version": BM25_FORMAT_VERSION, "fastbm25": "0.0.0"}, f)
+        store.get("doc0", lambda k: docs[k])
+        assert store.stats["build"] == 1
+        store.report()
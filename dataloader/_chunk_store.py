@@ -0,0 +1,209 @@
+from loguru import logger
+from typing import *
+from collections import OrderedDict
+import numpy as np
+import time
+import os
+
+CHUNK_FORMAT_VERSION = 1
+
+
+class DocChunks:
+    """
+    一份年报清洗后的文本行(已去掉页眉页脚和空行)
+    所有行以换行连接为一个字符串, 按行的字符偏移切片, 取连续多行时不需要重新拼接
+    """
+
+    def __init__(self, text: str, line_offsets: np.ndarray, page_lines: np.ndarray):
+        """
+        line_offsets: 第i行为text[line_offsets[i] : line_offsets[i + 1] - 1]
+        page_lines: 第p页为第page_lines[p]行到第page_lines[p + 1]行(不含)
+        """
+        self.text = text
+        self.line_offsets = line_offsets
+        self.page_lines = page_lines
+
+    @staticmethod
+    def from_pages(pages: List[str]) -> "DocChunks":
+        lines = []
+        page_lines = [0]
+        for page in pages:
+            lines.extend([line for line in page.split("\n") if len(line) > 0])
+            page_lines.append(len(lines))
+        text = "".join([line + "\n" for line in lines])
+        line_offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        np.cumsum([len(line) + 1 for line in lines], out=line_offsets[1:])
+        return DocChunks(text, line_offsets, np.array(page_lines, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.line_offsets) - 1
+
+    def window(self, start: int, end: int) -> str:
+        """
+        第start行到第end行(不含)以换行连接的文本
+        """
+        end = min(end, len(self))
+        if start >= end:
+            return ""
+        return self.text[self.line_offsets[start] : self.line_offsets[end] - 1]
+
+    def line(self, i: int) -> str:
+        return self.window(i, i + 1)
+
+    def page(self, p: int) -> str:
+        return self.window(self.page_lines[p], self.page_lines[p + 1])
+
+    def lines(self) -> List[str]:
+        return self.text.split("\n")[:-1]
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.text) * 4 + self.line_offsets.nbytes + self.page_lines.nbytes
+
+
+class ChunkStore:
+    """
+    年报清洗后文本行的缓存
+    - 预处理时为每份年报写入chunks/{key}.npz: utf-8文本, 行偏移, 分页行号
+    - 推理时按需加载, 放入按字节数限制的LRU
+    - 缓存文件不存在, 格式版本不一致或比alltxts旧时重新构建
+    """
+
+    def __init__(self, ctx_dir: str, max_bytes: int = 256 * 1024 * 1024):
+        self.ctx_dir = ctx_dir
+        self.max_bytes = max_bytes
+        self.cache: "OrderedDict[str, DocChunks]" = OrderedDict()
+        self.total_bytes = 0
+        self.stats = {"hit": 0, "load": 0, "build": 0, "evict": 0, "seconds": 0.0}
+
+    def chunk_path(self, key: str) -> str:
+        return os.path.join(self.ctx_dir, "chunks", "{}.npz".format(key))
+
+    def source_path(self, key: str) -> str:
+        return os.path.join(self.ctx_dir, "alltxts", "{}.txt".format(key))
+
+    def get(self, key: str, load_pages: Callable[[str], List[str]]) -> DocChunks:
+        """
+        load_pages: 缓存文件失效时用于读取年报的分页文本
+        """
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.stats["hit"] += 1
+            return self.cache[key]
+
+        start = time.perf_counter()
+        chunks = self._load(key)
+        if chunks is None:
+            chunks = self.build(key, load_pages(key))
+            self.stats["build"] += 1
+        else:
+            self.stats["load"] += 1
+        self.stats["seconds"] += time.perf_counter() - start
+
+        self.cache[key] = chunks
+        self.total_bytes += chunks.nbytes
+        while self.total_bytes > self.max_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.total_bytes -= evicted.nbytes
+            self.stats["evict"] += 1
+        return chunks
+
+    def build(self, key: str, pages: List[str]) -> DocChunks:
+        """
+        清洗并持久化一份年报的文本行
+        """
+        chunks = DocChunks.from_pages(pages)
+        path = self.chunk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                version=np.array(CHUNK_FORMAT_VERSION),
+                text=np.frombuffer(
+                    chunks.text.encode("utf-8", "surrogatepass"), dtype=np.uint8
+                ),
+                line_offsets=chunks.line_offsets,
+                page_lines=chunks.page_lines,
+            )
+        os.replace(tmp_path, path)
+        return chunks
+
+    def _load(self, key: str) -> Optional[DocChunks]:
+        path = self.chunk_path(key)
+        if not os.path.exists(path):
+            return None
+        source = self.source_path(key)
+        if os.path.exists(source) and os.path.getmtime(path) < os.path.getmtime(source):
+            return None
+        try:
+            with np.load(path) as data:
+                if int(data["version"]) != CHUNK_FORMAT_VERSION:
+                    return None
+                return DocChunks(
+                    data["text"].tobytes().decode("utf-8", "surrogatepass"),
+                    data["line_offsets"],
+                    data["page_lines"],
+                )
+        except Exception as e:
+            logger.warning("{}损坏, 重新构建: {}".format(path, e))
+            return None
+
+    def report(self) -> Dict:
+        logger.info(
+            "文本行缓存命中{hit}次, 加载{load}次, 构建{build}次, 淘汰{evict}次, 加载和构建共耗时{seconds:.2f}s".format(
+                **self.stats
+            )
+            + ", 当前缓存{}份, {:.1f}MB".format(
+                len(self.cache), self.total_bytes / 1024 / 1024
+            )
+        )
+        return self.stats
+
+
+def test_chunk_store():
+    import tempfile
+    import random
+
+    random.seed(0)
+    chars = "营业收入利润总额研发投入员工人数社会责任客户集中度现金流量资产负债 "
+    pages = [
+        "\n".join(
+            ["".join(random.choices(chars, k=random.randint(0, 40))) for _ in range(60)]
+        )
+        for _ in range(200)
+    ]
+    # 原先的做法: 按页切行, 去掉空行, 取窗口时再拼接
+    text_lines = [line for page in pages for line in page.split("\n")]
+    text_lines = [line for line in text_lines if len(line) > 0]
+
+    with tempfile.TemporaryDirectory() as ctx_dir:
+        store = ChunkStore(ctx_dir)
+        store.build("doc", pages)
+        chunks = store.get("doc", lambda k: pages)
+        assert store.stats["load"] == 1
+        assert chunks.lines() == text_lines
+        assert len(chunks) == len(text_lines)
+        windows = [(i, i + 31) for i in range(0, len(text_lines), 97)]
+        for start, end in windows:
+            assert chunks.window(start, end) == "\n".join(text_lines[start:end])
+        for p in range(len(pages)):
+            page_lines = [l for l in pages[p].split("\n") if len(l) > 0]
+            assert chunks.page(p) == "\n".join(page_lines)
+        assert DocChunks.from_pages([]).lines() == []
+
+        start = time.perf_counter()
+        for _ in range(100):
+            lines = [l for page in pages for l in page.split("\n")]
+            lines = [l for l in lines if len(l) > 0]
+            ["\n".join(lines[s:e]) for s, e in windows]
+        rebuild_cost = (time.perf_counter() - start) / 100
+        start = time.perf_counter()
+        for _ in range(100):
+            [chunks.window(s, e) for s, e in windows]
+        slice_cost = (time.perf_counter() - start) / 100
+        logger.info(
+            "{}行, 每次重新切行拼接{:.2f}ms, 按偏移切片{:.3f}ms".format(
+                len(text_lines), rebuild_cost * 1000, slice_cost * 1000
+            )
+        )
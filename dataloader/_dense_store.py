@@ -0,0 +1,311 @@
+from loguru import logger
+from typing import *
+from pathlib import Path
+import numpy as np
+import json
+import time
+import os
+
+DENSE_FORMAT_VERSION = 2
+
+# 与评估器相同的句向量模型
+DEFAULT_TEXT2VEC_PATH = Path(
+    Path.home(), ".cache/modelscope/hub/Jerry0/text2vec-base-chinese"
+)
+
+
+def chunk_spans(n: int, chunk_size: int, stride: int) -> List[Tuple[int, int]]:
+    """
+    把n行文本切成每块chunk_size行, 步长stride的文本块
+    return: [(起始行, 结束行)], 第j块的起始行为j * stride
+    """
+    spans = []
+    for start in range(0, n, stride):
+        spans.append((start, min(start + chunk_size, n)))
+        if start + chunk_size >= n:
+            break
+    return spans
+
+
+class Text2VecEncoder:
+    """
+    text2vec句向量模型, 输出归一化的float32向量
+    """
+
+    def __init__(
+        self, model_path: Path = DEFAULT_TEXT2VEC_PATH, device=None, batch_size=64
+    ):
+        from text2vec import SentenceModel
+
+        self.model = SentenceModel(model_name_or_path=str(model_path), device=device)
+        self.batch_size = batch_size
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        vectors = self.model.encode(texts, batch_size=self.batch_size)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+class DenseChunkStore:
+    """
+    年报文本块向量的内存映射存储
+    - dense/vectors.bin: 所有年报文本块的向量按年报依次存放, float16, 或int8加每行一个缩放系数(dense/scales.npy)
+    - dense/index.json: 格式版本, 向量维度, 切块参数, 以及每份年报的向量行区间, 文本行数和alltxts的修改时间
+    - 检索时只把该年报的向量切片转为float32, 与问题向量做一次矩阵乘
+    """
+
+    def __init__(self, ctx_dir: str):
+        self.ctx_dir = ctx_dir
+        self.dir = os.path.join(ctx_dir, "dense")
+        self.meta: Dict = None
+        self.vectors: np.memmap = None
+        self.scales: np.ndarray = None
+        self.stats = {"search": 0, "seconds": 0.0}
+
+    def source_path(self, key: str) -> str:
+        return os.path.join(self.ctx_dir, "alltxts", "{}.txt".format(key))
+
+    def source_mtime(self, key: str) -> Optional[float]:
+        source = self.source_path(key)
+        return os.path.getmtime(source) if os.path.exists(source) else None
+
+    def build(
+        self,
+        keys: List[str],
+        load_lines: Callable[[str], List[str]],
+        encode: Callable[[List[str]], np.ndarray],
+        dtype: str = "float16",
+        chunk_size: int = 8,
+        stride: int = 4,
+        batch_size: int = 256,
+    ) -> Dict:
+        """
+        为所有年报切块并编码, 向量逐批追加写入, 不需要一次放入内存
+        """
+        assert dtype in ["float16", "int8"], dtype
+        os.makedirs(self.dir, exist_ok=True)
+        vectors_tmp = os.path.join(self.dir, "vectors.bin.tmp")
+        docs = {}
+        scales = []
+        dim = None
+        total = 0
+        encoded_chars = 0
+        start_time = time.perf_counter()
+        with open(vectors_tmp, "wb") as f:
+            for key in keys:
+                text_lines = load_lines(key)
+                spans = chunk_spans(len(text_lines), chunk_size, stride)
+                texts = ["\n".join(text_lines[s:e]) for s, e in spans]
+                for i in range(0, len(texts), batch_size):
+                    batch = encode(texts[i : i + batch_size])
+                    dim = batch.shape[1]
+                    encoded_chars += sum([len(t) for t in texts[i : i + batch_size]])
+                    if dtype == "float16":
+                        f.write(batch.astype(np.float16).tobytes())
+                    else:
+                        scale = np.maximum(np.abs(batch).max(axis=1), 1e-12) / 127
+                        quantized = np.round(batch / scale[:, None]).astype(np.int8)
+                        f.write(quantized.tobytes())
+                        scales.append(scale.astype(np.float32))
+                docs[key] = {
+                    "rows": [total, total + len(spans)],
+                    "lines": len(text_lines),
+                    "mtime": self.source_mtime(key),
+                }
+                total += len(spans)
+
+        elapsed = time.perf_counter() - start_time
+        meta = {
+            "version": DENSE_FORMAT_VERSION,
+            "dtype": dtype,
+            "dim": dim or 0,
+            "chunk_size": chunk_size,
+            "stride": stride,
+            "docs": docs,
+        }
+        os.replace(vectors_tmp, os.path.join(self.dir, "vectors.bin"))
+        if dtype == "int8":
+            np.save(
+                os.path.join(self.dir, "scales.npy"),
+                np.concatenate(scales) if scales else np.zeros(0, dtype=np.float32),
+            )
+        # 索引最后写入, 作为构建完成的标志
+        with open(os.path.join(self.dir, "index.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        logger.info(
+            "{}份年报, {}个文本块, 编码{:.1f}块/s, {:.0f}字符/s".format(
+                len(docs),
+                total,
+                total / max(elapsed, 1e-9),
+                encoded_chars / max(elapsed, 1e-9),
+            )
+        )
+        self.meta = None
+        self.vectors = None
+        self.scales = None
+        return meta
+
+    def load(self) -> bool:
+        """
+        return: 索引是否可用
+        """
+        if self.meta is not None:
+            return True
+        index_path = os.path.join(self.dir, "index.json")
+        if not os.path.exists(index_path):
+            return False
+        with open(index_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != DENSE_FORMAT_VERSION:
+            logger.warning("向量索引版本不一致, 请重新构建: {}".format(index_path))
+            return False
+        total = sum([d["rows"][1] - d["rows"][0] for d in meta["docs"].values()])
+        if total == 0:
+            return False
+        self.vectors = np.memmap(
+            os.path.join(self.dir, "vectors.bin"),
+            dtype=np.float16 if meta["dtype"] == "float16" else np.int8,
+            mode="r",
+            shape=(total, meta["dim"]),
+        )
+        if meta["dtype"] == "int8":
+            self.scales = np.load(os.path.join(self.dir, "scales.npy"))
+        else:
+            self.scales = None
+        self.meta = meta
+        return True
+
+    def search(
+        self, key: str, query_vectors: np.ndarray, n_lines: int, top_k: int = 10
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        query_vectors: 归一化的问题向量, (问题数, 维度)
+        n_lines: 年报当前的文本行数, 与构建时不一致或alltxts比构建时新说明索引已过期
+        return: 每个问题的[(文本块序号, 余弦相似度)], 按相似度降序; 年报不在索引中时为空
+        """
+        if not self.load() or key not in self.meta["docs"]:
+            return [[] for _ in range(len(query_vectors))]
+        doc = self.meta["docs"][key]
+        mtime = self.source_mtime(key)
+        if doc["lines"] != n_lines or (
+            mtime is not None and mtime > (doc["mtime"] or 0)
+        ):
+            logger.warning("{}的向量索引已过期".format(key))
+            return [[] for _ in range(len(query_vectors))]
+
+        start_time = time.perf_counter()
+        start, end = doc["rows"]
+        scores = (
+            self.vectors[start:end].astype(np.float32)
+            @ np.asarray(query_vectors, dtype=np.float32).T
+        )
+        if self.scales is not None:
+            scores *= self.scales[start:end, None]
+        k = min(top_k, end - start)
+        results = []
+        for column in scores.T:
+            top = np.argpartition(-column, k - 1)[:k]
+            top = top[np.argsort(-column[top], kind="stable")]
+            results.append([(int(i), float(column[i])) for i in top])
+        self.stats["search"] += 1
+        self.stats["seconds"] += time.perf_counter() - start_time
+        return results
+
+    def report(self) -> Dict:
+        logger.info("向量检索{search}次, 共耗时{seconds:.2f}s".format(**self.stats))
+        return self.stats
+
+
+def test_dense_store():
+    """
+    随机单位向量代替句向量, 检查float16/int8的检索结果与float32精确检索一致, 并统计检索耗时
+    """
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    dim = 768
+    docs = {f"doc{i}": [f"第{i}份年报第{j}行" for j in range(2000)] for i in range(4)}
+    table = {}
+
+    def encode(texts):
+        vectors = []
+        for t in texts:
+            if t not in table:
+                v = rng.standard_normal(dim).astype(np.float32)
+                table[t] = v / np.linalg.norm(v)
+            vectors.append(table[t])
+        return np.stack(vectors)
+
+    for dtype in ["float16", "int8"]:
+        with tempfile.TemporaryDirectory() as ctx_dir:
+            store = DenseChunkStore(ctx_dir)
+            store.build(list(docs.keys()), docs.__getitem__, encode, dtype=dtype)
+            assert store.load()
+            for key, lines in docs.items():
+                spans = chunk_spans(len(lines), 8, 4)
+                exact = encode(["\n".join(lines[s:e]) for s, e in spans])
+                # 问题取某个文本块向量加少量噪声
+                queries = exact[[3, 100, len(spans) - 1]]
+                queries = queries + 0.01 * rng.standard_normal(queries.shape)
+                queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+                expected = np.argsort(-(exact @ queries.T), axis=0)[:5].T.tolist()
+                hits = store.search(key, queries, len(lines), top_k=5)
+                assert [[i for i, _ in h][:1] for h in hits] == [
+                    e[:1] for e in expected
+                ]
+                assert store.search(key, queries, len(lines) + 1) == [[], [], []]
+
+            start = time.perf_counter()
+            for _ in range(100):
+                store.search("doc0", queries[:1], len(docs["doc0"]), top_k=10)
+            logger.info(
+                "{}: {}个文本块/年报, 单次检索{:.2f}ms, 向量文件{:.1f}MB".format(
+                    dtype,
+                    store.meta["docs"]["doc0"]["rows"][1],
+                    (time.perf_counter() - start) * 10,
+                    store.vectors.nbytes / 1024 / 1024,
+                )
+            )
+
+    with tempfile.TemporaryDirectory() as ctx_dir:
+        # 同一个store先后构建int8和float16索引; alltxts更新后索引过期
+        os.makedirs(os.path.join(ctx_dir, "alltxts"))
+        source = os.path.join(ctx_dir, "alltxts", "doc0.txt")
+        open(source, "w").close()
+        store = DenseChunkStore(ctx_dir)
+        store.build(list(docs.keys()), docs.__getitem__, encode, dtype="int8")
+        assert store.load() and store.scales is not None
+        store.build(list(docs.keys()), docs.__getitem__, encode, dtype="float16")
+        assert store.load() and store.scales is None
+        query = encode(["营业收入"])
+        assert len(store.search("doc0", query, len(docs["doc0"]))[0]) > 0
+        os.utime(source, (time.time() + 10, time.time() + 10))
+        assert store.search("doc0", query, len(docs["doc0"])) == [[]]
+        assert len(store.search("doc1", query, len(docs["doc1"]))[0]) > 0
+
+
+def test_text2vec_throughput():
+    """
+    用真实年报文本测试text2vec的编码吞吐
+    """
+    from .dataloader import DataLoader
+
+    ctx_dir = os.path.join(
+        os.path.dirname(__file__), "..", "resources", "processed_data"
+    )
+    loader = DataLoader(ctx_dir=ctx_dir, inference_dir=ctx_dir)
+    keys = [
+        f for f in os.listdir(os.path.join(ctx_dir, "alltxts")) if f.endswith(".txt")
+    ]
+    key = sorted(keys)[0].replace(".txt", "")
+    lines = loader.load_pdf_text_lines(key)
+    texts = ["\n".join(lines[s:e]) for s, e in chunk_spans(len(lines), 8, 4)][:512]
+    encoder = Text2VecEncoder()
+    start = time.perf_counter()
+    vectors = encoder(texts)
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "text2vec编码{}个文本块, {:.1f}块/s".format(len(texts), len(texts) / elapsed)
+    )
+    assert vectors.shape[0] == len(texts)
@@ -0,0 +1,170 @@
+from typing import *
+from collections import deque
+import random
+import time
+
+
+class AhoCorasick:
+    """
+    多模式串匹配自动机, 一次扫描文本即可找出所有出现过的模式串, 耗时与模式串数量无关
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        # 每个节点: 子节点, 失败指针, 本节点结束的模式串, 沿失败链最近的有输出的节点
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[Optional[str]] = [None]
+        self.dict_link: List[int] = [0]
+
+        for pattern in set(patterns):
+            if pattern == "":
+                continue
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.dict_link.append(0)
+                node = nxt
+            self.output[node] = pattern
+
+        queue = deque(self.goto[0].values())
+        while len(queue) > 0:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                f = self.fail[node]
+                while f != 0 and ch not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(ch, 0)
+                self.fail[child] = f
+                self.dict_link[child] = (
+                    f if self.output[f] is not None else self.dict_link[f]
+                )
+                queue.append(child)
+
+    def find_all(self, text: str) -> Set[str]:
+        """
+        返回text中出现过的所有模式串(去重)
+        """
+        found = set()
+        goto, fail = self.goto, self.fail
+        output, dict_link = self.output, self.dict_link
+        node = 0
+        for ch in text:
+            while node != 0 and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            out = node if output[node] is not None else dict_link[node]
+            while out != 0:
+                found.add(output[out])
+                out = dict_link[out]
+        return found
+
+
+class EntityIndex:
+    """
+    公司全称及简称的实体索引, 由pdf元数据一次性构建
+    - 自动机找出问题中出现的所有公司名称
+    - 名称 -> 元数据条目, 名称 -> {年份: pdf key}
+    查询结果与逐条遍历元数据做子串判断完全一致
+    """
+
+    def __init__(self, pdf_metadata_map: Dict[str, Dict]):
+        self.pdf_metadata_map = pdf_metadata_map
+        # {名称: [(元数据位置, 0全称/1简称)]}
+        self.name_entries: Dict[str, List[Tuple[int, int]]] = {}
+        # {名称: {年份: [pdf key]}}
+        self.name_year_keys: Dict[str, Dict[str, List[str]]] = {}
+
+        for pos, (k, v) in enumerate(pdf_metadata_map.items()):
+            year = v["year"].replace("年", "").replace(" ", "")
+            for field, name in enumerate([v["company"], v["abbr"]]):
+                self.name_entries.setdefault(name, []).append((pos, field))
+                self.name_year_keys.setdefault(name, {}).setdefault(year, []).append(k)
+        self.names = [(v["company"], v["abbr"]) for v in pdf_metadata_map.values()]
+        self.automaton = AhoCorasick(self.name_entries.keys())
+
+    def find_names(self, text: str) -> Set[str]:
+        names = self.automaton.find_all(text)
+        # 空字符串是任意文本的子串
+        if "" in self.name_entries:
+            names.add("")
+        return names
+
+    def find_related_companies(self, text: str) -> List[str]:
+        """
+        text中出现的公司全称及简称, 按元数据顺序排列, 每条元数据先全称后简称
+        """
+        entries = []
+        for name in self.find_names(text):
+            entries.extend(self.name_entries[name])
+        entries.sort()
+        return [self.names[pos][field] for pos, field in entries]
+
+    def find_pdf_keys(self, text: str, years: Iterable[str]) -> List[str]:
+        """
+        全称或简称出现在text中, 且年份在years中的pdf key(可能重复)
+        """
+        years = set(years)
+        keys = []
+        for name in self.find_names(text):
+            year_keys = self.name_year_keys[name]
+            for year in years:
+                keys.extend(year_keys.get(year, []))
+        return keys
+
+
+def _linear_related_companies(pdf_metadata_map: Dict, text: str) -> List[str]:
+    related_companies = []
+    for k, md in pdf_metadata_map.items():
+        if md["company"] in text:
+            related_companies.append(md["company"])
+        if md["abbr"] in text:
+            related_companies.append(md["abbr"])
+    return related_companies
+
+
+def _synthetic_metadata(n: int, seed: int = 0) -> Dict[str, Dict]:
+    rng = random.Random(seed)
+    chars = "华东安科智能电子信息技术新材料生物医药健康能源环保精密机械控股集团"
+    ds = {}
+    for i in range(n):
+        abbr = "".join(rng.choices(chars, k=4)) + str(i)
+        company = abbr + "股份有限公司"
+        year = str(2019 + i % 3) + "年"
+        key = f"2020-01-01__{company}__{i:06d}__{abbr}__{year}__年度报告.pdf"
+        ds[key] = {"company": company, "abbr": abbr, "year": year}
+    return ds
+
+
+def test_entity_index_benchmark():
+    for n in [1000, 100000]:
+        md = _synthetic_metadata(n)
+        names = [(v["company"], v["abbr"]) for v in md.values()]
+        rng = random.Random(1)
+        questions = []
+        for _ in range(200):
+            company, abbr = rng.choice(names)
+            questions.append(f"{rng.choice([company, abbr])}2020年的营业收入是多少元?")
+
+        start = time.perf_counter()
+        index = EntityIndex(md)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        indexed = [index.find_related_companies(q) for q in questions]
+        index_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        linear = [_linear_related_companies(md, q) for q in questions]
+        linear_time = time.perf_counter() - start
+
+        assert indexed == linear
+        print(
+            f"{n}份年报: 索引构建{build_time:.3f}s, 200个问题 索引{index_time * 1000:.1f}ms, "
+            f"逐条遍历{linear_time * 1000:.1f}ms"
+        )
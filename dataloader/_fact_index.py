@@ -0,0 +1,47 @@
+from typing import *
+import pandas as pd
+import numpy as np
+
+
+class CompanyFactIndex:
+    """
+    CompanyTable的(公司全称, 年份) -> 行号索引
+    列名拆分为(表名, 字段名)只做一次, 查询时只取出命中的行, 无需全表query和iterrows
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        # {(公司全称, 年份): 行号数组}
+        self.row_positions: Dict[Tuple[Any, Any], np.ndarray] = dict(
+            df.groupby(["公司全称", "年份"], sort=False).indices
+        )
+        # 每列的(表名, 字段名), 没有表名前缀的列表名为no_table
+        self.column_keys: List[Tuple[str, str]] = []
+        for col_name in df.columns:
+            split = col_name.split(".")
+            if len(split) == 1:
+                self.column_keys.append(("no_table", split[0]))
+            else:
+                self.column_keys.append((split[0], split[1]))
+        self.year_col = df.columns.get_loc("年份")
+
+    def find(self, company, years: List[int]) -> List[Tuple[str, str, str, Any]]:
+        """
+        return: [(table name, row_year, column name, row_value)], 行按表中顺序排列
+        """
+        positions = [
+            self.row_positions[(company, year)]
+            for year in set(years)
+            if (company, year) in self.row_positions
+        ]
+        if len(positions) == 0:
+            return []
+        positions = np.sort(np.concatenate(positions))
+
+        # 与iterrows一致: 按行取出values, 混合类型的表中数值会转为python对象
+        tuples = []
+        for values in self.df.iloc[positions].values:
+            row_year = str(values[self.year_col])
+            for (table_name, key), value in zip(self.column_keys, values):
+                tuples.append((table_name, row_year, key, value))
+        return tuples
@@ -0,0 +1,11 @@
+# 财报字段名 -> company_table中的字段名(别名)
+# 预处理建表和推理时修正/裁剪字段都用这张表, 本模块不依赖其他模块
+alias = {
+    "在职员工的数量合计": "职工总人数",
+    "负债合计": "总负债",
+    "资产总计": "总资产",
+    "流动负债合计": "流动负债",
+    "非流动负债合计": "非流动负债",
+    "流动资产合计": "流动资产",
+    "非流动资产合计": "非流动资产",
+}
@@ -0,0 +1,137 @@
+from loguru import logger
+from typing import *
+from collections import Counter, OrderedDict
+from difflib import SequenceMatcher
+
+
+def tot_match_size(keyword: str, row_name: str) -> int:
+    """
+    SequenceMatcher各匹配块的长度之和
+    """
+    matches = SequenceMatcher(isjunk=None, a=keyword, b=row_name, autojunk=False)
+    return sum([match.size for match in matches.get_matching_blocks()])
+
+
+class RowNameIndex:
+    """
+    财报表行名(即company_table字段名)的字符倒排索引, 用于recall_pdf_tables
+    - 各公司的行名来自同一份字段表, 按去重后的行名建索引, 遇到新行名(如增长率)时追加
+    - 匹配块长度之和不超过两串的公共字符数(按次数), 公共字符数不足阈值的行名无需计算
+    - (关键词, 阈值)的匹配结果放入容量为max_memo的LRU, 行名增加后只为新行名补算
+    由CompanyTableStore持有, company_table重新解析时随之重建
+    """
+
+    def __init__(self, max_memo: int = 4096):
+        self.max_memo = max_memo
+        self.names: List[str] = []
+        self.name_ids: Dict[str, int] = {}
+        # {字符: [(行名序号, 出现次数)]}
+        self.inverted: Dict[str, List[Tuple[int, int]]] = {}
+        # {(关键词, 阈值): (已计算的行名数, {行名: 匹配长度})}
+        self.memo: "OrderedDict[Tuple[str, int], Tuple[int, Dict[str, int]]]" = (
+            OrderedDict()
+        )
+        self.stats = {"hit": 0, "miss": 0, "scored": 0, "evict": 0}
+
+    def add(self, row_name: str):
+        if row_name in self.name_ids:
+            return
+        i = len(self.names)
+        self.names.append(row_name)
+        self.name_ids[row_name] = i
+        for c, n in Counter(row_name).items():
+            self.inverted.setdefault(c, []).append((i, n))
+
+    def matches(self, keyword: str, min_match_number: int) -> Dict[str, int]:
+        """
+        return: {行名: 匹配长度}, 只包含匹配长度不低于阈值或被关键词包含的行名
+        """
+        key = (keyword, min_match_number)
+        scored_count, sizes = self.memo.get(key, (0, {}))
+        if scored_count == len(self.names):
+            self.memo.move_to_end(key)
+            self.stats["hit"] += 1
+            return sizes
+        self.stats["miss"] += 1
+
+        if min_match_number <= 0:
+            # 任何行名都满足阈值, 没有公共字符的行名匹配长度为0
+            candidates = range(scored_count, len(self.names))
+        else:
+            overlaps: Dict[int, int] = {}
+            for c, n in Counter(keyword).items():
+                for i, m in self.inverted.get(c, []):
+                    if i >= scored_count:
+                        overlaps[i] = overlaps.get(i, 0) + min(n, m)
+            candidates = sorted(
+                [
+                    i
+                    for i, n in overlaps.items()
+                    if n >= min_match_number or self.names[i] in keyword
+                ]
+            )
+            # 空行名被任何关键词包含
+            if "" in self.name_ids and self.name_ids[""] >= scored_count:
+                candidates.append(self.name_ids[""])
+
+        for i in candidates:
+            row_name = self.names[i]
+            size = tot_match_size(keyword, row_name)
+            self.stats["scored"] += 1
+            if size >= min_match_number or row_name in keyword:
+                sizes[row_name] = size
+        self.memo[key] = (len(self.names), sizes)
+        self.memo.move_to_end(key)
+        while len(self.memo) > self.max_memo:
+            self.memo.popitem(last=False)
+            self.stats["evict"] += 1
+        return sizes
+
+    def report(self) -> Dict[str, int]:
+        logger.info(
+            "行名索引{}个行名, 缓存命中{hit}次, 未命中{miss}次, 计算匹配{scored}次, 淘汰{evict}次".format(
+                len(self.names), **self.stats
+            )
+        )
+        return self.stats
+
+
+def test_row_name_index():
+    """
+    与逐个行名计算SequenceMatcher的结果一致, 匹配结果缓存有上限
+    """
+    import random
+
+    random.seed(0)
+    names = [
+        "营业收入",
+        "营业成本",
+        "营业利润",
+        "利润总额",
+        "净利润",
+        "研发费用",
+        "研发人员",
+        "负债合计",
+        "资产总计",
+        "流动资产合计",
+        "非流动负债合计",
+        "在职员工的数量合计",
+        "营业收入增长率",
+        "",
+    ]
+    keywords = ["营业收入", "研发费用", "员工数量", "负债", "营业收入增长率", "天气"]
+    index = RowNameIndex(max_memo=8)
+    for _ in range(3):
+        # 每轮追加新行名, 已缓存的结果只为新行名补算
+        for name in random.sample(names, 6):
+            index.add(name)
+        for k in keywords:
+            for m in [0, 2, 3]:
+                expected = {}
+                for name in index.names:
+                    size = tot_match_size(k, name)
+                    if size >= m or name in k:
+                        expected[name] = size
+                assert index.matches(k, m) == expected
+    assert len(index.memo) == 8 and index.stats["evict"] > 0
+    index.report()
@@ -0,0 +1,147 @@
+from loguru import logger
+from typing import *
+import pandas as pd
+import numpy as np
+import sqlite3
+from pathlib import Path
+import time
+import os
+
+# 统计题中最常用于过滤和排序的数值字段, 与年份建立联合索引
+INDEXED_NUMERIC_COLUMNS = [
+    "负债合计",
+    "利润总额",
+    "销售人员",
+    "营业收入",
+    "货币资金",
+    "资产总计",
+    "技术人员",
+    "在职员工的数量合计",
+]
+
+
+def _parse_float(v) -> Tuple[bool, float]:
+    try:
+        return True, float(v)
+    except (ValueError, TypeError):
+        return False, np.nan
+
+
+def infer_column(s: pd.Series) -> Tuple[str, pd.Series]:
+    """
+    推断列类型, 超过一半的值(不计NULLVALUE)能转为数字的列视为数值列
+    数值列中整数值转为int, 超出int64范围及inf转为nan
+    return: (sqlite类型, 转换后的列)
+    """
+    counted = s != "NULLVALUE"
+    tot_count = int(counted.sum())
+    if tot_count == 0:
+        return "TEXT", s
+
+    if pd.api.types.is_numeric_dtype(s):
+        nums = s.astype("float64")
+        parsed = pd.Series(True, index=s.index)
+    else:
+        # to_numeric只用于快速筛出可解析的值, 其解析精度与float()不同, 数值用astype重新转换
+        candidate = pd.to_numeric(s, errors="coerce").notna()
+        nums = pd.Series(np.nan, index=s.index)
+        try:
+            nums[candidate] = s[candidate].astype("float64")
+        except (ValueError, TypeError):
+            candidate[:] = False
+        # nan本身可以转为float
+        parsed = candidate | s.isna()
+        # to_numeric不支持的写法(如全角数字), 按float()逐个解析去重后的值
+        failed = ~parsed
+        if failed.any():
+            fallback = {v: _parse_float(v) for v in s[failed].unique()}
+            parsed[failed] = [fallback[v][0] for v in s[failed]]
+            nums[failed] = [fallback[v][1] for v in s[failed]]
+
+    num_count = int((parsed & counted).sum())
+    if num_count / tot_count <= 0.5:
+        return "TEXT", s
+
+    nums = nums.where(parsed & (nums < 2.0**63) & np.isfinite(nums), np.nan)
+    if nums.notna().all() and (nums == np.floor(nums)).all():
+        nums = nums.astype("int64")
+    return "REAL", nums
+
+
+def build_company_db(df: pd.DataFrame, db_path: str):
+    """
+    将去掉列名前缀的company_table类型化后写入sqlite文件, 并建立索引
+    先写临时文件再替换, 避免读到写了一半的库
+    """
+    start = time.perf_counter()
+    df = df.copy()
+    dtypes = {}
+    for col in df.columns:
+        dtypes[col], df[col] = infer_column(df[col])
+    dtypes["年份"] = "TEXT"
+
+    tmp_path = db_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        df.to_sql(name="company_table", con=conn, if_exists="replace", dtype=dtypes)
+        conn.execute('CREATE INDEX idx_year ON company_table ("年份")')
+        conn.execute('CREATE INDEX idx_company ON company_table ("公司全称")')
+        for i, col in enumerate(INDEXED_NUMERIC_COLUMNS):
+            if col in df.columns:
+                conn.execute(
+                    f'CREATE INDEX idx_year_num_{i} ON company_table ("年份", "{col}")'
+                )
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, db_path)
+    logger.info(
+        "写入{}, {}行, 耗时{:.2f}s".format(
+            db_path, len(df), time.perf_counter() - start
+        )
+    )
+
+
+def open_company_db(db_path: str) -> sqlite3.Connection:
+    """
+    只读打开sqlite文件, 开启mmap并加大页缓存
+    路径经过URI转义, 目录名中的?, #, %等字符不会被当作URI参数
+    """
+    uri = Path(db_path).absolute().as_uri() + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.execute("PRAGMA mmap_size = 268435456")
+    conn.execute("PRAGMA cache_size = -65536")
+    return conn
+
+
+def test_infer_column():
+    s = pd.Series(["1", "2.5", "NULLVALUE", None, "abc", "１２", "1e30"])
+    sql_type, nums = infer_column(s)
+    assert sql_type == "REAL"
+    print(nums.tolist())
+
+    s = pd.Series(["上海", "深圳", "1", None])
+    assert infer_column(s)[0] == "TEXT"
+
+
+def test_open_company_db():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_dir = os.path.join(tmp_dir, "data #1?x=%20")
+        os.makedirs(db_dir)
+        db_path = os.path.join(db_dir, "CompanyTable.db")
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("CREATE TABLE t (a REAL)")
+            conn.execute("INSERT INTO t VALUES (1)")
+        conn = open_company_db(db_path)
+        assert conn.execute("SELECT a FROM t").fetchall() == [(1.0,)]
+        try:
+            conn.execute("INSERT INTO t VALUES (2)")
+            assert False
+        except sqlite3.OperationalError:
+            pass
+        conn.close()
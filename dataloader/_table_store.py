@@ -0,0 +1,111 @@
+from loguru import logger
+from typing import *
+import pandas as pd
+import hashlib
+import time
+import os
+from ._fact_index import CompanyFactIndex
+from ._row_name_index import RowNameIndex
+
+
+class CompanyTableStore:
+    """
+    CompanyTable.csv的缓存, 文件只解析一次
+    - 带表名前缀(如"资产负债表.总负债")和去掉前缀的两种列名视图共享同一份数据
+    - 每次读取时检查文件的mtime和大小, 发生变化再比较内容哈希, 哈希也变化才重新解析
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.df: pd.DataFrame = None
+        self.unprefixed_df: pd.DataFrame = None
+        self.fact_index: CompanyFactIndex = None
+        self.row_name_index: RowNameIndex = None
+        self.file_stat: Tuple[int, int] = None
+        self.file_hash: str = None
+
+        self.load_count = 0
+        self.load_seconds = 0.0
+        self.hit_count = 0
+
+    def get(self, remove_column_prefix=False) -> pd.DataFrame:
+        """
+        返回的DataFrame与缓存共享数据, 调用方如需修改请先copy
+        """
+        self._ensure_fresh()
+        if not remove_column_prefix:
+            return self.df
+        if self.unprefixed_df is None:
+            # 浅拷贝只复制列索引, 数据仍与带前缀的视图共享
+            self.unprefixed_df = self.df.copy(deep=False)
+            self.unprefixed_df.columns = [
+                col.split(".")[1] if len(col.split(".")) > 1 else col
+                for col in self.df.columns
+            ]
+        return self.unprefixed_df
+
+    def get_fact_index(self) -> CompanyFactIndex:
+        self._ensure_fresh()
+        if self.fact_index is None:
+            self.fact_index = CompanyFactIndex(self.df)
+        return self.fact_index
+
+    def get_row_name_index(self) -> RowNameIndex:
+        self._ensure_fresh()
+        if self.row_name_index is None:
+            self.row_name_index = RowNameIndex()
+        return self.row_name_index
+
+    def _ensure_fresh(self):
+        st = os.stat(self.path)
+        file_stat = (st.st_mtime_ns, st.st_size)
+        if self.df is not None and file_stat == self.file_stat:
+            self.hit_count += 1
+            return
+
+        file_hash = CompanyTableStore._hash_file(self.path)
+        if self.df is not None and file_hash == self.file_hash:
+            # 只是mtime变化, 内容没变
+            self.file_stat = file_stat
+            self.hit_count += 1
+            return
+
+        start = time.perf_counter()
+        self.df = pd.read_csv(self.path, sep="\t", encoding="utf-8")
+        self.unprefixed_df = None
+        self.fact_index = None
+        self.row_name_index = None
+        self.file_stat = file_stat
+        self.file_hash = file_hash
+        self.load_count += 1
+        elapsed = time.perf_counter() - start
+        self.load_seconds += elapsed
+        logger.info(
+            "解析{}, {}行, 耗时{:.2f}s".format(
+                os.path.basename(self.path), len(self.df), elapsed
+            )
+        )
+
+    @staticmethod
+    def _hash_file(path: str) -> str:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def report(self) -> Dict:
+        stats = {
+            "load_count": self.load_count,
+            "load_seconds": self.load_seconds,
+            "hit_count": self.hit_count,
+        }
+        logger.info(
+            "{}共解析{}次, 耗时{:.2f}s, 缓存命中{}次".format(
+                os.path.basename(self.path),
+                self.load_count,
+                self.load_seconds,
+                self.hit_count,
+            )
+        )
+        return stats
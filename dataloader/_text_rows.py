@@ -0,0 +1,229 @@
+from loguru import logger
+from typing import *
+import numpy as np
+import json
+import ast
+import time
+import os
+
+TEXT_ROWS_MAGIC = b"ATXT"
+TEXT_ROWS_VERSION = 1
+ROW_TYPES = ["text", "excel"]
+
+HEADER_DTYPE = np.dtype(
+    [("magic", "S4"), ("version", "<u4"), ("n_rows", "<u8"), ("n_pages", "<u8")]
+)
+# 每页的行号区间和文本字节区间
+PAGE_DTYPE = np.dtype(
+    [
+        ("page", "<i4"),
+        ("row_start", "<u8"),
+        ("row_end", "<u8"),
+        ("byte_start", "<u8"),
+        ("byte_end", "<u8"),
+    ]
+)
+ROW_DTYPE = np.dtype(
+    [
+        ("page", "<i4"),
+        ("allrow", "<i8"),
+        ("type", "u1"),
+        ("byte_start", "<u8"),
+        ("byte_end", "<u8"),
+    ]
+)
+
+
+def parse_alltxt_lines(lines: Iterable[str], text_path: str = "") -> List[Dict]:
+    """
+    解析alltxts的jsonl行, 保留正文和表格行, 去掉空行和页眉页脚, 按allrow排序
+    表格行是str(list), 用ast.literal_eval还原后以制表符连接
+    """
+    text_lines = []
+    for line in lines:
+        line = json.loads(line)
+        if "type" not in line or "inside" not in line:
+            continue
+        if len(line["inside"].replace(" ", "")) == 0:
+            continue
+        if line["type"] in ["页脚", "页眉"]:
+            continue
+        if line["type"] == "text":
+            text_lines.append(line)
+        elif line["type"] == "excel":
+            try:
+                row = ast.literal_eval(line["inside"])
+                line["inside"] = "\t".join(row)
+                text_lines.append(line)
+            except:
+                logger.warning("Invalid line {}".format(line))
+        else:
+            logger.warning("Invalid line {}".format(line))
+
+    text_lines = sorted(text_lines, key=lambda x: x["allrow"])
+    if len(text_lines) == 0:
+        logger.warning("{} is empty".format(text_path))
+    return text_lines
+
+
+def compile_alltxt(text_path: str, bin_path: str) -> int:
+    """
+    把alltxts的jsonl编译为二进制格式:
+    头部 | 页索引(PAGE_DTYPE) | 行记录(ROW_DTYPE) | 以换行连接的utf-8文本
+    return: 行数
+    """
+    with open(text_path, "r", encoding="utf-8", errors="ignore") as f:
+        text_lines = parse_alltxt_lines(f, text_path)
+
+    rows = np.zeros(len(text_lines), dtype=ROW_DTYPE)
+    chunks = []
+    offset = 0
+    for i, line in enumerate(text_lines):
+        data = line["inside"].encode("utf-8", "surrogatepass")
+        rows[i] = (
+            line["page"],
+            line["allrow"],
+            ROW_TYPES.index(line["type"]),
+            offset,
+            offset + len(data),
+        )
+        chunks.append(data)
+        offset += len(data) + 1
+
+    # 行已按allrow排序, 同一页的行连续
+    page_starts = [
+        i for i in range(len(rows)) if i == 0 or rows["page"][i] != rows["page"][i - 1]
+    ]
+    pages = np.zeros(len(page_starts), dtype=PAGE_DTYPE)
+    for p, start in enumerate(page_starts):
+        end = page_starts[p + 1] if p + 1 < len(page_starts) else len(rows)
+        pages[p] = (
+            rows["page"][start],
+            start,
+            end,
+            rows["byte_start"][start],
+            rows["byte_end"][end - 1],
+        )
+
+    header = np.array(
+        [(TEXT_ROWS_MAGIC, TEXT_ROWS_VERSION, len(rows), len(pages))],
+        dtype=HEADER_DTYPE,
+    )
+    tmp_path = bin_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header.tobytes())
+        f.write(pages.tobytes())
+        f.write(rows.tobytes())
+        f.write(b"\n".join(chunks))
+    os.replace(tmp_path, bin_path)
+    return len(rows)
+
+
+class TextRows:
+    """
+    编译后的年报文本, 整个文件内存映射, 按页或按行取文本时只解码对应的字节
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        buf = np.memmap(path, dtype=np.uint8, mode="r")
+        header = buf[: HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        if header["magic"] != TEXT_ROWS_MAGIC or header["version"] != TEXT_ROWS_VERSION:
+            raise ValueError("unsupported text rows file {}".format(path))
+        pages_start = HEADER_DTYPE.itemsize
+        rows_start = pages_start + int(header["n_pages"]) * PAGE_DTYPE.itemsize
+        text_start = rows_start + int(header["n_rows"]) * ROW_DTYPE.itemsize
+        self.pages = buf[pages_start:rows_start].view(PAGE_DTYPE)
+        self.rows = buf[rows_start:text_start].view(ROW_DTYPE)
+        self.text = buf[text_start:]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _decode(self, start: int, end: int) -> str:
+        return self.text[start:end].tobytes().decode("utf-8", "surrogatepass")
+
+    def page_text(self, p: int) -> str:
+        """
+        第p个有内容的页, 各行以换行连接
+        """
+        page = self.pages[p]
+        return self._decode(page["byte_start"], page["byte_end"])
+
+    def page_texts(self) -> List[str]:
+        return [self.page_text(p) for p in range(len(self.pages))]
+
+    def row(self, i: int) -> Dict:
+        row = self.rows[i]
+        return {
+            "page": int(row["page"]),
+            "allrow": int(row["allrow"]),
+            "type": ROW_TYPES[row["type"]],
+            "inside": self._decode(row["byte_start"], row["byte_end"]),
+        }
+
+    def all_rows(self) -> List[Dict]:
+        return [self.row(i) for i in range(len(self.rows))]
+
+
+def test_text_rows():
+    """
+    与解析jsonl的结果一致, 并比较加载耗时
+    """
+    import tempfile
+    import random
+
+    random.seed(0)
+    chars = "营业收入利润总额研发投入员工人数社会责任客户集中度现金流量资产负债"
+    records = []
+    allrow = 0
+    for page in range(1, 301):
+        for i in range(40):
+            kind = random.random()
+            if i == 0:
+                record = {"type": "页眉", "inside": "某公司2019年年度报告"}
+            elif i == 39:
+                record = {"type": "页脚", "inside": f"{page} / 300"}
+            elif i == 20 and page % 100 == 0:
+                # 单元格为None的表格行无法连接, 与原先一样丢弃
+                record = {"type": "excel", "inside": str(["a", None])}
+            elif kind < 0.3:
+                cells = ["".join(random.choices(chars, k=random.randint(0, 8)))]
+                record = {"type": "excel", "inside": str(cells * 4)}
+            elif kind < 0.32:
+                record = {"type": "text", "inside": "   "}
+            else:
+                text = "".join(random.choices(chars, k=random.randint(1, 60)))
+                record = {"type": "text", "inside": text}
+            records.append({"page": page, "allrow": allrow, **record})
+            allrow += 1
+    random.shuffle(records)
+
+    with tempfile.TemporaryDirectory() as ctx_dir:
+        text_path = os.path.join(ctx_dir, "doc.txt")
+        bin_path = os.path.join(ctx_dir, "doc.bin")
+        with open(text_path, "w", encoding="utf-8") as f:
+            for r in records:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+
+        start = time.perf_counter()
+        with open(text_path, "r", encoding="utf-8") as f:
+            expected = parse_alltxt_lines(f)
+        parse_cost = time.perf_counter() - start
+        compile_alltxt(text_path, bin_path)
+
+        start = time.perf_counter()
+        rows = TextRows(bin_path)
+        pages = rows.page_texts()
+        load_cost = time.perf_counter() - start
+        assert rows.all_rows() == expected
+        assert pages[5] == "\n".join([r["inside"] for r in expected if r["page"] == 6])
+
+        start = time.perf_counter()
+        TextRows(bin_path).page_text(150)
+        page_cost = time.perf_counter() - start
+        logger.info(
+            "{}行: 解析jsonl {:.1f}ms, 二进制加载全部页 {:.1f}ms, 只取一页 {:.2f}ms".format(
+                len(records), parse_cost * 1000, load_cost * 1000, page_cost * 1000
+            )
+        )
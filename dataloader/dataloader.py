@@ -6,7 +6,18 @@ from typing import *
 from loguru import logger
 import sqlite3
 import numpy as np
+import time
+import re
+from collections import OrderedDict
 from pathlib import Path
+from ._entity_index import EntityIndex
+from ._table_store import CompanyTableStore
+from ._row_name_index import RowNameIndex
+from ._sql_store import build_company_db, open_company_db
+from ._bm25_store import Bm25Store
+from ._dense_store import DenseChunkStore
+from ._chunk_store import ChunkStore, DocChunks
+from ._text_rows import TextRows, parse_alltxt_lines, compile_alltxt
 
 file_dir = os.path.dirname(__file__)
 
@@ -15,11 +26,29 @@ class DataLoader(BaseModel):
     ctx_dir: Path
     inference_dir: Path
     pdf_metadata_map: dict = None
+    entity_index: EntityIndex = None
     company_table: pd.DataFrame = None
+    company_table_store: CompanyTableStore = None
     classfication_map: Dict[int, str] = None
     keywords_map: Dict[int, List[str]] = None
     nl2sql_map: Dict[int, str] = None
     sql_cursor: sqlite3.Cursor = None
+    # 单条sql的执行时间上限(秒), 以及返回结果的行数和字节数上限
+    sql_timeout: float = 5.0
+    sql_max_rows: int = 500
+    sql_max_bytes: int = 32 * 1024
+    sql_result_cache_size: int = 1024
+    sql_result_cache: OrderedDict = None
+    sql_stats: Dict[str, int] = None
+    # 年报bm25模型缓存的字节数上限(按内存占用估算)
+    bm25_cache_bytes: int = 256 * 1024 * 1024
+    bm25_store: Bm25Store = None
+    # 年报清洗后文本行缓存的字节数上限
+    chunk_cache_bytes: int = 256 * 1024 * 1024
+    chunk_store: ChunkStore = None
+    # 年报文本块向量索引及问题编码器, 编码器为None时不做向量检索
+    dense_store: DenseChunkStore = None
+    dense_encoder: Any = None
 
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
@@ -33,35 +62,58 @@ class DataLoader(BaseModel):
             self.pdf_metadata_map = json.load(f)
             return self.pdf_metadata_map
 
+    def load_entity_index(self) -> EntityIndex:
+        """
+        公司名称实体索引, 元数据变化时重新构建
+        """
+        pdf_metadata_map = self.load_pdf_metadata_map()
+        if (
+            self.entity_index is None
+            or self.entity_index.pdf_metadata_map is not pdf_metadata_map
+        ):
+            self.entity_index = EntityIndex(pdf_metadata_map)
+        return self.entity_index
+
     def load_company_table(
         self,
         data: pd.DataFrame = None,
         remove_column_prefix=False,
         reset=True,
     ) -> pd.DataFrame:
-        if reset:
-            self.company_table = None
-
-        if self.company_table is not None:
+        """
+        CompanyTable.csv只解析一次, 文件变化时自动重新加载, reset=False时沿用上一次返回的表
+        返回的表与缓存共享数据, 不要原地修改
+        """
+        if not reset and self.company_table is not None:
             return self.company_table
         if data is not None:
             self.company_table = data
             return self.company_table
-        df = pd.read_csv(
-            os.path.join(self.ctx_dir, "CompanyTable.csv"), sep="\t", encoding="utf-8"
-        )
-        if remove_column_prefix:
-            df.columns = [
-                col.replace(col, col.split(".")[1]) if len(col.split(".")) > 1 else col
-                for col in df.columns
-            ]
-        col_names = [col for col in df.columns]
-        col_names = ["- " + cn for cn in col_names]
-        col_names = "\n".join(col_names)
-
-        self.company_table = df
+        if self.company_table_store is None:
+            self.company_table_store = CompanyTableStore(
+                os.path.join(self.ctx_dir, "CompanyTable.csv")
+            )
+        self.company_table = self.company_table_store.get(remove_column_prefix)
         return self.company_table
 
+    def report_stats(self):
+        if self.company_table_store is not None:
+            self.company_table_store.report()
+            if self.company_table_store.row_name_index is not None:
+                self.company_table_store.row_name_index.report()
+        if self.chunk_store is not None:
+            self.chunk_store.report()
+        if self.bm25_store is not None:
+            self.bm25_store.report()
+        if self.dense_store is not None:
+            self.dense_store.report()
+        if self.sql_stats is not None:
+            logger.info(
+                "sql执行{executed}次, 结果缓存命中{cache_hit}次, 超时{timeout}次, 结果截断{truncated}次".format(
+                    **self.sql_stats
+                )
+            )
+
     def load_classification_map(self, data: dict = None) -> Dict:
         if self.classfication_map is not None:
             return self.classfication_map
@@ -105,6 +157,32 @@ class DataLoader(BaseModel):
         self.nl2sql_map = m
         return self.nl2sql_map
 
+    def merge_classification_map(self, data: Dict[int, str]):
+        """
+        合并推理过程中产生的结果, 使后续阶段无需经过文件即可读取
+        """
+        if self.classfication_map is None:
+            self.classfication_map = {}
+        self.classfication_map.update(data)
+
+    def merge_keywords_map(self, data: Dict[int, List[str]]):
+        if self.keywords_map is None:
+            self.keywords_map = {}
+        self.keywords_map.update(data)
+
+    def merge_nl2sql_map(self, data: Dict[int, str]):
+        if self.nl2sql_map is None:
+            self.nl2sql_map = {}
+        self.nl2sql_map.update(data)
+
+    def forget_question(self, question_id: int):
+        """
+        在线服务中问题处理完后清理中间结果, 避免常驻进程内存无限增长
+        """
+        for m in [self.classfication_map, self.keywords_map, self.nl2sql_map]:
+            if m is not None:
+                m.pop(question_id, None)
+
     def find_company_table_data(
         self, company, years: List[Union[int, str]]
     ) -> pd.DataFrame:
@@ -115,61 +193,60 @@ class DataLoader(BaseModel):
         # convert years to list of ints
         years = [int(year) for year in years]
 
-        df = self.load_company_table()
-        rows = df.query(f"`公司全称` == '{company}' and `年份`.isin({years})")
-        tuples = []
-        for index, row in rows.iterrows():
-            for col_name in rows.columns:
-                split = col_name.split(".")
-                if len(split) == 1:
-                    table_name = "no_table"
-                    key = split[0]
-                else:
-                    table_name = split[0]
-                    key = split[1]
-                value = row[col_name]
-                tuples.append((table_name, str(row["年份"]), key, value))
-        return tuples
+        self.load_company_table()
+        return self.company_table_store.get_fact_index().find(company, years)
+
+    def load_row_name_index(self) -> RowNameIndex:
+        """
+        company_table行名的匹配索引, 供recall_pdf_tables使用, 表重新解析后随之重建
+        """
+        self.load_company_table()
+        return self.company_table_store.get_row_name_index()
+
+    def _pdf_text_bin_path(self, key: str) -> str:
+        # 与alltxts分开存放, 列举alltxts时只有jsonl文件
+        return os.path.join(self.ctx_dir, "alltxt_bin", "{}.bin".format(key))
+
+    def _load_pdf_text_rows(self, key: str) -> Optional[TextRows]:
+        """
+        预处理时编译的二进制文本, 不存在, 比alltxts旧或无法读取时返回None
+        """
+        text_path = os.path.join(self.ctx_dir, "alltxts", "{}.txt".format(key))
+        bin_path = self._pdf_text_bin_path(key)
+        if not os.path.exists(bin_path):
+            return None
+        if os.path.exists(text_path) and os.path.getmtime(bin_path) < os.path.getmtime(
+            text_path
+        ):
+            return None
+        try:
+            return TextRows(bin_path)
+        except Exception as e:
+            logger.warning("{}无法读取, 改为解析alltxts: {}".format(bin_path, e))
+            return None
 
     def load_pdf_pure_text_alltxt(self, key: str):
-        key = key.replace(".pdf", "")
+        key = os.path.splitext(key.replace(".pdf", ""))[0]
+        text_rows = self._load_pdf_text_rows(key)
+        if text_rows is not None:
+            return text_rows.all_rows()
+
         text_lines = []
-        text_path = os.path.join(
-            self.ctx_dir, "alltxts", "{}.txt".format(os.path.splitext(key)[0])
-        )
+        text_path = os.path.join(self.ctx_dir, "alltxts", "{}.txt".format(key))
         if not os.path.exists(text_path):
             logger.warning("{} not exists".format(text_path))
             return text_lines
         with open(text_path, "r", encoding="utf-8", errors="ignore") as f:
-            lines = f.readlines()
-            raw_lines = [json.loads(line) for line in lines]
-            for line in raw_lines:
-                if "type" not in line or "inside" not in line:
-                    continue
-                if len(line["inside"].replace(" ", "")) == 0:
-                    continue
-                if line["type"] in ["页脚", "页眉"]:
-                    continue
-                if line["type"] == "text":
-                    text_lines.append(line)
-                elif line["type"] == "excel":
-                    try:
-                        row = eval(line["inside"])
-                        line["inside"] = "\t".join(row)
-                        text_lines.append(line)
-                    except:
-                        logger.warning("Invalid line {}".format(line))
-                else:
-                    logger.warning("Invalid line {}".format(line))
-
-            text_lines = sorted(text_lines, key=lambda x: x["allrow"])
-
-            if len(text_lines) == 0:
-                logger.warning("{} is empty".format(text_path))
+            text_lines = parse_alltxt_lines(f, text_path)
 
         return text_lines
 
     def load_pdf_pages(self, key: str):
+        key = os.path.splitext(key.replace(".pdf", ""))[0]
+        text_rows = self._load_pdf_text_rows(key)
+        if text_rows is not None:
+            return text_rows.page_texts()
+
         all_lines = self.load_pdf_pure_text_alltxt(key)
         pages = []
         if len(all_lines) == 0:
@@ -186,44 +263,120 @@ class DataLoader(BaseModel):
         pages.append("\n".join([t["inside"] for t in current_page]))
         return pages
 
+    def compile_pdf_text(self, key: str):
+        """
+        把alltxts的jsonl编译为二进制格式, 写入alltxt_bin目录, 预处理时调用
+        """
+        key = os.path.splitext(key.replace(".pdf", ""))[0]
+        text_path = os.path.join(self.ctx_dir, "alltxts", "{}.txt".format(key))
+        if not os.path.exists(text_path):
+            logger.warning("{} not exists".format(text_path))
+            return
+        bin_path = self._pdf_text_bin_path(key)
+        os.makedirs(os.path.dirname(bin_path), exist_ok=True)
+        compile_alltxt(text_path, bin_path)
+
+    def load_pdf_chunks(self, key: str) -> DocChunks:
+        """
+        年报清洗后的所有非空文本行, 可按行号区间直接切出连续多行的文本
+        优先使用预处理时持久化的结果, 加载后缓存在内存中
+        """
+        if self.chunk_store is None:
+            self.chunk_store = ChunkStore(
+                self.ctx_dir, max_bytes=self.chunk_cache_bytes
+            )
+        key = os.path.splitext(key.replace(".pdf", ""))[0]
+        return self.chunk_store.get(key, self.load_pdf_pages)
+
+    def build_pdf_chunks(self, key: str):
+        """
+        构建并持久化年报清洗后的文本行, 预处理时调用
+        """
+        if self.chunk_store is None:
+            self.chunk_store = ChunkStore(
+                self.ctx_dir, max_bytes=self.chunk_cache_bytes
+            )
+        key = os.path.splitext(key.replace(".pdf", ""))[0]
+        self.chunk_store.build(key, self.load_pdf_pages(key))
+
+    def load_pdf_text_lines(self, key: str) -> List[str]:
+        """
+        年报的所有非空文本行
+        """
+        return self.load_pdf_chunks(key).lines()
+
+    def load_pdf_bm25(self, key: str) -> Tuple[List[str], Any]:
+        """
+        年报的文本行及以每行为文档的bm25模型(fastbm25), 没有文本时模型为None
+        优先使用预处理时持久化的模型, 加载后缓存在内存中
+        """
+        if self.bm25_store is None:
+            self.bm25_store = Bm25Store(self.ctx_dir, max_bytes=self.bm25_cache_bytes)
+        key = os.path.splitext(key.replace(".pdf", ""))[0]
+        return self.bm25_store.get(key, self.load_pdf_text_lines)
+
+    def build_pdf_bm25(self, key: str):
+        """
+        构建并持久化年报的bm25模型, 预处理时调用
+        """
+        if self.bm25_store is None:
+            self.bm25_store = Bm25Store(self.ctx_dir, max_bytes=self.bm25_cache_bytes)
+        key = os.path.splitext(key.replace(".pdf", ""))[0]
+        self.bm25_store.build(key, self.load_pdf_text_lines(key))
+
+    def search_pdf_dense(
+        self, key: str, query: str, n_lines: int, top_k: int = 10
+    ) -> List[Tuple[int, int, float]]:
+        """
+        n_lines: 年报当前的文本行数, 用于判断索引是否过期
+        return: 与问题最相似的文本块[(起始行, 结束行, 相似度)], 未启用或索引不可用时为空
+        """
+        if self.dense_encoder is None:
+            return []
+        if self.dense_store is None:
+            self.dense_store = DenseChunkStore(self.ctx_dir)
+        key = os.path.splitext(key.replace(".pdf", ""))[0]
+        hits = self.dense_store.search(
+            key, self.dense_encoder([query]), n_lines, top_k=top_k
+        )[0]
+        if len(hits) == 0:
+            return []
+        chunk_size = self.dense_store.meta["chunk_size"]
+        stride = self.dense_store.meta["stride"]
+        return [
+            (i * stride, min(i * stride + chunk_size, n_lines), score)
+            for i, score in hits
+        ]
+
+    def build_pdf_dense(self, keys: List[str], encoder=None, dtype="float16"):
+        """
+        为所有年报的文本块编码并写入向量索引, 预处理时调用
+        """
+        if self.dense_store is None:
+            self.dense_store = DenseChunkStore(self.ctx_dir)
+        keys = [os.path.splitext(k.replace(".pdf", ""))[0] for k in keys]
+        self.dense_store.build(
+            keys, self.load_pdf_text_lines, encoder or self.dense_encoder, dtype=dtype
+        )
+
     def load_sql_search_cursor(self) -> sqlite3.Cursor:
         """
-        将dataframe转换为关系型数据库，方便查询
+        company_table的sqlite查询游标
+        预处理时已写好CompanyTable.db, 这里只需只读打开; 文件不存在或比csv旧时重新生成
         """
         if self.sql_cursor is not None:
             return self.sql_cursor
 
-        conn = sqlite3.connect(":memory:")
-
-        df = self.load_company_table(remove_column_prefix=True)
-
-        dtypes = {}
-        for col in df.columns:
-            num_count = 0
-            tot_count = 0
-            for v in df[col]:
-                if v == "NULLVALUE":
-                    continue
-                tot_count += 1
-                try:
-                    number = float(v)
-                except ValueError:
-                    continue
-                num_count += 1
-            if tot_count > 0 and num_count / tot_count > 0.5:
-                df[col] = (
-                    df[col]
-                    .apply(lambda t: DataLoader.col_to_numeric(t))
-                    .replace([np.inf, -np.inf], np.nan)
-                )
-                dtypes[col] = "REAL"
-            else:
-                dtypes[col] = "TEXT"
-
-        dtypes["年份"] = "TEXT"
-        df.to_sql(name="company_table", con=conn, if_exists="replace", dtype=dtypes)
+        csv_path = os.path.join(self.ctx_dir, "CompanyTable.csv")
+        db_path = os.path.join(self.ctx_dir, "CompanyTable.db")
+        if not os.path.exists(db_path) or os.path.getmtime(db_path) < os.path.getmtime(
+            csv_path
+        ):
+            build_company_db(
+                self.load_company_table(remove_column_prefix=True), db_path
+            )
 
-        cursor = conn.cursor()
+        cursor = open_company_db(db_path).cursor()
 
         self.sql_cursor = cursor
 
@@ -281,8 +434,117 @@ class DataLoader(BaseModel):
         except Exception as e:
             return {}, str(e)
 
+    def exec_sql_v3(self, sql) -> Tuple[dict, str]:
+        """
+        带资源限制的sql执行
+        - 通过sqlite的progress handler限制单条sql的执行时间
+        - 用fetchmany逐批读取, 超出行数或字节数上限时截断
+        - 按规范化后的sql缓存执行结果, 超时的结果不缓存
+        返回结果额外带有elapsed(秒), truncated, cached字段
+        """
+        if self.sql_result_cache is None:
+            self.sql_result_cache = OrderedDict()
+            self.sql_stats = {
+                "executed": 0,
+                "cache_hit": 0,
+                "timeout": 0,
+                "truncated": 0,
+            }
+
+        cache_key = DataLoader.normalize_sql(sql)
+        if cache_key in self.sql_result_cache:
+            self.sql_result_cache.move_to_end(cache_key)
+            self.sql_stats["cache_hit"] += 1
+            result, err = self.sql_result_cache[cache_key]
+            # 调用方可能修改结果, 返回副本
+            return {**result, "executed_sql": sql, "cached": True}, err
+
+        timeout_count = self.sql_stats["timeout"]
+        result, err = self._exec_sql_bounded(sql)
+        # 超时与机器负载有关, 下次执行未必超时
+        if self.sql_stats["timeout"] > timeout_count:
+            return {**result}, err
+        self.sql_result_cache[cache_key] = (result, err)
+        if len(self.sql_result_cache) > self.sql_result_cache_size:
+            self.sql_result_cache.popitem(last=False)
+        return {**result}, err
+
+    def _exec_sql_bounded(self, sql) -> Tuple[dict, str]:
+        sql_cursor = self.load_sql_search_cursor()
+        conn = sql_cursor.connection
+        self.sql_stats["executed"] += 1
+
+        start = time.perf_counter()
+        deadline = start + self.sql_timeout
+        # 返回非0值时sqlite中断当前语句
+        conn.set_progress_handler(lambda: int(time.perf_counter() > deadline), 1000)
+        rows = []
+        total_bytes = 0
+        truncated = False
+        try:
+            sql_cursor.execute(sql)
+            while not truncated:
+                batch = sql_cursor.fetchmany(100)
+                if len(batch) == 0:
+                    break
+                for row in batch:
+                    if len(row) == 1:
+                        line = f"{row[0]}"
+                    elif len(row) == 2:
+                        line = ":".join([f"{val}" for val in row])
+                    else:
+                        line = ",".join([f"{val}" for val in row])
+                    total_bytes += len(line.encode("utf-8")) + 1
+                    if (
+                        len(rows) >= self.sql_max_rows
+                        or total_bytes > self.sql_max_bytes
+                    ):
+                        truncated = True
+                        break
+                    rows.append(line)
+        except sqlite3.OperationalError as e:
+            if time.perf_counter() > deadline:
+                self.sql_stats["timeout"] += 1
+                return {}, "sql执行超时({}秒), 请检查过滤条件".format(self.sql_timeout)
+            return {}, str(e)
+        except Exception as e:
+            return {}, str(e)
+        finally:
+            conn.set_progress_handler(None, 1000)
+
+        if truncated:
+            self.sql_stats["truncated"] += 1
+            logger.warning(f"sql结果超出上限, 只保留前{len(rows)}行: {sql}")
+        return {
+            "result": "\n".join(rows),
+            "executed_sql": sql,
+            "elapsed": time.perf_counter() - start,
+            "truncated": truncated,
+            "cached": False,
+        }, None
+
+    @staticmethod
+    def normalize_sql(sql: str) -> str:
+        """
+        合并引号外的空白并去掉末尾分号, 作为结果缓存的key
+        """
+        parts = re.split(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")", sql.strip())
+        for i in range(0, len(parts), 2):
+            parts[i] = re.sub(r"\s+", " ", parts[i])
+        return "".join(parts).strip().rstrip(";").strip()
+
+    def explain_sql(self, sql) -> Optional[str]:
+        """
+        用EXPLAIN只编译不执行sql, 返回sqlite的报错信息, 语法和字段都正确时返回None
+        """
+        try:
+            self.load_sql_search_cursor().execute("EXPLAIN " + sql)
+        except (sqlite3.Error, sqlite3.Warning) as e:
+            return str(e)
+        return None
+
     def exec_sql(self, sql) -> Tuple[dict, str]:
-        return self.exec_sql_v2(sql)
+        return self.exec_sql_v3(sql)
 
 
 def test_exec_sql():
@@ -297,6 +559,56 @@ def test_exec_sql():
     print(f"err: {err}")
 
 
+def test_exec_sql_bounded():
+    """
+    用内存数据库检查sql执行的超时, 结果截断和缓存
+    """
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE company_table (公司全称 TEXT, 年份 INTEGER)")
+    conn.executemany(
+        "INSERT INTO company_table VALUES (?, ?)",
+        [(f"公司{i}", 2019 + i % 3) for i in range(100)],
+    )
+    loader = DataLoader(
+        ctx_dir=file_dir,
+        inference_dir=file_dir,
+        sql_cursor=conn.cursor(),
+        sql_timeout=0.05,
+        sql_max_rows=10,
+        sql_max_bytes=64,
+    )
+
+    # 无限递归的查询被progress handler中断, 超时结果不进入缓存
+    endless = (
+        "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) "
+        "SELECT count(*) FROM c"
+    )
+    for _ in range(2):
+        result, err = loader.exec_sql(endless)
+        assert result == {} and err.startswith("sql执行超时")
+    assert loader.sql_stats["timeout"] == 2 and loader.sql_stats["executed"] == 2
+    assert len(loader.sql_result_cache) == 0
+
+    # 超出行数上限
+    result, err = loader.exec_sql("SELECT 年份 FROM company_table")
+    assert err is None and result["truncated"]
+    assert len(result["result"].split("\n")) == 10
+    # 超出字节数上限
+    result, err = loader.exec_sql("SELECT 公司全称, 年份 FROM company_table")
+    assert err is None and result["truncated"]
+    assert len(result["result"].encode("utf-8")) <= 64
+    assert loader.sql_stats["truncated"] == 2
+
+    # 只有空白和末尾分号不同的sql命中缓存, 出错的结果同样缓存
+    result, err = loader.exec_sql("SELECT  年份\nFROM company_table;")
+    assert result["cached"] and result["truncated"]
+    result, err = loader.exec_sql("SELECT 不存在的列 FROM company_table")
+    assert result == {} and "no such column" in err
+    result, err = loader.exec_sql("SELECT 不存在的列 FROM company_table")
+    assert "no such column" in err
+    assert loader.sql_stats["cache_hit"] == 2 and loader.sql_stats["executed"] == 5
+
+
 def test_dataloader():
     loader = DataLoader(
         ctx_dir=Path(Path(file_dir).parent, "resources/processed_data").as_posix(),
@@ -1,3 +1,6 @@
 from .inferencer import Inferencer
 from ._model import VllmModel, MockModel
 from ._hf_model import HFModelForClassification
+from ._response_cache import ResponseCache
+from ._pipeline import QAPipeline
+from ._service import QAService
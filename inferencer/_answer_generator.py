@@ -2,14 +2,13 @@ from loguru import logger
 import re
 from typing import *
 from dataloader import DataLoader
-from difflib import SequenceMatcher
 from ._prompt import type1_prompt, keyword_extraction_prompt_type3, type3_prompt
 from ._model import InferenceModel
-import itertools
-from fastbm25 import fastbm25
 from ._answer_generator_util import AnswerGeneratorUtil
+from ._context_packer import ContextPacker
+from ._lcs import BlockScorer, SuffixAutomatonScorer
 from abc import ABC, abstractmethod
-
+from pydantic import BaseModel
 
 valid_table_map = {
     "A": ["basic_info", "no_table"],
@@ -27,23 +26,35 @@ valid_table_map = {
 }
 
 
+class ChatRequest(BaseModel):
+    """
+    答案生成过程中待执行的一次模型调用
+    """
+
+    prompt: str
+    max_tokens: int = 2048
+    lora_name: str = ""
+
+
+# 生成器每次yield一个ChatRequest(或一组相互独立的ChatRequest),
+# 收到模型输出(或输出列表)后继续执行, 最终return答案
+AnswerSteps = Generator[
+    Union[ChatRequest, List[ChatRequest]], Union[str, List[str]], str
+]
+
+
 class AnswerGenerator(ABC):
     def __init__(self, dataloader: DataLoader, model: InferenceModel):
         self.dataloader = dataloader
         self.model = model
         self.valid_table_map = valid_table_map
+        self.packer = ContextPacker(count_tokens=model.count_tokens)
+        # 召回文本块按与问题的最长公共子串长度重排
+        self.block_scorer: BlockScorer = SuffixAutomatonScorer()
 
     def get_match_pdf_names(self, question):
         years = AnswerGeneratorUtil.extract_years(question)
-        match_keys = []
-        for k, v in self.dataloader.load_pdf_metadata_map().items():
-            company = v["company"]
-            abbr = v["abbr"]
-            year = v["year"].replace("年", "").replace(" ", "")
-            if company in question and year in years:
-                match_keys.append(k)
-            if abbr in question and year in years:
-                match_keys.append(k)
+        match_keys = self.dataloader.load_entity_index().find_pdf_keys(question, years)
         match_keys = list(set(match_keys))
         # 前面已经完全匹配了年份, 所以可以删除年份
         overlap_len = [
@@ -104,34 +115,31 @@ class AnswerGenerator(ABC):
         anoy_question = re.sub(r"(公司|年报|根据|数据|介绍)", "", anoy_question)
         logger.debug("anoy_question: {}".format(anoy_question.replace("<", "")))
 
-        text_pages = self.dataloader.load_pdf_pages(key)
-        text_lines = list(itertools.chain(*[page.split("\n") for page in text_pages]))
-        text_lines = [line for line in text_lines if len(line) > 0]
-        if len(text_lines) == 0:
+        chunks = self.dataloader.load_pdf_chunks(key)
+        if len(chunks) == 0:
             return []
-        model = fastbm25(text_lines)
+        _, model = self.dataloader.load_pdf_bm25(key)
         result_keywords = model.top_k_sentence(keywords, k=3)
         result_question = model.top_k_sentence(anoy_question, k=3)
         top_match_indexes = [t[1] for t in result_question + result_keywords]
+        dense_hits = self.dataloader.search_pdf_dense(key, anoy_question, len(chunks))
+        if len(dense_hits) > 0:
+            top_match_indexes = self.fuse_dense_hits(
+                model, anoy_question, keywords, dense_hits
+            )
         block_line_indexes = AnswerGeneratorUtil.merge_idx(
-            top_match_indexes, len(text_lines), 0, 30
+            top_match_indexes, len(chunks), 0, 30
         )
 
+        # 合并后的每个文本块都是连续的行, 直接按行号区间切片
         text_blocks = [
-            "\n".join([text_lines[idx] for idx in line_indexes])
+            chunks.window(line_indexes[0], line_indexes[-1] + 1)
             for line_indexes in block_line_indexes
         ]
         text_blocks = [re.sub(" {3,}", "\t", text_block) for text_block in text_blocks]
 
-        text_blocks = [
-            (
-                t,
-                SequenceMatcher(None, anoy_question, t, autojunk=False)
-                .find_longest_match()
-                .size,
-            )
-            for t in text_blocks
-        ]
+        match_sizes = self.block_scorer.score(anoy_question, text_blocks)
+        text_blocks = list(zip(text_blocks, match_sizes))
 
         max_match_size = max([t[1] for t in text_blocks])
         text_blocks = [t[0] for t in text_blocks if t[1] == max_match_size]
@@ -144,6 +152,27 @@ class AnswerGenerator(ABC):
         text_blocks = ["```\n{}\n```".format(t) for t in text_blocks]
         return text_blocks
 
+    def fuse_dense_hits(
+        self, model, anoy_question, keywords, dense_hits, top_k=6
+    ) -> List[int]:
+        """
+        bm25与向量检索的结果按RRF融合, 返回排名靠前的起始行
+        bm25命中的行落在召回的向量文本块中时, 算作该文本块
+        """
+
+        def to_block(line):
+            for start, end, _ in dense_hits:
+                if start <= line < end:
+                    return start
+            return line
+
+        rankings = [
+            list(dict.fromkeys([to_block(t[1]) for t in model.top_k_sentence(q, k=10)]))
+            for q in [anoy_question, keywords]
+        ]
+        rankings.append([start for start, _, _ in dense_hits])
+        return AnswerGeneratorUtil.reciprocal_rank_fusion(rankings)[:top_k]
+
     def parse_question_keywords(self, question, real_company, years):
         question = (
             re.sub(r"[\(\)（）]", "", question)
@@ -161,13 +190,17 @@ class AnswerGenerator(ABC):
         )
         if anoy_question[0] == "的":
             anoy_question = anoy_question[1:]
-        answer = self.model(keyword_extraction_prompt_type3(anoy_question))
+        answer = yield ChatRequest(
+            prompt=keyword_extraction_prompt_type3(anoy_question)
+        )
 
         key_words = AnswerGeneratorUtil.parse_keyword_from_answer(anoy_question, answer)
         # 无法提取，删除的再试一次
         if len(key_words) == 0:
             anoy_question = anoy_question.replace("的", "")
-            answer = self.model(keyword_extraction_prompt_type3(anoy_question))
+            answer = yield ChatRequest(
+                prompt=keyword_extraction_prompt_type3(anoy_question)
+            )
             key_words = AnswerGeneratorUtil.parse_keyword_from_answer(
                 anoy_question, answer
             )
@@ -182,5 +215,39 @@ class AnswerGenerator(ABC):
         return re.sub(r"[\(\)（）]", "", question)
 
     @abstractmethod
-    def generate_answer(self, question_id, question, question_type) -> str:
+    def generate_answer_steps(
+        self, question_id, question, question_type
+    ) -> AnswerSteps:
+        """
+        以生成器的形式生成答案, 需要模型时yield ChatRequest, 由调用方send回模型输出
+        """
         pass
+
+    def generate_answer(self, question_id, question, question_type) -> str:
+        """
+        逐条执行模型调用, 生成单个问题的答案
+        """
+        steps = self.generate_answer_steps(question_id, question, question_type)
+        return AnswerGenerator.run_steps(steps, self.model)
+
+    @staticmethod
+    def run_steps(steps: AnswerSteps, model: InferenceModel) -> str:
+        try:
+            request = next(steps)
+            while True:
+                if isinstance(request, list):
+                    output = [
+                        model.chat(
+                            r.prompt, max_tokens=r.max_tokens, lora_name=r.lora_name
+                        )
+                        for r in request
+                    ]
+                else:
+                    output = model.chat(
+                        request.prompt,
+                        max_tokens=request.max_tokens,
+                        lora_name=request.lora_name,
+                    )
+                request = steps.send(output)
+        except StopIteration as e:
+            return e.value
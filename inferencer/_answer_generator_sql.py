@@ -1,18 +1,33 @@
-from ._answer_generator import AnswerGenerator
+from ._answer_generator import AnswerGenerator, AnswerSteps, ChatRequest
 from dataloader import DataLoader
 from ._model import InferenceModel
 from ._answer_generator_util import AnswerGeneratorUtil
 import re
 from loguru import logger
+from ._column_index import ColumnIndex
 from ._prompt import sql_correction_prompt, find_synonyms_prompt, general_qa_prompt
 from typing import List
 
 
 class AnswerGeneratorSql(AnswerGenerator):
-    def __init__(self, dataloader: DataLoader, model: InferenceModel):
+    def __init__(self, dataloader: DataLoader, model: InferenceModel, planner=None):
+        """
+        planner: QueryPlanner, 能被规则解析的统计题直接查询作答, 不调用模型
+        """
         super().__init__(dataloader, model)
+        self.planner = planner
+        self.column_index: ColumnIndex = None
+
+    def generate_answer_steps(
+        self, question_id, question, question_type
+    ) -> AnswerSteps:
+        ori_question = AnswerGenerator.cleanup_question(question)
+        if self.planner is not None:
+            answer = self.planner.answer(ori_question)
+            if answer is not None:
+                return answer
 
-    def generate_answer(self, question_id, question, question_type) -> str:
+        # 规则无法解析或查询失败, 使用nl2sql阶段模型生成的sql
         sql_dict = self.dataloader.load_nl2sql_map()
         sql = sql_dict[question_id]
         existing_fields = list(
@@ -22,13 +37,15 @@ class AnswerGeneratorSql(AnswerGenerator):
         if sql is None:
             return ""
 
-        ori_question = AnswerGenerator.cleanup_question(question)
-
         sql = AnswerGeneratorSql.correct_sql_number(sql, ori_question)
         sql_ctx, exec_err = self.dataloader.exec_sql(sql)
 
         if exec_err is None:
-            return self._gen_answer_with_model(ori_question, sql_ctx, question_type)
+            return (
+                yield from self._gen_answer_with_model(
+                    ori_question, sql_ctx, question_type
+                )
+            )
 
         logger.warning(
             f"执行sql错误: {exec_err}, sql: {sql}, question_id: {question_id}"
@@ -39,7 +56,9 @@ class AnswerGeneratorSql(AnswerGenerator):
             wrong_column = exec_err.replace("no such column:", "").strip()
             logger.info(f"尝试修复no such column错误, 目标字段: {wrong_column}")
 
-            sql = self.correct_sql_field_llm(sql, existing_fields, wrong_column)
+            sql = yield from self.correct_sql_field_llm(
+                sql, existing_fields, wrong_column
+            )
             sql_ctx, exec_err = self.dataloader.exec_sql(sql)
             if exec_err is not None:
                 logger.error(
@@ -47,12 +66,16 @@ class AnswerGeneratorSql(AnswerGenerator):
                 )
                 return ""
             logger.info(f"no such column重试成功! sql: [{sql}], 答案: {sql_ctx}")
-            return self._gen_answer_with_model(ori_question, sql_ctx, question_type)
+            return (
+                yield from self._gen_answer_with_model(
+                    ori_question, sql_ctx, question_type
+                )
+            )
 
         logger.info(f"尝试修复sql错误...")
         logger.debug("模型纠正前sql: {}".format(sql.replace("<>", "")))
-        corrected_sqls = self.model(
-            sql_correction_prompt(existing_fields, sql, exec_err)
+        corrected_sqls = yield ChatRequest(
+            prompt=sql_correction_prompt(existing_fields, sql, exec_err)
         )
         logger.debug("模型纠正后sql: {}".format(corrected_sqls.replace("<>", "")))
 
@@ -70,16 +93,23 @@ class AnswerGeneratorSql(AnswerGenerator):
                 )
             )
             return ""
-        return self._gen_answer_with_model(ori_question, sql_ctx, question_type)
+        return (
+            yield from self._gen_answer_with_model(ori_question, sql_ctx, question_type)
+        )
 
     def _gen_answer_with_model(
         self, question: str, sql_ctx: dict, question_type: str
-    ) -> str:
+    ) -> AnswerSteps:
+        # 耗时, 截断等执行信息不放入prompt
+        ctx = {"result": sql_ctx["result"], "executed_sql": sql_ctx["executed_sql"]}
         if "第" in question and "高" in question:
-            sql_ctx["result"] = sql_ctx["result"].split("\n")[0]
-        prompt = general_qa_prompt(question=question, ctx=sql_ctx)
+            ctx["result"] = ctx["result"].split("\n")[0]
+        elif sql_ctx.get("truncated"):
+            ctx["result"] += "\n...(查询结果过多, 已截断)"
+        prompt = general_qa_prompt(question=question, ctx=ctx)
         logger.debug(f"prompt for type {question_type}: {prompt}")
-        return self.model.chat(question=prompt)
+        answer = yield ChatRequest(prompt=prompt)
+        return answer
 
     @staticmethod
     def correct_sql_number(sql, question):
@@ -194,12 +224,23 @@ class AnswerGeneratorSql(AnswerGenerator):
                     number_list.append(str(int(digit_num) * unit_dic.get(unit)))
         return number_list
 
+    def load_column_index(self, existing_fields: List[str]) -> ColumnIndex:
+        if self.column_index is None or self.column_index.columns != existing_fields:
+            self.column_index = ColumnIndex(existing_fields)
+        return self.column_index
+
     def correct_sql_field_llm(self, sql, existing_fields, wrong_column):
         """
-        用大模型来根据已知字段纠正sql中错误的字段
+        根据已知字段纠正sql中错误的字段, 先查字段相似度索引, 置信度不足时再用大模型
         """
         new_sql = sql
-        synonyms = self.find_synonyms_llm(wrong_column, existing_fields)
+        synonyms, score = self.load_column_index(existing_fields).resolve(wrong_column)
+        if synonyms is not None:
+            logger.info(
+                f"字段索引纠正: {wrong_column} -> {synonyms}, 置信度{score:.2f}"
+            )
+        else:
+            synonyms = yield from self.find_synonyms_llm(wrong_column, existing_fields)
         if len(synonyms) > 0:
             logger.debug("文本字段纠正前sql: {}".format(new_sql))
             new_sql = new_sql.replace(wrong_column, synonyms)
@@ -207,8 +248,9 @@ class AnswerGeneratorSql(AnswerGenerator):
         return new_sql
 
     def find_synonyms_llm(self, word, word_lsit):
+        answer = ""
         try:
-            answer = self.model(find_synonyms_prompt(word_lsit, word))
+            answer = yield ChatRequest(prompt=find_synonyms_prompt(word_lsit, word))
             logger.debug("同义词推理结果：{}".format(answer.replace("<>", "")))
         except Exception as e:
             logger.warning(
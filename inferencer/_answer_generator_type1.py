@@ -1,4 +1,4 @@
-from ._answer_generator import AnswerGenerator
+from ._answer_generator import AnswerGenerator, AnswerSteps, ChatRequest
 from dataloader import DataLoader
 from ._model import InferenceModel
 from ._answer_generator_util import AnswerGeneratorUtil
@@ -8,10 +8,15 @@ from ._prompt import type1_prompt
 
 
 class AnswerGeneratorType1(AnswerGenerator):
+    # prompt的token预算
+    token_budget = 3500
+
     def __init__(self, dataloader: DataLoader, model: InferenceModel):
         super().__init__(dataloader, model)
 
-    def generate_answer(self, question_id, question, question_type) -> str:
+    def generate_answer_steps(
+        self, question_id, question, question_type
+    ) -> AnswerSteps:
         question_keywords = self.get_question_keywords(question_id)
 
         ori_question = AnswerGenerator.cleanup_question(question)
@@ -25,14 +30,18 @@ class AnswerGeneratorType1(AnswerGenerator):
         answer = "经查询，无法回答: {}".format(ori_question)
 
         logger.debug("问题关键词: {}".format(question_keywords))
-        background = ""
+        year_headers = []
+        # 每年按排名从高到低排列的召回行
+        year_ranked_rows = []
         tot_matched_rows = []
         for year in years:
             # [(table name, row_year, column name, row_value)]
             data_rows = self.dataloader.find_company_table_data(company, [year])
 
-            background += "已知{}(简称:{},证券代码:{}){}年的资料如下:\n    ".format(
-                company, abbr, code, year
+            year_headers.append(
+                "已知{}(简称:{},证券代码:{}){}年的资料如下:\n    ".format(
+                    company, abbr, code, year
+                )
             )
             matched_table_rows = []
             for keyword in question_keywords:
@@ -44,21 +53,22 @@ class AnswerGeneratorType1(AnswerGenerator):
                         data_rows,
                         min_match_number=3,
                         valid_tables=self.valid_table_map[question_type],
+                        row_name_index=self.dataloader.load_row_name_index(),
                     )
                 )
 
             if len(matched_table_rows) == 0:
-                for table_row in data_rows:
-                    if table_row[0] in self.valid_table_map[question_type]:
-                        matched_table_rows.append(table_row)
-
-            table_text = AnswerGeneratorUtil.table_to_text(
-                matched_table_rows,
-                with_year=False,
-            )
-            background += table_text
-            background += "\n"
+                # 没有关键词命中时, 有效表的所有行都作为候选, 按与关键词的重合度排序
+                matched_table_rows = AnswerGeneratorUtil.recall_pdf_tables(
+                    "".join(question_keywords) or ori_question,
+                    [year],
+                    data_rows,
+                    min_match_number=0,
+                    valid_tables=self.valid_table_map[question_type],
+                    row_name_index=self.dataloader.load_row_name_index(),
+                )
 
+            year_ranked_rows.append(matched_table_rows)
             tot_matched_rows.extend(matched_table_rows)
 
         tot_matched_rows = AnswerGeneratorUtil.add_text_compare_in_table(
@@ -69,11 +79,70 @@ class AnswerGeneratorType1(AnswerGenerator):
         if "相同" in tot_text or "不相同且不同" in tot_text:
             answer = tot_text
         else:
+            background = self.pack_background(
+                ori_question, company, abbr, years, year_headers, year_ranked_rows
+            )
             prompt = type1_prompt(ori_question, company, abbr, years).format(
                 background, ori_question
             )
-            if len(prompt) > 5120:
-                prompt = prompt[:5120]
             logger.debug(f"type 1 prompt for question: {question_id}: {prompt}")
-            answer = self.model(prompt)
+            answer = yield ChatRequest(prompt=prompt)
         return answer
+
+    def pack_background(
+        self, ori_question, company, abbr, years, year_headers, year_ranked_rows
+    ) -> str:
+        """
+        在token预算内组装背景资料, 各年份轮流放入排名靠前的行, 超出预算时先丢弃排名靠后的行
+        """
+        fixed = type1_prompt(ori_question, company, abbr, years).format(
+            "".join([header + "\n" for header in year_headers]), ori_question
+        )
+        # (rank, year_idx, row)
+        candidates = sorted(
+            [
+                (rank, year_idx, row)
+                for year_idx, rows in enumerate(year_ranked_rows)
+                for rank, row in enumerate(rows)
+            ],
+            key=lambda t: (t[0], t[1]),
+        )
+        # 每行的文本与table_to_text中的一致, 同一年份中重复的行只输出一次, 不重复计数
+        evidence = []
+        seen = set()
+        for _, year_idx, row in candidates:
+            text = AnswerGeneratorUtil.table_to_text([row], with_year=False)
+            evidence.append("" if (year_idx, text) in seen else text)
+            seen.add((year_idx, text))
+
+        def build_background(packed) -> str:
+            kept = set(
+                [
+                    (year_idx, rank)
+                    for (rank, year_idx, _), text in zip(candidates, packed)
+                    if text != ""
+                ]
+            )
+            background = ""
+            for year_idx, rows in enumerate(year_ranked_rows):
+                background += year_headers[year_idx]
+                background += AnswerGeneratorUtil.table_to_text(
+                    [row for rank, row in enumerate(rows) if (year_idx, rank) in kept],
+                    with_year=False,
+                )
+                background += "\n"
+            return background
+
+        packed = self.packer.pack(
+            fixed,
+            evidence,
+            self.token_budget,
+            render=lambda packed: type1_prompt(
+                ori_question, company, abbr, years
+            ).format(build_background(packed), ori_question),
+        )
+        kept_count = len([text for text in packed if text != ""])
+        total_count = len([text for text in evidence if text != ""])
+        if kept_count < total_count:
+            logger.debug(f"背景资料超出token预算, 保留{kept_count}/{total_count}行")
+        return build_background(packed)
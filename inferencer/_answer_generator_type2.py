@@ -1,4 +1,4 @@
-from ._answer_generator import AnswerGenerator
+from ._answer_generator import AnswerGenerator, AnswerSteps, ChatRequest
 from dataloader import DataLoader
 from ._model import InferenceModel
 from ._answer_generator_util import AnswerGeneratorUtil
@@ -11,7 +11,9 @@ class AnswerGeneratorType2(AnswerGenerator):
     def __init__(self, dataloader: DataLoader, model: InferenceModel):
         super().__init__(dataloader, model)
 
-    def generate_answer(self, question_id, question, question_type) -> str:
+    def generate_answer_steps(
+        self, question_id, question, question_type
+    ) -> AnswerSteps:
         question_keywords = self.get_question_keywords(question_id)
 
         ori_question = AnswerGenerator.cleanup_question(question)
@@ -60,6 +62,7 @@ class AnswerGeneratorType2(AnswerGenerator):
             logger.error("无法解析出step questions, 答案置空")
             return ""
 
+        step_prompts = []
         for step_question, step_keyword, step_year in zip(
             step_questions, step_keywords, step_years
         ):
@@ -74,6 +77,7 @@ class AnswerGeneratorType2(AnswerGenerator):
                 pdf_table,
                 min_match_number=3,
                 top_k=5,
+                row_name_index=self.dataloader.load_row_name_index(),
             )
             if len(matched_table_rows) == 0:
                 logger.warning(
@@ -85,6 +89,7 @@ class AnswerGeneratorType2(AnswerGenerator):
                     pdf_table,
                     min_match_number=2,
                     top_k=None,
+                    row_name_index=self.dataloader.load_row_name_index(),
                 )
             if len(matched_table_rows) == 0:
                 logger.error("仍然无法匹配keyword {}".format(step_keyword))
@@ -94,6 +99,7 @@ class AnswerGeneratorType2(AnswerGenerator):
                     pdf_table,
                     min_match_number=0,
                     top_k=10,
+                    row_name_index=self.dataloader.load_row_name_index(),
                 )
 
             table_text = AnswerGeneratorUtil.table_to_text(
@@ -111,7 +117,11 @@ class AnswerGeneratorType2(AnswerGenerator):
                 step_question,
             )
             logger.debug(f"type 2 prompt for question {question_id}: {prompt}")
-            step_answer = self.model(prompt)
+            step_prompts.append(prompt)
+
+        # 各步骤问题相互独立, 一次性提交
+        step_outputs = yield [ChatRequest(prompt=prompt) for prompt in step_prompts]
+        for step_answer in step_outputs:
             variable_value = AnswerGeneratorUtil.get_variable_value_from_answer(
                 step_answer
             )
@@ -1,4 +1,4 @@
-from ._answer_generator import AnswerGenerator
+from ._answer_generator import AnswerGenerator, AnswerSteps, ChatRequest
 from dataloader import DataLoader
 from ._model import InferenceModel
 from ._answer_generator_util import AnswerGeneratorUtil
@@ -8,10 +8,15 @@ from ._prompt import type3_prompt
 
 
 class AnswerGeneratorType3(AnswerGenerator):
+    # prompt的token预算
+    token_budget = 3500
+
     def __init__(self, dataloader: DataLoader, model: InferenceModel):
         super().__init__(dataloader, model)
 
-    def generate_answer(self, question_id, question, question_type) -> str:
+    def generate_answer_steps(
+        self, question_id, question, question_type
+    ) -> AnswerSteps:
         question_keywords = self.get_question_keywords(question_id)
         ori_question = AnswerGenerator.cleanup_question(question)
         mactched_pdf_names = self.get_match_pdf_names(ori_question)
@@ -23,7 +28,7 @@ class AnswerGeneratorType3(AnswerGenerator):
         )
         answer = ""
         if len(years) == 0:
-            answer = self.model(ori_question)
+            answer = yield ChatRequest(prompt=ori_question)
             return answer
         if not is_year_valid:
             logger.error(
@@ -31,10 +36,12 @@ class AnswerGeneratorType3(AnswerGenerator):
             )
             return ""
 
-        anoy_question, _ = self.parse_question_keywords(ori_question, real_comp, years)
+        anoy_question, _ = yield from self.parse_question_keywords(
+            ori_question, real_comp, years
+        )
         logger.debug(f"问题关键词: {question_keywords}")
 
-        background = "***************{}{}年年报***************\n".format(
+        header = "***************{}{}年年报***************\n".format(
             real_comp, years[0]
         )
         matched_text = self.recall_annual_report_texts(
@@ -42,17 +49,25 @@ class AnswerGeneratorType3(AnswerGenerator):
             "".join(question_keywords),
             mactched_pdf_names[0],
         )
-        for block_idx, text_block in enumerate(matched_text):
-            background += "{}片段:{}{}\n".format("-" * 15, block_idx + 1, "-" * 15)
-            background += text_block
-            background += "\n"
-        prompt = type3_prompt(
-            background,
-            ori_question,
+        # 召回的片段按排名排列, 超出token预算时先丢弃排名靠后的片段
+        # 只会丢弃排名靠后的片段, 保留的片段编号不变, 可以带着分隔符一起计数
+        blocks = []
+        for text_block in matched_text:
+            if text_block == "":
+                continue
+            blocks.append(
+                "{}片段:{}{}\n".format("-" * 15, len(blocks) + 1, "-" * 15)
+                + text_block
+                + "\n"
+            )
+        packed_blocks = self.packer.pack(
+            type3_prompt(header, ori_question),
+            blocks,
+            self.token_budget,
+            render=lambda packed: type3_prompt(header + "".join(packed), ori_question),
         )
+        prompt = type3_prompt(header + "".join(packed_blocks), ori_question)
         logger.debug(f"type 3 prompt for question: {question_id}: {prompt}")
 
-        if len(prompt) > 5120:
-            prompt = prompt[:5120]
-        answer = self.model(prompt)
+        answer = yield ChatRequest(prompt=prompt)
         return answer
@@ -1,8 +1,8 @@
 from typing import *
 import re
 import pandas as pd
-from difflib import SequenceMatcher
 from loguru import logger
+from dataloader import RowNameIndex
 
 
 class AnswerGeneratorUtil:
@@ -60,10 +60,17 @@ class AnswerGeneratorUtil:
         invalid_tables=None,
         min_match_number=3,
         top_k=None,
+        row_name_index: RowNameIndex = None,
     ):
+        """
+        row_name_index: 缓存行名匹配结果的索引, 通常为DataLoader.load_row_name_index(); 为None时只在本次调用内使用
+        """
         valid_keywords = keywords
+        if row_name_index is None:
+            row_name_index = RowNameIndex()
 
-        matched_lines = []
+        candidate_rows = []
+        exact_match = None
         for table_row in tables:
             table_name, row_year, row_name, row_value = table_row
             row_name = row_name.replace('"', "")
@@ -78,21 +85,22 @@ class AnswerGeneratorUtil:
 
             # find exact match, only return this row
             if row_name == valid_keywords:
-                matched_lines = [(table_row, len(row_name))]
+                exact_match = table_row
                 break
+            candidate_rows.append((table_row, row_name))
 
-            tot_match_size = 0
-            matches = SequenceMatcher(
-                isjunk=None,
-                a=valid_keywords,
-                b=row_name,
-                autojunk=False,
-            )
-            for match in matches.get_matching_blocks():
-                inter_text = valid_keywords[match.a : match.a + match.size]
-                tot_match_size += match.size
-            if tot_match_size >= min_match_number or row_name in valid_keywords:
-                matched_lines.append([table_row, tot_match_size])
+        if exact_match is not None:
+            matched_lines = [(exact_match, len(valid_keywords))]
+        else:
+            # 匹配长度按行名缓存, 不再逐行计算SequenceMatcher
+            for _, row_name in candidate_rows:
+                row_name_index.add(row_name)
+            matched_sizes = row_name_index.matches(valid_keywords, min_match_number)
+            matched_lines = [
+                [table_row, matched_sizes[row_name]]
+                for table_row, row_name in candidate_rows
+                if row_name in matched_sizes
+            ]
 
         matched_lines = sorted(matched_lines, key=lambda x: x[1], reverse=True)
         matched_lines = [t[0] for t in matched_lines]
@@ -100,6 +108,17 @@ class AnswerGeneratorUtil:
             matched_lines = matched_lines[:top_k]
         return matched_lines
 
+    @staticmethod
+    def reciprocal_rank_fusion(rankings: List[List[Hashable]], k=60) -> List[Hashable]:
+        """
+        多路召回结果按排名倒数之和融合, 得分相同时保持先出现的顺序
+        """
+        scores = {}
+        for ranking in rankings:
+            for rank, item in enumerate(ranking):
+                scores[item] = scores.get(item, 0) + 1 / (k + rank + 1)
+        return sorted(scores.keys(), key=lambda x: scores[x], reverse=True)
+
     @staticmethod
     def table_to_dataframe(table_rows):
         df = pd.DataFrame(
@@ -428,3 +447,81 @@ class AnswerGeneratorUtil:
             return numbers[0]
         else:
             return None
+
+
+def test_recall_pdf_tables():
+    """
+    与逐行计算SequenceMatcher的结果一致, 并比较召回耗时
+    """
+    import random
+    import time
+    from dataloader._row_name_index import tot_match_size
+
+    row_name_index = RowNameIndex()
+
+    def recall_baseline(keywords, years, tables, min_match_number, top_k=None):
+        matched_lines = []
+        for table_row in tables:
+            _, row_year, row_name, _ = table_row
+            row_name = row_name.replace('"', "")
+            if row_year not in years:
+                continue
+            if row_name == keywords:
+                matched_lines = [(table_row, len(row_name))]
+                break
+            size = tot_match_size(keywords, row_name)
+            if size >= min_match_number or row_name in keywords:
+                matched_lines.append([table_row, size])
+        matched_lines = sorted(matched_lines, key=lambda x: x[1], reverse=True)
+        return [t[0] for t in matched_lines][:top_k]
+
+    random.seed(0)
+    names = [
+        "营业收入",
+        "营业成本",
+        "营业利润",
+        "利润总额",
+        "净利润",
+        "研发费用",
+        "研发人员",
+        "货币资金",
+        "负债合计",
+        "资产总计",
+        "流动资产合计",
+        "非流动负债合计",
+        "在职员工的数量合计",
+        "营业收入增长率",
+        "",
+    ]
+    tables = []
+    for company in range(50):
+        for year in ["2019", "2020", "2021"]:
+            for name in random.sample(names, 12):
+                tables.append(("cis_info", year, name, str(random.random())))
+    queries = [
+        (k, m)
+        for k in ["营业收入", "研发费用", "员工数量", "负债", "营业收入增长率", "天气"]
+        for m in [0, 2, 3]
+    ]
+
+    start = time.perf_counter()
+    expected = [
+        recall_baseline(k, ["2020"], tables, m) for k, m in queries for _ in range(20)
+    ]
+    baseline_cost = time.perf_counter() - start
+    start = time.perf_counter()
+    results = [
+        AnswerGeneratorUtil.recall_pdf_tables(
+            k, ["2020"], tables, min_match_number=m, row_name_index=row_name_index
+        )
+        for k, m in queries
+        for _ in range(20)
+    ]
+    indexed_cost = time.perf_counter() - start
+    assert results == expected
+    logger.info(
+        "{}行, {}次召回: 逐行匹配{:.1f}ms, 行名索引{:.1f}ms".format(
+            len(tables), len(expected), baseline_cost * 1000, indexed_cost * 1000
+        )
+    )
+    row_name_index.report()
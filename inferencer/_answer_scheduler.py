@@ -0,0 +1,202 @@
+from loguru import logger
+from typing import *
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+import traceback
+import time
+from ._model import InferenceModel
+from ._answer_generator import AnswerSteps, ChatRequest
+
+_START = object()
+
+
+class AnswerScheduler:
+    """
+    按波次调度多个问题的答案生成:
+    - 每个问题的生成器在需要模型时yield ChatRequest
+    - 调度器收集所有在途问题的请求, 合并为一次批量模型调用(一个波次)
+    - 模型输出分发回各自的生成器继续执行, 直到生成器返回答案
+    当前波次在后台线程推理时, 主线程同时为新问题执行检索等python逻辑, 让GPU保持忙碌
+    """
+
+    def __init__(self, model: InferenceModel, max_in_flight: int = 256):
+        self.model = model
+        self.max_in_flight = max_in_flight
+        self.wave_count = 0
+        self.request_count = 0
+
+    def run(
+        self,
+        steps_list: List[AnswerSteps],
+        on_done: Callable[[int, str], None] = None,
+        desc: str = "Answer Generation",
+    ) -> List[str]:
+        """
+        执行所有生成器, 返回与steps_list顺序一致的答案
+        on_done按输入顺序回调(idx, answer), 便于增量持久化
+        """
+        self._steps = steps_list
+        self._answers: Dict[int, str] = {}
+        # 每个问题得到答案的时刻(perf_counter)
+        self.finish_times: Dict[int, float] = {}
+        self._pending: Dict[int, Union[ChatRequest, List[ChatRequest]]] = {}
+        self._in_flight = 0
+        self._waiting = deque(range(len(steps_list)))
+        self._next_flush = 0
+        self._on_done = on_done
+        self._bar = tqdm(total=len(steps_list), desc=desc)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            running = None
+            while True:
+                if running is None and len(self._pending) > 0:
+                    wave = self._pending
+                    self._pending = {}
+                    running = (executor.submit(self._exec_wave, wave), wave)
+
+                # 上一波次推理期间, 为新问题执行检索并收集下一波次的请求
+                self._admit()
+
+                if running is not None:
+                    future, wave = running
+                    running = None
+                    try:
+                        outputs = future.result()
+                    except Exception:
+                        traceback.print_exc()
+                        logger.error(f"批量推理失败, {len(wave)}个问题答案置空")
+                        for idx in wave:
+                            self._finish(idx, "")
+                        continue
+                    for idx, output in outputs.items():
+                        self._resume(idx, output)
+                elif len(self._pending) == 0 and len(self._waiting) == 0:
+                    break
+
+        self._bar.close()
+        logger.info(
+            f"答案生成共{self.wave_count}个波次, {self.request_count}次模型调用"
+        )
+        return [self._answers.get(idx, "") for idx in range(len(steps_list))]
+
+    def _admit(self):
+        while len(self._waiting) > 0 and self._in_flight < self.max_in_flight:
+            idx = self._waiting.popleft()
+            self._in_flight += 1
+            self._resume(idx, _START)
+
+    def _resume(self, idx: int, value):
+        steps = self._steps[idx]
+        try:
+            request = next(steps) if value is _START else steps.send(value)
+            # 空的请求列表无需经过模型
+            while isinstance(request, list) and len(request) == 0:
+                request = steps.send([])
+        except StopIteration as e:
+            self._finish(idx, e.value)
+            return
+        except Exception:
+            traceback.print_exc()
+            self._finish(idx, "")
+            return
+        self._pending[idx] = request
+
+    def _finish(self, idx: int, answer: str):
+        self._answers[idx] = answer
+        self.finish_times[idx] = time.perf_counter()
+        self._in_flight -= 1
+        self._bar.update(1)
+        if self._on_done is None:
+            return
+        while self._next_flush in self._answers:
+            self._on_done(self._next_flush, self._answers[self._next_flush])
+            self._next_flush += 1
+
+    def _exec_wave(self, wave: Dict[int, Union[ChatRequest, List[ChatRequest]]]):
+        # 同一波次内按采样参数分组, 每组一次批量调用
+        groups: Dict[Tuple[int, str], List[Tuple[int, int, ChatRequest]]] = {}
+        for idx, request in wave.items():
+            requests = request if isinstance(request, list) else [request]
+            for pos, r in enumerate(requests):
+                groups.setdefault((r.max_tokens, r.lora_name), []).append((idx, pos, r))
+
+        results: Dict[int, Dict[int, str]] = {idx: {} for idx in wave}
+        for (max_tokens, lora_name), items in groups.items():
+            outputs = self.model.chat_batch(
+                [r.prompt for _, _, r in items],
+                max_tokens=max_tokens,
+                lora_name=lora_name,
+            )
+            for (idx, pos, _), output in zip(items, outputs):
+                results[idx][pos] = output
+            self.request_count += len(items)
+        self.wave_count += 1
+
+        return {
+            idx: (
+                [results[idx][pos] for pos in range(len(request))]
+                if isinstance(request, list)
+                else results[idx][0]
+            )
+            for idx, request in wave.items()
+        }
+
+
+def test_answer_scheduler():
+    from ._model import MockModel
+
+    class RecordingModel(MockModel):
+        def __init__(self, fail: bool = False):
+            super().__init__()
+            self.fail = fail
+            self.calls = []
+
+        def _chat_batch(
+            self, prompts, max_tokens=2048, temperature=0.01, top_p=0.8, lora_name=""
+        ):
+            self.calls.append((prompts, max_tokens, lora_name))
+            if self.fail:
+                raise RuntimeError("mock failure")
+            return [prompt.upper() for prompt in prompts]
+
+    def two_waves():
+        first = yield ChatRequest(prompt="a", max_tokens=8)
+        rest = yield [ChatRequest(prompt="b", lora_name="x"), ChatRequest(prompt="c")]
+        return "|".join([first] + rest)
+
+    def one_wave():
+        return (yield ChatRequest(prompt="d", max_tokens=8))
+
+    def no_model():
+        return "direct"
+        yield
+
+    # 第一波次a和d采样参数相同, 合并为一次调用; 第二波次b和c的lora不同, 分为两次调用
+    model = RecordingModel()
+    scheduler = AnswerScheduler(model)
+    done = []
+    answers = scheduler.run(
+        [two_waves(), one_wave(), no_model()],
+        on_done=lambda idx, answer: done.append((idx, answer)),
+    )
+    assert answers == ["A|B|C", "D", "direct"]
+    assert model.calls == [
+        (["a", "d"], 8, ""),
+        (["b"], 2048, "x"),
+        (["c"], 2048, ""),
+    ]
+    assert scheduler.wave_count == 2 and scheduler.request_count == 4
+    # no_model最先完成, 但on_done仍按输入顺序回调
+    assert scheduler.finish_times[2] < scheduler.finish_times[0]
+    assert done == [(0, "A|B|C"), (1, "D"), (2, "direct")]
+
+    # 批量推理失败时, 该波次内的问题答案置空, 其余问题不受影响
+    model = RecordingModel(fail=True)
+    done = []
+    answers = AnswerScheduler(model).run(
+        [one_wave(), no_model()],
+        on_done=lambda idx, answer: done.append((idx, answer)),
+    )
+    assert answers == ["", "direct"]
+    assert done == [(0, ""), (1, "direct")]
@@ -0,0 +1,109 @@
+from loguru import logger
+from typing import *
+from enum import Enum
+import re
+
+
+class ClsResult(Enum):
+    # 公司基本信息, type 1
+    COMPANY_BASIC_INFO = "A"
+    # 员工信息, type 1
+    EMPLOYEE_INFO = "B"
+    # 财务报表相关信息, type 1
+    FINANCIAL_REPORT = "C"
+    # 计算题, type 2
+    CALCULATION = "D"
+    # 统计题, type 2
+    STATISTICS = "E"
+    # 开放性问题
+    OPEN = "F"  # type 3
+    # 未知问题
+    UNKNOWN = "G"  # type 1
+
+    """
+    type 1: 基本信息处理
+    type 2: 统计计算
+    type 3: 总结推理
+    """
+
+    @staticmethod
+    def from_value(value: str):
+        for member in ClsResult:
+            v = value.strip().upper().encode("utf-8").decode("utf-8")
+            if member.value == v:
+                return member
+        logger.error(f"Unknown cls result value: '{v}', encode: {v}")
+        return ClsResult.UNKNOWN
+
+    @staticmethod
+    def is_member(value: str):
+        return value in [member.value for member in ClsResult]
+
+
+class ClsRuleEngine:
+    """
+    问题分类规则引擎
+    - 模型前规则: 能直接确定分类的问题不再经过分类模型
+    - 模型后规则: 依赖模型输出的修正
+    """
+
+    # 命中任一关键词即为开放性问题
+    OPEN_KEYWORDS = [
+        "状况",
+        "简要介绍",
+        "简要分析",
+        "概述",
+        "具体描述",
+        "审计意见",
+        "什么是",
+        "指什么",
+        "什么意思",
+        "定义",
+        "含义",
+        "为什么",
+    ]
+
+    def __init__(self):
+        # 所有关键词合并为一个正则, 一次扫描完成匹配
+        self.open_pattern = re.compile(
+            "|".join([re.escape(kw) for kw in ClsRuleEngine.OPEN_KEYWORDS])
+        )
+        self.total = 0
+        self.short_circuited = 0
+
+    def before_model(
+        self, question: str, related_companies: List[str]
+    ) -> Optional[ClsResult]:
+        """
+        返回None表示规则无法确定, 需要模型判断
+        命中开放性关键词时, 只有"模型判断为统计题且问题中有公司名"才会改判为UNKNOWN,
+        因此问题中没有公司名时可以直接判定为OPEN
+        """
+        self.total += 1
+        if len(related_companies) == 0 and self.open_pattern.search(question):
+            self.short_circuited += 1
+            return ClsResult.OPEN
+        return None
+
+    def after_model(
+        self, question: str, related_companies: List[str], model_answer: str
+    ) -> ClsResult:
+        if model_answer in ["E"] and len(related_companies) > 0:
+            return ClsResult.UNKNOWN
+
+        if self.open_pattern.search(question):
+            return ClsResult.OPEN
+
+        if model_answer in ["A", "B", "C", "D"] and len(related_companies) == 0:
+            return ClsResult.OPEN
+
+        return ClsResult.from_value(model_answer)
+
+    def report(self) -> Dict[str, int]:
+        ratio = self.short_circuited / self.total if self.total > 0 else 0
+        logger.info(
+            "分类规则直接判定{}/{}个问题({:.2%}), 其余交给分类模型".format(
+                self.short_circuited, self.total, ratio
+            )
+        )
+        return {"total": self.total, "short_circuited": self.short_circuited}
@@ -0,0 +1,299 @@
+from loguru import logger
+from typing import *
+import json
+import os
+import re
+import time
+from dataloader._field_alias import alias
+
+# 问题中的常见说法 -> company_table字段名
+FIELD_SYNONYMS = {
+    "总负债": "负债合计",
+    "负债总额": "负债合计",
+    "负债总金额": "负债合计",
+    "总资产": "资产总计",
+    "资产总额": "资产总计",
+    "资产总金额": "资产总计",
+    "货币总额": "货币资金",
+    "职工总人数": "在职员工的数量合计",
+    "流动负债": "流动负债合计",
+    "非流动负债": "非流动负债合计",
+    "流动资产": "流动资产合计",
+    "非流动资产": "非流动资产合计",
+}
+
+
+def field_synonyms(columns: Iterable[str]) -> Dict[str, str]:
+    """
+    FIELD_SYNONYMS中指向columns的部分: {同义词: 字段名}
+    建表时财报字段名已按alias换成别名(如负债合计 -> 总负债), 同义词随之指向别名
+    """
+    column_set = set(columns)
+    synonyms = {}
+    for k, v in FIELD_SYNONYMS.items():
+        if v not in column_set:
+            v = alias.get(v)
+        if v in column_set and k != v:
+            synonyms[k] = v
+    return synonyms
+
+
+class ColumnIndex:
+    """
+    company_table字段名的相似度索引, 用于修正sql中不存在的字段
+    - 别名(_field_alias.alias及常见说法)直接映射, 置信度为1
+    - 其余按字符unigram+bigram的Dice系数打分, 通过倒排表只对有公共字符的字段打分
+    - 解析结果按错误字段名缓存
+    """
+
+    def __init__(
+        self, columns: List[str], min_score: float = 0.6, min_margin: float = 0.1
+    ):
+        """
+        min_score: 最高分低于该值时认为不可信
+        min_margin: 最高分与第二名的差距低于该值时认为有歧义
+        """
+        self.columns = list(columns)
+        # 去掉前缀后不同表可能有同名字段, 打分时只保留一个
+        self.unique_columns = list(dict.fromkeys(columns))
+        self.min_score = min_score
+        self.min_margin = min_margin
+        column_set = set(self.unique_columns)
+        self.synonyms = {
+            v: k for k, v in alias.items() if k in column_set and v not in column_set
+        }
+        self.synonyms.update(field_synonyms(column_set))
+
+        self.column_grams = [ColumnIndex.grams(c) for c in self.unique_columns]
+        self.column_bigram_counts = [
+            len([g for g in grams if len(g) == 2]) for grams in self.column_grams
+        ]
+        # {gram: [字段序号]}
+        self.inverted: Dict[str, List[int]] = {}
+        for i, grams in enumerate(self.column_grams):
+            for g in grams:
+                self.inverted.setdefault(g, []).append(i)
+        # {错误字段: (字段, 置信度)}
+        self.memo: Dict[str, Tuple[Optional[str], float]] = {}
+
+    @staticmethod
+    def grams(text: str) -> Set[str]:
+        return set(text) | set([text[i : i + 2] for i in range(len(text) - 1)])
+
+    def candidates(self, word: str, top_k: int = 5) -> List[Tuple[str, float]]:
+        word_grams = ColumnIndex.grams(word)
+        overlaps: Dict[int, int] = {}
+        for g in word_grams:
+            for i in self.inverted.get(g, []):
+                overlaps[i] = overlaps.get(i, 0) + 1
+        scored = [
+            (
+                self.unique_columns[i],
+                2 * n / (len(word_grams) + len(self.column_grams[i])),
+            )
+            for i, n in overlaps.items()
+        ]
+        scored.sort(key=lambda x: x[1], reverse=True)
+        return scored[:top_k]
+
+    def covered(self, text: str, min_coverage: float) -> List[Tuple[str, float]]:
+        """
+        return: 大部分bigram出现在text中的字段及其覆盖率, 按覆盖率降序
+        """
+        hits: Dict[int, int] = {}
+        for g in ColumnIndex.grams(text):
+            if len(g) < 2:
+                continue
+            for i in self.inverted.get(g, []):
+                hits[i] = hits.get(i, 0) + 1
+        results = [
+            (self.unique_columns[i], n / self.column_bigram_counts[i])
+            for i, n in hits.items()
+        ]
+        results = [r for r in results if r[1] >= min_coverage]
+        results.sort(key=lambda x: x[1], reverse=True)
+        return results
+
+    def resolve(self, word: str) -> Tuple[Optional[str], float]:
+        """
+        return: (字段名, 置信度), 置信度不足时字段名为None
+        """
+        if word in self.memo:
+            return self.memo[word]
+        if word in self.synonyms:
+            result = (self.synonyms[word], 1.0)
+        else:
+            scored = self.candidates(word, top_k=2)
+            if len(scored) == 0:
+                result = (None, 0.0)
+            else:
+                top, score = scored[0]
+                second = scored[1][1] if len(scored) > 1 else 0.0
+                if score < self.min_score or score - second < self.min_margin:
+                    result = (None, score)
+                else:
+                    result = (top, score)
+        self.memo[word] = result
+        return result
+
+
+class SchemaPruner:
+    """
+    为nl2sql prompt挑选与问题相关的字段
+    - 问题覆盖了字段大部分bigram的字段
+    - 问题中出现的表字段名(如"在职员工的数量合计")对应的prompt字段名(如"职工总人数")
+    - 关键词阶段输出的关键词在字段索引中的近似匹配
+    公司全称, 年份及最常用的过滤字段注册地址总是保留, 结果保持原字段顺序
+    """
+
+    ALWAYS_FIELDS = ["公司全称", "年份", "注册地址"]
+
+    def __init__(
+        self,
+        fields: List[str],
+        min_coverage: float = 0.5,
+        max_fields: int = 16,
+        keyword_top_k: int = 3,
+        keyword_min_score: float = 0.3,
+    ):
+        self.fields = fields
+        self.index = ColumnIndex(fields)
+        field_set = set(fields)
+        self.aliases = {k: v for k, v in alias.items() if v in field_set}
+        self.min_coverage = min_coverage
+        self.max_fields = max_fields
+        self.keyword_top_k = keyword_top_k
+        self.keyword_min_score = keyword_min_score
+
+    def prune(self, question: str, keywords: List[str] = None) -> List[str]:
+        selected = set(SchemaPruner.ALWAYS_FIELDS)
+        for field, _ in self.index.covered(question, self.min_coverage)[
+            : self.max_fields
+        ]:
+            selected.add(field)
+        for name, field in self.aliases.items():
+            if name in question:
+                selected.add(field)
+        for keyword in keywords or []:
+            if keyword in self.index.synonyms:
+                selected.add(self.index.synonyms[keyword])
+            for field, score in self.index.candidates(keyword, self.keyword_top_k):
+                if score >= self.keyword_min_score:
+                    selected.add(field)
+        return [f for f in self.fields if f in selected]
+
+
+def test_column_index():
+    from ._prompt import nl2sql_fields
+
+    fields = nl2sql_fields()
+
+    index = ColumnIndex(fields)
+    for word in ["负债总额", "总资产", "营业总收入额", "研发投入金额", "天气"]:
+        print(word, index.resolve(word), index.candidates(word, top_k=3))
+    assert index.resolve("负债总额")[0] == "总负债"
+    assert index.resolve("天气")[0] is None
+
+    words = [f + "额" for f in fields]
+    start = time.perf_counter()
+    for w in words:
+        index.resolve(w)
+    miss_cost = (time.perf_counter() - start) / len(words)
+    start = time.perf_counter()
+    for w in words:
+        index.resolve(w)
+    hit_cost = (time.perf_counter() - start) / len(words)
+    logger.info(
+        "{}个字段, 首次解析{:.1f}us/次, 缓存命中{:.2f}us/次".format(
+            len(fields), miss_cost * 1e6, hit_cost * 1e6
+        )
+    )
+
+
+def test_schema_pruning():
+    """
+    在nl2sql测试集上统计裁剪后prompt的token数, 以及标注sql用到的字段被保留的比例
+    - 与do_sql_generation一样传入关键词阶段的输出, 这里用关键词数据集的标注代替模型输出
+    - 有company_table时用EXPLAIN检查标注sql, 只统计能在库中执行的标注
+    """
+    from dataloader import DataLoader
+    from ._prompt import nl2sql_fields, nl2sql_prompt, parse_keywords
+    from ._model import VllmModel, MockModel
+
+    dataset_dir = os.path.join(os.path.dirname(__file__), "..", "resources", "dataset")
+    with open(
+        os.path.join(dataset_dir, "nl2sql", "test.jsonl"), "r", encoding="utf-8"
+    ) as f:
+        rows = [json.loads(line) for line in f]
+    keyword_labels = {}
+    for name in ["train.jsonl", "test.jsonl"]:
+        with open(
+            os.path.join(dataset_dir, "keyword", name), "r", encoding="utf-8"
+        ) as f:
+            for line in f:
+                row = json.loads(line)
+                keyword_labels[row["question"]] = parse_keywords(row["label"])
+
+    # 有本地模型时按模型分词器计数, 否则按字符数近似
+    model = VllmModel()
+    if os.path.exists(model.model_full_path):
+        count_tokens = model.count_tokens
+    else:
+        count_tokens = MockModel().count_tokens
+
+    ctx_dir = os.path.join(
+        os.path.dirname(__file__), "..", "resources", "processed_data"
+    )
+    loader = None
+    if os.path.exists(os.path.join(ctx_dir, "CompanyTable.csv")):
+        loader = DataLoader(ctx_dir=ctx_dir, inference_dir=ctx_dir)
+
+    fields = nl2sql_fields()
+    field_set = set(fields)
+    pruner = SchemaPruner(fields)
+    full_tokens, pruned_tokens, pruned_fields, with_keywords = 0, 0, 0, 0
+    covered, valid, valid_covered = 0, 0, 0
+    for row in rows:
+        question = row["question"]
+        keywords = keyword_labels.get(question.strip("“”"))
+        with_keywords += int(keywords is not None)
+        kept = pruner.prune(question, keywords)
+        full_tokens += count_tokens(nl2sql_prompt(question))
+        pruned_tokens += count_tokens(nl2sql_prompt(question, fields=kept))
+        pruned_fields += len(kept)
+
+        # 标注中的字段名可能是别名(如负债合计), 换算为prompt及company_table中的字段名
+        sql = re.sub(
+            r"[\u4e00-\u9fa5、]+",
+            lambda m: alias.get(m.group(0), m.group(0)),
+            row["label"].strip("`"),
+        )
+        names = re.findall(
+            r"[\u4e00-\u9fa5、]+", re.sub(r"'[^']*'|\"[^\"]*\"", "", sql)
+        )
+        used = set([name for name in names if name in field_set])
+        is_covered = used.issubset(kept)
+        covered += int(is_covered)
+        if loader is not None and loader.explain_sql(sql) is None:
+            valid += 1
+            valid_covered += int(is_covered)
+
+    logger.info(
+        "{}题(其中{}题有关键词), 字段数{} -> 平均{:.1f}, prompt平均{:.0f} -> {:.0f}token(-{:.1%}), 标注sql字段全部保留{}题({:.1%})".format(
+            len(rows),
+            with_keywords,
+            len(fields),
+            pruned_fields / len(rows),
+            full_tokens / len(rows),
+            pruned_tokens / len(rows),
+            1 - pruned_tokens / full_tokens,
+            covered,
+            covered / len(rows),
+        )
+    )
+    assert covered / len(rows) >= 0.95
+    if loader is not None:
+        logger.info(
+            "可执行的标注sql{}题, 其中字段全部保留{}题".format(valid, valid_covered)
+        )
+        assert valid > 0 and valid_covered / valid >= 0.95
@@ -0,0 +1,101 @@
+from typing import *
+from functools import lru_cache
+
+
+class ContextPacker:
+    """
+    按token预算组装prompt的背景资料:
+    - 指令和问题(固定部分)始终保留
+    - 证据按排名从高到低放入, 放不下的低排名证据被丢弃
+    - 片段的token数带缓存, 同一片段在不同问题间复用时不重复分词
+    - 证据应是原样拼入prompt的字符串(含分隔符和换行), 并可用最终prompt的实际token数校验
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], cache_size: int = 65536):
+        self._count_tokens = lru_cache(maxsize=cache_size)(count_tokens)
+
+    def count(self, text: str) -> int:
+        return self._count_tokens(text)
+
+    def pack(
+        self,
+        fixed: str,
+        evidence: List[str],
+        budget: int,
+        render: Callable[[List[str]], str] = None,
+    ) -> List[str]:
+        """
+        fixed: 必须保留的部分(指令, 问题, 标题等)
+        evidence: 按排名从高到低排列的证据
+        render: 由pack的结果生成最终prompt, 按其实际token数校验, 仍超出预算时继续丢弃排名最低的证据
+        return: 与evidence一一对应, 被丢弃的证据为空字符串, 放不下的首条证据会被截断
+        """
+        remaining = budget - self.count(fixed)
+        packed = [""] * len(evidence)
+        for idx, text in enumerate(evidence):
+            if text == "":
+                continue
+            tokens = self.count(text)
+            if tokens <= remaining:
+                packed[idx] = text
+                remaining -= tokens
+                continue
+            if all([t == "" for t in packed]) and remaining > 0:
+                # 连排名最高的证据都放不下时, 截断它而不是返回空背景
+                packed[idx] = self._truncate(text, remaining)
+            # 之后的证据排名更低, 全部丢弃
+            break
+
+        if render is not None:
+            # 拼接处的分词可能与分别计数不同, 以最终prompt为准
+            # 最终prompt只分词一次, 之后丢弃证据时减去该证据的token数
+            over = self._count_tokens.__wrapped__(render(packed)) - budget
+            kept = [idx for idx, text in enumerate(packed) if text != ""]
+            while over > 0 and len(kept) > 1:
+                idx = kept.pop()
+                over -= self.count(packed[idx])
+                packed[idx] = ""
+            if over > 0 and len(kept) == 1:
+                idx = kept[0]
+                text = packed[idx]
+                tokens = (
+                    self.count(text)
+                    if text == evidence[idx]
+                    else self._count_tokens.__wrapped__(text)
+                )
+                packed[idx] = self._truncate(text, max(tokens - over, 0))
+        return packed
+
+    def _truncate(self, text: str, budget: int) -> str:
+        # 二分查找不超过预算的最长前缀
+        lo, hi = 0, len(text)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            # 截断产生的前缀不会复用, 不进入缓存
+            if self._count_tokens.__wrapped__(text[:mid]) <= budget:
+                lo = mid
+            else:
+                hi = mid - 1
+        return text[:lo]
+
+
+def test_context_packer():
+    calls = []
+
+    def count_tokens(text):
+        calls.append(text)
+        return len(text)
+
+    packer = ContextPacker(count_tokens)
+    evidence = ["a" * 30, "b" * 30, "c" * 30, "d" * 30]
+    # 每条证据拼入prompt时多出10个字符的分隔符, 分别计数时没有算上
+    render = lambda packed: "q" + "".join(["-" * 10 + t for t in packed if t != ""])
+    packed = packer.pack("q", evidence, 100, render=render)
+    assert packed == ["a" * 30, "b" * 30, "", ""]
+    assert len(render(packed)) <= 100
+    # 完整prompt只计数一次
+    assert len([c for c in calls if c.startswith("q-")]) == 1
+
+    # 只剩一条证据仍超出预算时截断它
+    packed = packer.pack("q", ["x" * 95], 100, render=render)
+    assert packed == ["x" * 89] and len(render(packed)) == 100
@@ -0,0 +1,167 @@
+from loguru import logger
+from typing import *
+from abc import ABC, abstractmethod
+from difflib import SequenceMatcher
+import random
+import time
+import os
+
+
+class BlockScorer(ABC):
+    """
+    检索出的文本块与问题的相关性打分, 分数越高越相关
+    """
+
+    @abstractmethod
+    def score(self, query: str, blocks: List[str]) -> List[int]:
+        pass
+
+
+class SequenceMatcherScorer(BlockScorer):
+    """
+    最长公共子串长度, difflib实现, 每个文本块都要为其建立字符索引
+    """
+
+    def score(self, query: str, blocks: List[str]) -> List[int]:
+        return [
+            SequenceMatcher(None, query, block, autojunk=False)
+            .find_longest_match()
+            .size
+            for block in blocks
+        ]
+
+
+class SuffixAutomaton:
+    """
+    字符串的后缀自动机, 用于线性时间求另一个字符串与它的最长公共子串
+    """
+
+    def __init__(self, text: str):
+        # 每个状态的转移, 后缀链接, 以及到达该状态的最长子串长度
+        self.next: List[Dict[str, int]] = [{}]
+        self.link: List[int] = [-1]
+        self.length: List[int] = [0]
+        self.alphabet = set(text)
+        last = 0
+        for c in text:
+            cur = self._new_state(self.length[last] + 1)
+            p = last
+            while p != -1 and c not in self.next[p]:
+                self.next[p][c] = cur
+                p = self.link[p]
+            if p == -1:
+                self.link[cur] = 0
+            else:
+                q = self.next[p][c]
+                if self.length[p] + 1 == self.length[q]:
+                    self.link[cur] = q
+                else:
+                    clone = self._new_state(self.length[p] + 1)
+                    self.next[clone] = dict(self.next[q])
+                    self.link[clone] = self.link[q]
+                    while p != -1 and self.next[p].get(c) == q:
+                        self.next[p][c] = clone
+                        p = self.link[p]
+                    self.link[q] = clone
+                    self.link[cur] = clone
+            last = cur
+
+    def _new_state(self, length: int) -> int:
+        self.next.append({})
+        self.link.append(-1)
+        self.length.append(length)
+        return len(self.length) - 1
+
+    def longest_common_substring(self, other: str) -> int:
+        best = 0
+        state = 0
+        matched = 0
+        next_, link, length, alphabet = self.next, self.link, self.length, self.alphabet
+        for c in other:
+            # 大部分字符不在问题中, 直接回到初始状态
+            if c not in alphabet:
+                state = 0
+                matched = 0
+                continue
+            while state != 0 and c not in next_[state]:
+                state = link[state]
+                matched = length[state]
+            if c in next_[state]:
+                state = next_[state][c]
+                matched += 1
+                if matched > best:
+                    best = matched
+            else:
+                matched = 0
+        return best
+
+
+class SuffixAutomatonScorer(BlockScorer):
+    """
+    最长公共子串长度, 对问题只建一次后缀自动机, 每个文本块线性扫描一遍
+    结果与SequenceMatcherScorer完全一致
+    """
+
+    def score(self, query: str, blocks: List[str]) -> List[int]:
+        automaton = SuffixAutomaton(query)
+        return [automaton.longest_common_substring(block) for block in blocks]
+
+
+def test_lcs_scorers_equivalent():
+    random.seed(0)
+    reference = SequenceMatcherScorer()
+    scorer = SuffixAutomatonScorer()
+    for _ in range(500):
+        alphabet = "营业收入利润的公司研发员工" + "ab"
+        query = "".join(random.choices(alphabet, k=random.randint(0, 30)))
+        blocks = [
+            "".join(random.choices(alphabet, k=random.randint(0, 300)))
+            for _ in range(5)
+        ]
+        assert scorer.score(query, blocks) == reference.score(query, blocks)
+
+
+ctx_dir = os.path.join(os.path.dirname(__file__), "..", "resources", "processed_data")
+
+
+def test_lcs_scorer_benchmark():
+    """
+    用真实年报文本按召回时的方式切成30行左右的文本块, 比较两种实现的耗时
+    """
+    from dataloader import DataLoader
+    from ._answer_generator_util import AnswerGeneratorUtil
+
+    loader = DataLoader(ctx_dir=ctx_dir, inference_dir=ctx_dir)
+    keys = sorted(
+        [f for f in os.listdir(os.path.join(ctx_dir, "alltxts")) if f.endswith(".txt")]
+    )[:5]
+    random.seed(0)
+    blocks = []
+    for key in keys:
+        text_lines = loader.load_pdf_text_lines(key.replace(".txt", ""))
+        top_indexes = random.sample(range(len(text_lines)), 6)
+        for line_indexes in AnswerGeneratorUtil.merge_idx(
+            top_indexes, len(text_lines), 0, 30
+        ):
+            blocks.append("\n".join([text_lines[idx] for idx in line_indexes]))
+    queries = [
+        "2019年的研发投入金额是多少元",
+        "请简要介绍报告期内公司主要销售客户的客户集中度情况",
+        "公司的社会责任工作情况",
+    ]
+
+    results = {}
+    for scorer in [SequenceMatcherScorer(), SuffixAutomatonScorer()]:
+        start = time.perf_counter()
+        results[type(scorer).__name__] = [scorer.score(q, blocks) for q in queries]
+        elapsed = time.perf_counter() - start
+        logger.info(
+            "{}: {}个文本块(平均{:.0f}字符) x {}个问题, 耗时{:.1f}ms".format(
+                type(scorer).__name__,
+                len(blocks),
+                sum([len(b) for b in blocks]) / len(blocks),
+                len(queries),
+                elapsed * 1000,
+            )
+        )
+    assert results["SequenceMatcherScorer"] == results["SuffixAutomatonScorer"]
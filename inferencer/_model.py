@@ -4,7 +4,11 @@ from vllm import LLM, SamplingParams
 from vllm.lora.request import LoRARequest
 import os
 import torch
+import threading
 from loguru import logger
+from typing import List, Dict, Callable
+from ._response_cache import ResponseCache
+from ._prefix_stats import PrefixCacheStats
 
 
 class InferenceModel(ABC):
@@ -12,6 +16,7 @@ class InferenceModel(ABC):
         self,
         model_name: str = "Qwen/Qwen2.5-3B-Instruct",
         cache_dir: str = "",
+        response_cache: ResponseCache = None,
     ):
         self.model_name = model_name
         self.cache_dir = (
@@ -21,6 +26,10 @@ class InferenceModel(ABC):
         )
         self.model_full_path = os.path.join(self.cache_dir, self.model_name)
         self.loaded = False
+        self.response_cache = response_cache
+        # 当前所处的推理阶段, 用于分阶段统计
+        self.stage = "default"
+        self.prefix_stats: PrefixCacheStats = None
 
     @abstractmethod
     def _chat(
@@ -41,10 +50,119 @@ class InferenceModel(ABC):
         top_p=0.8,
         lora_name="",
     ) -> str:
+        return self._cached_chat(
+            [question],
+            max_tokens,
+            temperature,
+            top_p,
+            lora_name,
+            lambda prompts: [
+                self._chat(prompts[0], max_tokens, temperature, top_p, lora_name)
+            ],
+        )[0]
+
+    def _chat_batch(
+        self,
+        prompts: List[str],
+        max_tokens: int = 2048,
+        temperature=0.01,
+        top_p=0.8,
+        lora_name="",
+    ) -> List[str]:
+        """
+        默认逐条调用_chat, 支持批量推理的模型应覆盖此方法
+        """
+        return [
+            self._chat(prompt, max_tokens, temperature, top_p, lora_name)
+            for prompt in prompts
+        ]
+
+    def chat_batch(
+        self,
+        prompts: List[str],
+        max_tokens: int = 2048,
+        temperature=0.01,
+        top_p=0.8,
+        lora_name="",
+    ) -> List[str]:
+        """
+        一次提交多条prompt, 返回结果与prompts顺序一致
+        """
+        if len(prompts) == 0:
+            return []
+        return self._cached_chat(
+            prompts,
+            max_tokens,
+            temperature,
+            top_p,
+            lora_name,
+            lambda missed: self._chat_batch(
+                missed, max_tokens, temperature, top_p, lora_name
+            ),
+        )
+
+    def _cached_chat(
+        self,
+        prompts: List[str],
+        max_tokens: int,
+        temperature,
+        top_p,
+        lora_name: str,
+        generate: Callable[[List[str]], List[str]],
+    ) -> List[str]:
+        """
+        先查缓存, 只把未命中的prompt交给模型; 全部命中时不会加载模型
+        """
+        # 断点续跑时整个阶段可能都已完成, 此时无需加载模型
+        if len(prompts) == 0:
+            return []
+        if self.response_cache is None:
+            self._ensure_loaded()
+            return generate(prompts)
+
+        sampling_params = self.sampling_params(max_tokens, temperature, top_p)
+        keys = [
+            ResponseCache.make_key(
+                self.model_name,
+                lora_name,
+                self.lora_path(lora_name),
+                sampling_params,
+                prompt,
+            )
+            for prompt in prompts
+        ]
+        hits = self.response_cache.get_many(keys)
+        outputs = [hits.get(key) for key in keys]
+        missed_idx = [i for i, key in enumerate(keys) if key not in hits]
+        if len(missed_idx) == 0:
+            return outputs
+
+        self._ensure_loaded()
+        generated = generate([prompts[i] for i in missed_idx])
+        for i, output in zip(missed_idx, generated):
+            outputs[i] = output
+        self.response_cache.put_many({keys[i]: outputs[i] for i in missed_idx})
+        return outputs
+
+    def _ensure_loaded(self):
         if not self.loaded:
             self._load()
             self.loaded = True
-        return self._chat(question, max_tokens, temperature, top_p, lora_name)
+
+    def sampling_params(self, max_tokens: int, temperature, top_p) -> dict:
+        """
+        影响输出的采样参数, 作为缓存key的一部分
+        """
+        return {"max_tokens": max_tokens, "temperature": temperature, "top_p": top_p}
+
+    def lora_path(self, lora_name: str) -> str:
+        return ""
+
+    def count_tokens(self, text: str) -> int:
+        """
+        没有分词器的模型按字符数近似
+        """
+        return len(text)
 
     @abstractmethod
     def _load(self):
@@ -53,6 +171,7 @@ class InferenceModel(ABC):
     def unload(self):
         if self.loaded:
             self._unload()
+            self.loaded = False
 
     @abstractmethod
     def _unload(self):
@@ -73,52 +192,140 @@ class MockModel(InferenceModel):
         pass
 
     def _chat(
-        self, question: str, max_tokens: int = 1024, temperature=1.0, top_p=1.0
+        self,
+        question: str,
+        max_tokens: int = 1024,
+        temperature=1.0,
+        top_p=1.0,
+        lora_name="",
     ) -> str:
         return "Mock answer"
 
 
+class VllmEngine:
+    """
+    一个vllm LLM实例, 由多个VllmModel共享
+    """
+
+    def __init__(self, model_full_path: str):
+        self.model_full_path = model_full_path
+        # 始终开启lora, 不带lora_request的请求直接使用基座权重
+        self.llm = LLM(
+            model=model_full_path,
+            gpu_memory_utilization=0.9,
+            max_model_len=16384,
+            enable_lora=True,
+            max_loras=4,
+            # prompt的静态前缀在请求间复用KV cache, 只需prefill一次
+            enable_prefix_caching=True,
+        )
+        self.ref_count = 0
+        # lora路径 -> lora_int_id, 同一个engine内id必须唯一
+        self.lora_ids: Dict[str, int] = {}
+
+    def lora_id(self, lora_path: str) -> int:
+        if lora_path not in self.lora_ids:
+            self.lora_ids[lora_path] = len(self.lora_ids) + 1
+        return self.lora_ids[lora_path]
+
+
+class VllmEngineRegistry:
+    """
+    按model_full_path复用vllm engine, 同一基座只加载一份权重
+    """
+
+    _engines: Dict[str, VllmEngine] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def acquire(cls, model_full_path: str) -> VllmEngine:
+        with cls._lock:
+            engine = cls._engines.get(model_full_path)
+            if engine is None:
+                logger.info(f"加载vllm engine: {model_full_path}")
+                engine = VllmEngine(model_full_path)
+                cls._engines[model_full_path] = engine
+            engine.ref_count += 1
+            return engine
+
+    @classmethod
+    def release(cls, model_full_path: str):
+        with cls._lock:
+            engine = cls._engines.get(model_full_path)
+            if engine is None:
+                return
+            engine.ref_count -= 1
+            if engine.ref_count > 0:
+                return
+            logger.info(f"卸载vllm engine: {model_full_path}")
+            del cls._engines[model_full_path]
+            del engine.llm
+            torch.cuda.empty_cache()
+
+
 class VllmModel(InferenceModel):
     def __init__(
         self,
         model_name: str = "Qwen/Qwen2.5-3B-Instruct",
         cache_dir: str = "",
         lora_adapters: dict = {},
+        response_cache: ResponseCache = None,
+        prefix_stats: bool = False,
     ):
-        super().__init__(model_name, cache_dir)
+        """
+        prefix_stats: 统计各阶段prompt的共享前缀, 每条prompt需额外分词一次, 用于离线分析
+        """
+        super().__init__(model_name, cache_dir, response_cache)
         self.lora_adapters = lora_adapters
         self.lora_request_map = {}
         self.llm: LLM = None
+        self.tokenizer = None
+        if prefix_stats:
+            self.prefix_stats = PrefixCacheStats(encode=self.encode)
 
     def _load(self):
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.model_full_path, trust_remote_code=True
-        )
-        id = 1
-        if len(self.lora_adapters) > 0:
-            for lora_desc, lora_path in self.lora_adapters.items():
-                self.lora_request_map[lora_desc] = {"id": id, "path": lora_path}
-                id += 1
-
-            self.llm = LLM(
-                model=self.model_full_path,
-                gpu_memory_utilization=0.9,
-                max_model_len=16384,
-                enable_lora=True,
+        engine = VllmEngineRegistry.acquire(self.model_full_path)
+        self.llm = engine.llm
+        for lora_desc, lora_path in self.lora_adapters.items():
+            self.lora_request_map[lora_desc] = {
+                "id": engine.lora_id(lora_path),
+                "path": lora_path,
+            }
+        if len(self.lora_request_map) > 0:
+            logger.info(self.lora_request_map)
+
+    def _unload(self):
+        self.llm = None
+        VllmEngineRegistry.release(self.model_full_path)
+
+    def sampling_params(self, max_tokens: int, temperature, top_p) -> dict:
+        return {
+            "stop": ["<|im_end|>", "``` "],
+            "top_k": 20,
+            "top_p": top_p,
+            "repetition_penalty": 1.05,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
+
+    def lora_path(self, lora_name: str) -> str:
+        return self.lora_adapters.get(lora_name, "")
+
+    def get_tokenizer(self):
+        """
+        分词器独立于engine加载, 不占用GPU, 在模型加载前即可用于计算token数
+        """
+        if self.tokenizer is None:
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                self.model_full_path, trust_remote_code=True
             )
-            print(self.lora_request_map)
-            return
+        return self.tokenizer
 
-        self.llm = LLM(
-            model=self.model_full_path,
-            gpu_memory_utilization=0.9,
-            max_model_len=16384,
-        )
+    def encode(self, text: str) -> List[int]:
+        return self.get_tokenizer().encode(text, add_special_tokens=False)
 
-    def _unload(self):
-        del self.llm
-        del self.tokenizer
-        torch.cuda.empty_cache()
+    def count_tokens(self, text: str) -> int:
+        return len(self.encode(text))
 
     def _chat(
         self,
@@ -128,45 +335,46 @@ class VllmModel(InferenceModel):
         top_p=0.8,
         lora_name="",
     ) -> str:
-        messages = [{"role": "user", "content": prompt}]
-        sp = (
-            SamplingParams(
-                stop=["<|im_end|>", "``` "],
-                top_k=20,
-                top_p=top_p,
-                repetition_penalty=1.05,
-                max_tokens=max_tokens,
-                temperature=temperature,
-            ),
-        )
+        return self._chat_batch([prompt], max_tokens, temperature, top_p, lora_name)[0]
+
+    def _chat_batch(
+        self,
+        prompts: List[str],
+        max_tokens: int = 2048,
+        temperature=0.01,
+        top_p=0.8,
+        lora_name="",
+    ) -> List[str]:
+        if self.prefix_stats is not None:
+            self.prefix_stats.record(self.stage, prompts)
+        sp = SamplingParams(**self.sampling_params(max_tokens, temperature, top_p))
         lora_config: dict = None
         if lora_name != "":
             lora_config = self.lora_request_map.get(lora_name, None)
 
-        if lora_config is None:
-            # do normal generation
-            outputs = self.llm.chat(
-                use_tqdm=False,
-                messages=messages,
-                sampling_params=sp,
+        # 所有prompt一次提交, 由vllm的continuous batching统一调度
+        tokenizer = self.llm.get_tokenizer()
+        input_texts = [
+            tokenizer.apply_chat_template(
+                conversation=[{"role": "user", "content": prompt}],
+                tokenize=False,
+                add_generation_prompt=True,
             )
-            return outputs[0].outputs[0].text.strip("```").strip()
+            for prompt in prompts
+        ]
 
-        # do lora generation
-        input_text = self.llm.get_tokenizer().apply_chat_template(
-            conversation=messages,
-            tokenize=False,
-            add_generation_prompt=True,
-        )
+        lora_request = None
+        if lora_config is not None:
+            lora_request = LoRARequest(
+                lora_name=lora_name,
+                lora_path=lora_config["path"],
+                lora_int_id=lora_config["id"],
+            )
 
         outputs = self.llm.generate(
-            input_text,
+            input_texts,
             sampling_params=sp,
             use_tqdm=False,
-            lora_request=LoRARequest(
-                lora_name=lora_name,
-                lora_path=lora_config["path"],
-                lora_int_id=lora_config["id"],
-            ),
+            lora_request=lora_request,
         )
-        return outputs[0].outputs[0].text.strip("```").strip()
+        return [output.outputs[0].text.strip("```").strip() for output in outputs]
@@ -0,0 +1,98 @@
+from loguru import logger
+from typing import *
+import time
+from .inferencer import Inferencer
+
+
+class QAPipeline:
+    """
+    进程内的问答流水线: 分类 -> 关键词 -> nl2sql -> 答案生成
+    各阶段结果直接在内存中传递, 批量脚本和在线服务共用
+    """
+
+    def __init__(
+        self,
+        inferencer: Inferencer,
+        keywords_lora_name: str = "keywords",
+        nl2sql_lora_name: str = "nl2sql",
+        unload_cls_model: bool = False,
+    ):
+        """
+        unload_cls_model: 分类完成后卸载分类模型, 批量脚本中用于给vllm腾出显存
+        """
+        self.inferencer = inferencer
+        self.keywords_lora_name = keywords_lora_name
+        self.nl2sql_lora_name = nl2sql_lora_name
+        self.unload_cls_model = unload_cls_model
+
+    def answer_batch(self, questions: List[Dict], persist=False) -> List[Dict]:
+        """
+        questions: [{"id": 0, "question": "xxx"}]
+        return: 每个问题的分类, 关键词, sql, 答案, 以及耗时(秒)
+            - timings: 该问题各阶段的耗时, 前三个阶段整批推理, 答案阶段为从阶段开始到该问题得到答案
+            - batch_timings: 本批次各阶段的总耗时
+        """
+        timings = {}
+
+        start = time.perf_counter()
+        cls_entries = self.inferencer.do_classification(
+            questions=questions, persist=persist, unload_on_done=self.unload_cls_model
+        )
+        timings["classification"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        keywords_entries = self.inferencer.do_keywords_generation(
+            questions=questions, persist=persist, lora_name=self.keywords_lora_name
+        )
+        timings["keywords"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sql_entries = self.inferencer.do_sql_generation(
+            questions=questions, persist=persist, lora_name=self.nl2sql_lora_name
+        )
+        timings["nl2sql"] = time.perf_counter() - start
+
+        answer_start = time.perf_counter()
+        answer_entries = self.inferencer.do_answer_generation(
+            questions=questions, persist=persist, unload_on_done=False
+        )
+        timings["answer"] = time.perf_counter() - answer_start
+        finish_times = self.inferencer.answer_finish_times
+
+        logger.info(
+            "{}个问题各阶段耗时: {}".format(
+                len(questions), {k: round(v, 3) for k, v in timings.items()}
+            )
+        )
+
+        cls_map = {e["id"]: e["class"] for e in cls_entries}
+        keywords_map = {e["id"]: e["keywords"] for e in keywords_entries}
+        sql_map = {e["id"]: e["sql"] for e in sql_entries}
+        answer_map = {e["id"]: e["answer"] for e in answer_entries}
+        results = []
+        for q in questions:
+            results.append(
+                {
+                    "id": q["id"],
+                    "question": q["question"],
+                    "class": cls_map.get(q["id"]),
+                    "keywords": keywords_map.get(q["id"], []),
+                    "sql": sql_map.get(q["id"]),
+                    "answer": answer_map.get(q["id"], ""),
+                    "timings": {
+                        **timings,
+                        # 断点续跑直接复用的答案没有生成耗时
+                        "answer": finish_times.get(q["id"], answer_start)
+                        - answer_start,
+                    },
+                    "batch_timings": dict(timings),
+                }
+            )
+
+        if not persist:
+            for q in questions:
+                self.inferencer.dataloader.forget_question(q["id"])
+        return results
+
+    def answer(self, question_id: int, question: str) -> Dict:
+        return self.answer_batch([{"id": question_id, "question": question}])[0]
@@ -0,0 +1,95 @@
+from loguru import logger
+from typing import *
+from collections import deque
+import bisect
+
+
+class PrefixCacheStats:
+    """
+    统计各阶段prompt之间的共享前缀, 估算prefix caching节省的prefill token数
+    每条prompt与此前出现过的prompt的最长公共前缀即可被推理引擎复用,
+    在有序列表中它等于与相邻元素的最长公共前缀
+    - 每条prompt只分词一次, 直接比较token id序列
+    - 每个阶段只保留最近window条prompt, 长期运行的服务中内存有上限
+    """
+
+    def __init__(self, encode: Callable[[str], List[int]] = list, window: int = 1024):
+        """
+        encode: 把prompt转为token序列, 默认按字符
+        """
+        self.encode = encode
+        self.window = window
+        # {stage: 按token序列排序的最近prompt}, 以及按出现顺序排列的同一批prompt, 用于淘汰最旧的
+        self.seen: Dict[str, List[tuple]] = {}
+        self.order: Dict[str, Deque[tuple]] = {}
+        # {stage: {"prompts": n, "prompt_tokens": n, "shared_tokens": n}}
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def record(self, stage: str, prompts: List[str]):
+        seen = self.seen.setdefault(stage, [])
+        order = self.order.setdefault(stage, deque())
+        stage_stats = self.stats.setdefault(
+            stage, {"prompts": 0, "prompt_tokens": 0, "shared_tokens": 0}
+        )
+        for prompt in prompts:
+            tokens = tuple(self.encode(prompt))
+            pos = bisect.bisect_left(seen, tokens)
+            shared_len = 0
+            if pos > 0:
+                shared_len = PrefixCacheStats.common_prefix_len(seen[pos - 1], tokens)
+            if pos < len(seen):
+                shared_len = max(
+                    shared_len, PrefixCacheStats.common_prefix_len(seen[pos], tokens)
+                )
+            seen.insert(pos, tokens)
+            order.append(tokens)
+            if len(order) > self.window:
+                oldest = order.popleft()
+                del seen[bisect.bisect_left(seen, oldest)]
+
+            stage_stats["prompts"] += 1
+            stage_stats["prompt_tokens"] += len(tokens)
+            stage_stats["shared_tokens"] += shared_len
+
+    @staticmethod
+    def common_prefix_len(a: Sequence, b: Sequence) -> int:
+        n = min(len(a), len(b))
+        i = 0
+        while i < n and a[i] == b[i]:
+            i += 1
+        return i
+
+    def report(self, stage: str) -> Dict[str, int]:
+        stage_stats = self.stats.get(
+            stage, {"prompts": 0, "prompt_tokens": 0, "shared_tokens": 0}
+        )
+        ratio = (
+            stage_stats["shared_tokens"] / stage_stats["prompt_tokens"]
+            if stage_stats["prompt_tokens"] > 0
+            else 0
+        )
+        logger.info(
+            "阶段{}共{}条prompt, prefill {}个token, 其中共享前缀{}个token(占比{:.2%})可由prefix caching节省".format(
+                stage,
+                stage_stats["prompts"],
+                stage_stats["prompt_tokens"],
+                stage_stats["shared_tokens"],
+                ratio,
+            )
+        )
+        return stage_stats
+
+
+def test_prefix_cache_stats():
+    stats = PrefixCacheStats(window=2)
+    stats.record("nl2sql", ["abcd", "abxy", "zzz"])
+    # abxy与abcd共享ab; zzz没有共享前缀
+    assert stats.stats["nl2sql"] == {
+        "prompts": 3,
+        "prompt_tokens": 11,
+        "shared_tokens": 2,
+    }
+    # 只保留最近2条, abcd已被淘汰, abcz与abxy共享ab
+    assert stats.seen["nl2sql"] == [tuple("abxy"), tuple("zzz")]
+    stats.record("nl2sql", ["abcz"])
+    assert stats.stats["nl2sql"]["shared_tokens"] == 4
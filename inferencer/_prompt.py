@@ -1,3 +1,27 @@
+import hashlib
+from typing import Dict, List
+
+
+class PromptTemplate:
+    """
+    prompt模板, 由静态前缀和动态后缀组成
+    静态前缀在所有调用间保持不变, 放在最前面以便推理引擎复用其KV cache(prefix caching)
+    """
+
+    def __init__(self, name: str, static: str, dynamic: str):
+        self.name = name
+        self.static = static
+        self.dynamic = dynamic
+        PROMPT_TEMPLATES[name] = self
+
+    def render(self, **kwargs) -> str:
+        return self.static + self.dynamic.format(**kwargs)
+
+
+PROMPT_TEMPLATES: Dict[str, PromptTemplate] = {}
+
+
+# 分类模型是bert(encoder), 不存在KV cache复用, 且微调时使用的就是问题在前的格式, 因此保持原样
 def classify_prompt(question) -> str:
     classify_prompt = """
     请问“{}”是属于下面哪个类别的问题?
@@ -14,8 +38,9 @@ def classify_prompt(question) -> str:
     return classify_prompt
 
 
-def keywords_prompt(question) -> str:
-    question_prompt = """
+keywords_template = PromptTemplate(
+    name="keywords",
+    static="""
 # 任务
 请根据用户输入,为我从以下句子中提取最多3个关键词, 这些关键词是句子中最重要, 最能概括句子主题的词汇, 需要作为报表数据库查询的关键字段名被使用.
 
@@ -30,14 +55,26 @@ def keywords_prompt(question) -> str:
 ```关键词1,关键词2,关键词3```
 
 # 用户输入：
-{question}
-"""
-    keywords_prompt = question_prompt.format(question=question)
-    return keywords_prompt
+""",
+    dynamic="""{question}
+""",
+)
+
+
+def keywords_prompt(question) -> str:
+    return keywords_template.render(question=question)
 
 
-def nl2sql_prompt(question) -> str:
-    nl2sql_prompt = """
+def parse_keywords(model_answer: str) -> List[str]:
+    """
+    解析关键词模型的输出, 如```关键词1, 关键词2```
+    """
+    return [kw.strip() for kw in model_answer.strip("```").split(",")]
+
+
+nl2sql_template = PromptTemplate(
+    name="nl2sql",
+    static="""
 # 任务
 你是一名Mysql数据库开发人员, 你精通Mysql数据库的sql语句编写, 你需要根据已知的表名、字段名和用户输入来编写sql代码.
 
@@ -249,11 +286,36 @@ def nl2sql_prompt(question) -> str:
 ```select sum(销售人员) from company_table where 年份 = '2021' and 注册地址 like '%上海%' and 销售人员 is not null```
 
 # 用户输入
-{question}
-""".format(
-        question=question
-    )
-    return nl2sql_prompt
+""",
+    dynamic="""{question}
+""",
+)
+
+
+NL2SQL_FIELDS_HEADER = "## 已知字段名\n"
+
+
+def nl2sql_fields() -> List[str]:
+    """
+    nl2sql prompt中列出的全部字段名
+    """
+    static = nl2sql_template.static
+    start = static.index(NL2SQL_FIELDS_HEADER) + len(NL2SQL_FIELDS_HEADER)
+    end = static.index("\n\n", start)
+    return [l[2:].strip() for l in static[start:end].split("\n")]
+
+
+def nl2sql_prompt(question, fields: List[str] = None) -> str:
+    """
+    fields: 只列出这些字段, 缩短prompt; 为None时列出全部字段
+        裁剪后字段列表不再属于静态前缀, 只在未开启prefix caching或prefill开销为主时使用
+    """
+    prompt = nl2sql_template.render(question=question)
+    if fields is None:
+        return prompt
+    start = prompt.index(NL2SQL_FIELDS_HEADER) + len(NL2SQL_FIELDS_HEADER)
+    end = prompt.index("\n\n", start)
+    return prompt[:start] + "\n".join([f"- {f}" for f in fields]) + prompt[end:]
 
 
 def type1_prompt(question, company, abbr, years):
@@ -289,8 +351,9 @@ def type1_prompt(question, company, abbr, years):
     return prompt
 
 
-def keyword_extraction_prompt_type3(question):
-    return '''
+keyword_extraction_type3_template = PromptTemplate(
+    name="keyword_extraction_type3",
+    static='''
 这是文字提取器，你要从用户输入的文本中提取关键词
 关键词是指：问题最终指向的词语，通常是名词或句子的宾语，通常出现在公司名称或时间状语后面
 如：净利润、社会责任工作、企业名称、固定资产、外文名称、注册地址、财务费用、长期借款、短期借款、资产及负债、收回投资收到的现金、净利润率、企业研发经费与利润比值、企业研发经费与营业收入比值、研发人员占职工人数比例、企业硕士及以上人员占职工人数比例、企业研发经费占费用比例、收回投资所收到的现金、关键审计事项、法人代表、负债总金额、总负债、无。对象可以有多个。没有写“无”。
@@ -344,14 +407,19 @@ def keyword_extraction_prompt_type3(question):
 """
 
 请根据以下文本，严格按照示例模版格式输出内容。
-用户输入：{}
-'''.format(
-        question
-    )
+用户输入：''',
+    dynamic="""{question}
+""",
+)
 
 
-def type3_prompt(background, question):
-    return """
+def keyword_extraction_prompt_type3(question):
+    return keyword_extraction_type3_template.render(question=question)
+
+
+type3_template = PromptTemplate(
+    name="type3",
+    static="""
     你需要阅读理解年报的片段来真实详细完整的回答用户的提问。
     下面是年报内容格式的一些说明:
     1. 片段由标题和正文内容组成。
@@ -360,32 +428,41 @@ def type3_prompt(background, question):
     3. "√适用"表示该项内容公司存在该事项, "√不适用"表示公司不存在该事项。
     4. "√是"表示该项是或者有, "√否"表示该项不是或者没有。
 
-    {}
+""",
+    dynamic="""    {background}
     ******************************
-    问: {}
-    """.format(
-        background, question
-    )
+    问: {question}
+    """,
+)
 
 
-def general_qa_prompt(ctx, question):
-    prompt = f"""
+def type3_prompt(background, question):
+    return type3_template.render(background=background, question=question)
+
+
+general_qa_template = PromptTemplate(
+    name="general_qa",
+    static="""
     # 任务
     请根据提供的上下文回答我的问题
 
-    # 我的问题
+    # 回答要求
+    - 你只需要回答问题相关的内容, 不要回答无关内容。
+    - 你的回答只能来源于提供的上下文。
+    - 在回答回答需要复述问题。
+
+""",
+    dynamic="""    # 我的问题
     {question}
 
     # 上下文
     {ctx}
+    """,
+)
 
-    # 回答要求
-    - 你只需要回答问题相关的内容, 不要回答无关内容。
-    - 你的回答只能来源于提供的上下文。
-    - 在回答回答需要复述问题。
-    """
 
-    return prompt
+def general_qa_prompt(ctx, question):
+    return general_qa_template.render(ctx=ctx, question=question)
 
 
 def single_question_prompt(ori_question, company, year, background, step_question):
@@ -463,3 +540,17 @@ def find_synonyms_prompt(word_list, word):
 '''.format(
         word_list, word
     )
+
+
+_prompt_version = None
+
+
+def prompt_version() -> str:
+    """
+    prompt模板的版本号, 取本文件内容的哈希, 任一模板改动都会使其变化
+    """
+    global _prompt_version
+    if _prompt_version is None:
+        with open(__file__, "rb") as f:
+            _prompt_version = hashlib.sha256(f.read()).hexdigest()[:16]
+    return _prompt_version
@@ -0,0 +1,254 @@
+from loguru import logger
+from typing import *
+import json
+import os
+import re
+from dataloader import DataLoader
+from ._answer_generator_sql import AnswerGeneratorSql
+from ._sql_template import ZH_DIGITS, zh_to_int
+from ._column_index import field_synonyms
+
+REGION_PATTERNS = [
+    re.compile(
+        r"(?:注册地址|注册地点|注册地)在([\u4e00-\u9fa5]{2,4}?)(?=[，,的、哪有]|$)"
+    ),
+    re.compile(r"在([\u4e00-\u9fa5]{2,4}?)注册"),
+]
+
+# 规划器不支持的问法, 交给模型
+UNSUPPORTED_KEYWORDS = re.compile(
+    "最低|最少|最小|低的|增长|比例|比率|占比|差|变化|同比|环比|以上|以下|之间"
+)
+
+COMPARE_OPS = {
+    "大于": ">",
+    "高于": ">",
+    "超过": ">",
+    "多于": ">",
+    "小于": "<",
+    "低于": "<",
+    "少于": "<",
+}
+
+
+class QueryPlan(NamedTuple):
+    # rank: 第N高, top: 最高的前N家, count: 大于阈值的数量, sum/avg: 按年份汇总
+    shape: str
+    sql: str
+    column: str
+    # 问题中字段的原始说法, 用于组织答案
+    field_text: str
+    years: List[str]
+    region: Optional[str]
+    n: int = 1
+    with_amount: bool = False
+    compare_text: str = ""
+
+
+class QueryPlanner:
+    """
+    常见统计题的规则化查询
+    - 解析年份, 注册地, 字段, 名次/数量, 阈值, 直接生成sql在company_table上执行
+    - 按参考答案的格式组织答案, 不调用模型
+    无法解析的问题返回None, 仍走nl2sql+模型生成答案的流程
+    """
+
+    def __init__(self, dataloader: DataLoader, columns: List[str] = None):
+        """
+        columns: 可用于排序和汇总的数值字段, 默认从sqlite库中取REAL类型的列
+        """
+        self.dataloader = dataloader
+        self.columns = columns
+        self.field_pattern = None
+        self.field_map: Dict[str, str] = {}
+        self.stats = {"planned": 0, "answered": 0, "fallback": 0}
+
+    def load_columns(self) -> List[str]:
+        if self.columns is None:
+            cursor = self.dataloader.load_sql_search_cursor()
+            table_info = cursor.execute("PRAGMA table_info(company_table)").fetchall()
+            self.columns = [row[1] for row in table_info if row[2] == "REAL"]
+        if self.field_pattern is None:
+            self.field_map = field_synonyms(self.columns)
+            # 字段名本身优先于同义词
+            self.field_map.update({c: c for c in self.columns})
+            names = sorted(self.field_map.keys(), key=len, reverse=True)
+            self.field_pattern = re.compile("|".join([re.escape(n) for n in names]))
+        return self.columns
+
+    def plan(self, question: str) -> Optional[QueryPlan]:
+        self.load_columns()
+        text = re.sub(r"[\s“”\"]", "", question)
+        years = re.findall(r"(20\d{2})年", text)
+        if len(years) == 0:
+            return None
+
+        region = None
+        for pattern in REGION_PATTERNS:
+            m = pattern.search(text)
+            if m is not None:
+                region = m.group(1)
+                text = text[: m.start()] + text[m.end() :]
+                break
+
+        # 只支持单个字段的问题
+        field_matches = list(self.field_pattern.finditer(text))
+        if len(set([self.field_map[m.group(0)] for m in field_matches])) != 1:
+            return None
+        field_text = field_matches[0].group(0)
+        column = self.field_map[field_text]
+        rest = self.field_pattern.sub("", text)
+        if UNSUPPORTED_KEYWORDS.search(rest):
+            return None
+
+        region_cond = f" AND 注册地址 LIKE '%{region}%'" if region else ""
+        not_null_cond = f' AND "{column}" IS NOT NULL'
+        plan_args = {
+            "column": column,
+            "field_text": field_text,
+            "years": years,
+            "region": region,
+        }
+
+        if len(set(years)) == 1:
+            year_cond = f"年份 = '{years[0]}'"
+            m = re.search(f"第([{ZH_DIGITS}\\d]+)(?:高|大|多)", rest)
+            if m is not None:
+                n = zh_to_int(m.group(1))
+                if n is None or n < 1:
+                    return None
+                sql = f'SELECT 公司全称 FROM company_table WHERE {year_cond}{region_cond}{not_null_cond} ORDER BY "{column}" DESC LIMIT 1 OFFSET {n - 1}'
+                return QueryPlan(shape="rank", sql=sql, n=n, **plan_args)
+
+            m = re.search(
+                f"({'|'.join(COMPARE_OPS.keys())})([{ZH_DIGITS}\\d\\.百千万亿]+)", rest
+            )
+            if m is not None and re.search("多少|数量|几家", rest):
+                numbers = AnswerGeneratorSql.get_number_from_question(m.group(2))
+                if len(numbers) != 1:
+                    return None
+                sql = f'SELECT COUNT(*) FROM company_table WHERE {year_cond}{region_cond} AND "{column}" {COMPARE_OPS[m.group(1)]} {numbers[0]}'
+                return QueryPlan(
+                    shape="count", sql=sql, compare_text=m.group(0), **plan_args
+                )
+
+            if re.search("最高|最多", rest) and not re.search(
+                "平均|总和|总计|合计", rest
+            ):
+                m = re.search(f"([{ZH_DIGITS}\\d]+)(?:家|个|名)", rest)
+                n = zh_to_int(m.group(1)) if m is not None else 1
+                if n is None or n < 1:
+                    return None
+                sql = f'SELECT 公司全称, "{column}" FROM company_table WHERE {year_cond}{region_cond}{not_null_cond} ORDER BY "{column}" DESC LIMIT {n}'
+                return QueryPlan(
+                    shape="top",
+                    sql=sql,
+                    n=n,
+                    with_amount=re.search("金额|多少|数值", rest) is not None,
+                    **plan_args,
+                )
+
+        agg = None
+        if re.search("平均", rest):
+            agg = "avg"
+        elif re.search("总和|总计|合计|总数|一共|总共", rest):
+            agg = "sum"
+        if agg is None or region is None:
+            return None
+        year_list = ", ".join([f"'{y}'" for y in sorted(set(years))])
+        sql = f'SELECT 年份, ROUND({agg.upper()}("{column}"), 2) FROM company_table WHERE 年份 IN ({year_list}){region_cond}{not_null_cond} GROUP BY 年份'
+        return QueryPlan(shape=agg, sql=sql, **plan_args)
+
+    def answer(self, question: str) -> Optional[str]:
+        """
+        return: 答案, 问题无法解析或查询无结果时返回None
+        """
+        plan = self.plan(question)
+        if plan is None:
+            return None
+        self.stats["planned"] += 1
+        sql_ctx, err = self.dataloader.exec_sql(plan.sql)
+        if err is not None or sql_ctx["result"] == "":
+            logger.warning(f"规则查询失败或无结果, 交给模型: {plan.sql}, 错误: {err}")
+            self.stats["fallback"] += 1
+            return None
+        rows = sql_ctx["result"].split("\n")
+        answer = QueryPlanner.format_answer(plan, rows)
+        self.stats["answered"] += 1
+        return answer
+
+    @staticmethod
+    def format_answer(plan: QueryPlan, rows: List[str]) -> str:
+        prefix = f"在{plan.region}注册的所有上市公司中，" if plan.region else ""
+        subject = f"{prefix}{plan.years[0]}年{plan.field_text}"
+        if plan.shape == "rank":
+            return f"{subject}第{plan.n}高的公司为{rows[0]}。"
+        if plan.shape == "count":
+            return f"{subject}{plan.compare_text}的上市公司数量为{rows[0]}。"
+        if plan.shape == "top":
+            pairs = [row.rsplit(":", 1) for row in rows]
+            if plan.n == 1:
+                answer = f"{subject}最高的公司为{pairs[0][0]}"
+                if plan.with_amount:
+                    answer += f"，金额为{pairs[0][1]}元"
+                return answer + "。"
+            if plan.with_amount:
+                details = "；".join([f"{c}{plan.column}为{v}元" for c, v in pairs])
+                return f"{subject}最高的前{plan.n}家上市公司及金额分别为{details}。"
+            companies = "、".join([c for c, _ in pairs])
+            return f"{subject}最高的前{plan.n}家上市公司分别为{companies}。"
+
+        # 按问题中年份的顺序给出汇总值
+        values = dict([row.split(":", 1) for row in rows])
+        years = list(dict.fromkeys(plan.years))
+        agg_text = "平均值" if plan.shape == "avg" else "总和"
+        years_text = "、".join([f"{y}年" for y in years])
+        values_text = "、".join([values.get(y, "无数据") for y in years])
+        if len(years) == 1:
+            return f"{prefix}{years_text}{plan.field_text}的{agg_text}为{values_text}。"
+        return f"{prefix}{years_text}{plan.field_text}的{agg_text}分别为{values_text}。"
+
+    def report(self) -> Dict[str, int]:
+        logger.info(
+            "规则查询解析{planned}题, 直接作答{answered}题, 交给模型{fallback}题".format(
+                **self.stats
+            )
+        )
+        return self.stats
+
+
+def test_query_planner():
+    """
+    统计参考答案中能被规则解析的统计题, 并检查几个典型问题生成的sql
+    """
+    from ._prompt import nl2sql_fields
+
+    dataset_dir = os.path.join(os.path.dirname(__file__), "..", "resources")
+    planner = QueryPlanner(dataloader=None, columns=nl2sql_fields())
+
+    plan = planner.plan("2019年负债总额第2高的上市公司是？")
+    assert plan.shape == "rank" and plan.column == "总负债" and plan.n == 2
+    assert QueryPlanner.format_answer(plan, ["某公司"]) == (
+        "2019年负债总额第2高的公司为某公司。"
+    )
+    plan = planner.plan("在杭州注册的所有上市公司中，2020年总负债大于5亿的有多少家？")
+    assert plan.shape == "count" and plan.region == "杭州"
+    assert plan.sql.endswith('"总负债" > 500000000')
+    plan = planner.plan("2020年哪四家上市公司，在杭州注册，总负债最高？金额为？")
+    assert plan.shape == "top" and plan.n == 4 and plan.with_amount
+    assert planner.plan("2019年负债总额最低的上市公司是？") is None
+
+    planned = 0
+    total = 0
+    with open(
+        os.path.join(dataset_dir, "metrics", "ground_truth.jsonl"),
+        "r",
+        encoding="utf-8",
+    ) as f:
+        for line in f:
+            gt = json.loads(line)
+            if gt["type"] not in ["1", "1-2"] or gt["prompt"].get("ent_name") != "":
+                continue
+            total += 1
+            planned += int(planner.plan(gt["question"]) is not None)
+    print(f"参考答案中无公司名的统计题{total}题, 规则可解析{planned}题")
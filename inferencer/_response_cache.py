@@ -0,0 +1,182 @@
+from loguru import logger
+from typing import *
+import sqlite3
+import hashlib
+import json
+import threading
+import time
+import os
+
+
+class ResponseCache:
+    """
+    基于sqlite的模型输出缓存, 按最近访问时间做容量受限的LRU淘汰
+    key由模型名, lora名称及路径, 采样参数和prompt哈希共同决定
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stage = "default"
+        # {stage: {"hit": n, "miss": n}}
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+        dir_name = os.path.dirname(path)
+        if dir_name != "":
+            os.makedirs(dir_name, exist_ok=True)
+        # 答案生成阶段会在后台线程调用模型, 连接需要跨线程使用
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_access REAL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)"
+        )
+        self.conn.commit()
+        self.total_bytes = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @staticmethod
+    def make_key(
+        model_name: str,
+        lora_name: str,
+        lora_path: str,
+        sampling_params: dict,
+        prompt: str,
+    ) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        raw = json.dumps(
+            [model_name, lora_name, lora_path, sampling_params, prompt_hash],
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        if len(keys) == 0:
+            return {}
+        found = {}
+        with self.lock:
+            unique_keys = list(set(keys))
+            # sqlite单条语句的变量数有上限, 分段查询
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start : start + 500]
+                rows = self.conn.execute(
+                    "SELECT key, response FROM responses WHERE key IN ({})".format(
+                        ",".join(["?"] * len(chunk))
+                    ),
+                    chunk,
+                ).fetchall()
+                found.update({k: v for k, v in rows})
+            if len(found) > 0:
+                now = time.time()
+                self.conn.executemany(
+                    "UPDATE responses SET last_access = ? WHERE key = ?",
+                    [(now, k) for k in found],
+                )
+                self.conn.commit()
+
+        stage_stats = self.stats.setdefault(self.stage, {"hit": 0, "miss": 0})
+        hit = sum([1 for k in keys if k in found])
+        stage_stats["hit"] += hit
+        stage_stats["miss"] += len(keys) - hit
+        return found
+
+    def put_many(self, items: Dict[str, str]):
+        if len(items) == 0:
+            return
+        now = time.time()
+        with self.lock:
+            for key, response in items.items():
+                size = len(response.encode("utf-8"))
+                old = self.conn.execute(
+                    "SELECT size FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if old is not None:
+                    self.total_bytes -= old[0]
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (key, response, size, now),
+                )
+                self.total_bytes += size
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 100"
+            ).fetchall()
+            if len(rows) == 0:
+                self.total_bytes = 0
+                return
+            for key, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+
+    def report(self, stage: str = None) -> Dict[str, int]:
+        stage = stage or self.stage
+        stage_stats = self.stats.get(stage, {"hit": 0, "miss": 0})
+        total = stage_stats["hit"] + stage_stats["miss"]
+        hit_rate = stage_stats["hit"] / total if total > 0 else 0
+        logger.info(
+            "阶段{}的模型缓存命中{}次, 未命中{}次, 命中率{:.2%}".format(
+                stage, stage_stats["hit"], stage_stats["miss"], hit_rate
+            )
+        )
+        return stage_stats
+
+    def close(self):
+        self.conn.close()
+
+
+def test_response_cache():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "cache.sqlite")
+        cache = ResponseCache(path, max_bytes=10)
+
+        def put(key: str, response: str):
+            # 保证每次写入/访问的last_access不同
+            time.sleep(0.01)
+            cache.put_many({key: response})
+
+        def keys() -> Set[str]:
+            return set([k for k, in cache.conn.execute("SELECT key FROM responses")])
+
+        put("a", "aaaa")
+        put("b", "bbbb")
+        assert cache.total_bytes == 8
+        # 覆盖写入时扣除旧值的大小
+        put("a", "aa")
+        assert cache.total_bytes == 6
+
+        cache.stage = "nl2sql"
+        time.sleep(0.01)
+        assert cache.get_many(["b"]) == {"b": "bbbb"}
+        put("c", "cccc")
+        assert cache.total_bytes == 10 and keys() == {"a", "b", "c"}
+        # 超出容量, 淘汰最久未访问的a; b刚被读取过, 得以保留
+        put("d", "dd")
+        assert keys() == {"b", "c", "d"}
+        assert cache.total_bytes == 10
+
+        cache.stage = "keywords"
+        assert cache.get_many(["a", "d", "d"]) == {"d": "dd"}
+        assert cache.stats == {
+            "nl2sql": {"hit": 1, "miss": 0},
+            "keywords": {"hit": 2, "miss": 1},
+        }
+        assert cache.report("keywords") == {"hit": 2, "miss": 1}
+        cache.close()
+
+        # 重新打开时从表中恢复总大小
+        cache = ResponseCache(path, max_bytes=10)
+        assert cache.total_bytes == 10
+        cache.close()
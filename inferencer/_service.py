@@ -0,0 +1,259 @@
+from loguru import logger
+from typing import *
+import asyncio
+import itertools
+import json
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from ._pipeline import QAPipeline
+
+
+class QAService:
+    """
+    基于asyncio的在线问答http服务
+    - 请求进入有界队列, 队列满时直接返回503
+    - 后台批处理协程从队列中攒批, 整批交给流水线, 让模型批量推理
+    - 流水线在单独线程中执行, 同一时间只有一个批次在推理
+    接口:
+    - POST /answer  {"question": "xxx"}
+    - GET  /health
+    """
+
+    def __init__(
+        self,
+        pipeline: QAPipeline,
+        host: str = "0.0.0.0",
+        port: int = 8000,
+        max_queue_size: int = 256,
+        max_batch_size: int = 32,
+        max_wait_ms: int = 20,
+        request_timeout: float = 300,
+        max_headers: int = 64,
+        max_body_bytes: int = 64 * 1024,
+    ):
+        """
+        max_headers / max_body_bytes: 请求头个数和请求体字节数上限, 超出时返回400/413
+        """
+        self.pipeline = pipeline
+        self.host = host
+        self.port = port
+        self.max_queue_size = max_queue_size
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.request_timeout = request_timeout
+        self.max_headers = max_headers
+        self.max_body_bytes = max_body_bytes
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # 在线问题的id从较大的数开始, 与离线问题集的id区分
+        self.id_counter = itertools.count(1_000_000)
+        self.queue: asyncio.Queue = None
+
+    async def serve(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        batcher = asyncio.create_task(self._batch_loop())
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"QA服务已启动: http://{self.host}:{self.port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def submit(self, question: str) -> Dict:
+        """
+        提交一个问题并等待答案, 队列已满时抛出asyncio.QueueFull
+        """
+        future = asyncio.get_running_loop().create_future()
+        q = {"id": next(self.id_counter), "question": question}
+        self.queue.put_nowait((q, future, time.perf_counter()))
+        return await asyncio.wait_for(future, timeout=self.request_timeout)
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while len(items) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            questions = [q for q, _, _ in items]
+            batch_start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.pipeline.answer_batch, questions
+                )
+            except Exception as e:
+                traceback.print_exc()
+                for _, future, _ in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            now = time.perf_counter()
+            for (_, future, enqueued_at), result in zip(items, results):
+                if future.done():
+                    continue
+                result["timings"]["queue"] = batch_start - enqueued_at
+                result["timings"]["total"] = now - enqueued_at
+                result["batch_size"] = len(items)
+                future.set_result(result)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                request = await self._read_request(reader)
+                if request is None:
+                    # 客户端未发送请求就关闭了连接
+                    return
+                status, payload = await self._route(*request)
+            except HttpError as e:
+                status, payload = e.status, {"error": str(e)}
+            except Exception as e:
+                traceback.print_exc()
+                status, payload = 400, {"error": str(e)}
+
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            writer.write(
+                (
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                    "Content-Type: application/json; charset=utf-8\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode("utf-8")
+                + data
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(
+        self, reader: asyncio.StreamReader
+    ) -> Optional[Tuple[str, str, bytes]]:
+        """
+        return: (method, path, body), 连接在发送请求前关闭时为None
+        单行长度受StreamReader的limit(默认64KB)限制, 超出时readline抛出ValueError
+        """
+        request_line = (await reader.readline()).decode("utf-8").strip()
+        if request_line == "":
+            return None
+        method, path, _ = request_line.split(" ", 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("utf-8").strip()
+            if line == "":
+                break
+            if len(headers) >= self.max_headers:
+                raise HttpError(400, "请求头过多")
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+        content_length = int(headers.get("content-length", 0))
+        if content_length < 0:
+            raise HttpError(400, "Content-Length无效")
+        if content_length > self.max_body_bytes:
+            raise HttpError(413, "请求体超过{}字节".format(self.max_body_bytes))
+        body = b""
+        if content_length > 0:
+            body = await reader.readexactly(content_length)
+        return method, path, body
+
+    async def _route(self, method: str, path: str, body: bytes) -> Tuple[int, Dict]:
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok", "queue_size": self.queue.qsize()}
+
+        if method == "POST" and path == "/answer":
+            data = json.loads(body.decode("utf-8"))
+            question = data.get("question", "")
+            if question == "":
+                return 400, {"error": "question不能为空"}
+            try:
+                return 200, await self.submit(question)
+            except asyncio.QueueFull:
+                return 503, {"error": "请求队列已满"}
+            except asyncio.TimeoutError:
+                return 504, {"error": "请求超时"}
+            except Exception as e:
+                return 500, {"error": str(e)}
+
+        return 404, {"error": f"unknown path {method} {path}"}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+
+def test_service_request_limits():
+    """
+    用假的流水线启动服务, 检查请求头/请求体上限, 以及提前关闭的连接
+    """
+
+    class EchoPipeline:
+        def answer_batch(self, questions):
+            return [
+                {"id": q["id"], "answer": q["question"], "timings": {}}
+                for q in questions
+            ]
+
+    async def request(port: int, raw: bytes) -> bytes:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(raw)
+        writer.write_eof()
+        data = await reader.read()
+        writer.close()
+        return data
+
+    async def main():
+        service = QAService(EchoPipeline(), max_headers=4, max_body_bytes=100)
+        service.queue = asyncio.Queue(maxsize=service.max_queue_size)
+        batcher = asyncio.create_task(service._batch_loop())
+        server = await asyncio.start_server(service._handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        body = json.dumps({"question": "你好"}).encode("utf-8")
+        ok = await request(
+            port,
+            b"POST /answer HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body) + body,
+        )
+        assert ok.startswith(b"HTTP/1.1 200") and "你好".encode("utf-8") in ok
+        too_large = await request(
+            port, b"POST /answer HTTP/1.1\r\nContent-Length: 1000000\r\n\r\n"
+        )
+        assert too_large.startswith(b"HTTP/1.1 413")
+        headers = b"".join([b"X-%d: 1\r\n" % i for i in range(10)])
+        too_many = await request(port, b"GET /health HTTP/1.1\r\n" + headers + b"\r\n")
+        assert too_many.startswith(b"HTTP/1.1 400")
+        # 不发送请求直接关闭
+        assert await request(port, b"") == b""
+        assert (await request(port, b"GET /health HTTP/1.1\r\n\r\n")).startswith(
+            b"HTTP/1.1 200"
+        )
+
+        server.close()
+        await server.wait_closed()
+        batcher.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,260 @@
+from loguru import logger
+from typing import *
+import json
+import os
+import re
+from ._answer_generator_sql import AnswerGeneratorSql
+
+# 问题中的槽位在模板key里的占位符, 使用私有区字符, 避免与问题文本及后续正则冲突
+SLOT_MARKS = {"C": "\ue000", "Y": "\ue001", "N": "\ue002", "K": "\ue003"}
+
+ZH_DIGITS = "一二三四五六七八九十两"
+ZH_DIGIT_VALUES = {
+    "一": 1,
+    "二": 2,
+    "两": 2,
+    "三": 3,
+    "四": 4,
+    "五": 5,
+    "六": 6,
+    "七": 7,
+    "八": 8,
+    "九": 9,
+}
+
+# 数字按连续数字串切分, 别名中的年份(如sum_2021)也能被识别为槽位
+SQL_TOKEN_PATTERN = re.compile(
+    r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\d+|[\u4e00-\u9fa5]+)"
+)
+
+
+def zh_to_int(text: str) -> Optional[int]:
+    """
+    解析100以内的阿拉伯数字或中文数字, 如"5", "五", "十二", "二十"
+    """
+    if text.isdigit():
+        return int(text)
+    if text in ZH_DIGIT_VALUES:
+        return ZH_DIGIT_VALUES[text]
+    if "十" in text and len(text) <= 3:
+        tens, _, ones = text.partition("十")
+        tens_value = ZH_DIGIT_VALUES.get(tens, 1 if tens == "" else None)
+        ones_value = ZH_DIGIT_VALUES.get(ones, 0 if ones == "" else None)
+        if tens_value is not None and ones_value is not None:
+            return tens_value * 10 + ones_value
+    return None
+
+
+class QuestionSlots(NamedTuple):
+    # 抽象掉槽位后的问题, 作为模板的key
+    key: str
+    # {槽位类型: [槽位值]}, 按在问题中出现的顺序排列
+    values: Dict[str, List[Union[str, int]]]
+
+
+class SqlTemplateCache:
+    """
+    nl2sql的参数化模板缓存
+    - 问题中的字段名(C), 年份(Y), 金额等数值(N), 名次/数量(K)抽象为槽位, 其余文本作为模板key
+    - 模型为某个问题生成sql后, 把sql中与槽位值对应的部分替换为槽位, 得到sql骨架
+    - 之后key相同的问题直接用各自的槽位值实例化骨架, 不再调用模型
+    只有能无歧义地还原出原sql的骨架才会被缓存
+    """
+
+    def __init__(self, fields: List[str], validate_sql: Callable[[str], bool] = None):
+        """
+        validate_sql: 检查模型生成的sql能否执行, 不通过的sql不作为模板, 避免错误复制到同类问题
+        """
+        self.validate_sql = validate_sql
+        # 长字段名优先匹配
+        self.fields = sorted([f for f in fields if f != ""], key=len, reverse=True)
+        self.field_pattern = (
+            re.compile("|".join([re.escape(f) for f in self.fields]))
+            if len(self.fields) > 0
+            else None
+        )
+        self.number_pattern = re.compile(
+            "[一二三四五六七八九十两1234567890]+个?(十万|百万|千万|十亿|百亿|千亿|百|千|万|亿|)"
+        )
+        self.rank_pattern = re.compile(
+            f"(?<=[第前哪])[{ZH_DIGITS}\\d]+|[{ZH_DIGITS}\\d]+(?=[家名位])"
+        )
+        # {key: [(token, 槽位类型, 槽位序号, 偏移)]}
+        self.templates: Dict[str, List[Tuple[str, str, int, int]]] = {}
+        self.stats = {"hit": 0, "miss": 0, "learned": 0, "rejected": 0, "invalid": 0}
+
+    def parse_question(self, question: str) -> QuestionSlots:
+        values = {"C": [], "Y": [], "N": [], "K": []}
+        text = question
+
+        def sub(slot_type: str, pattern, text: str, to_value) -> str:
+            result = []
+            last = 0
+            for m in pattern.finditer(text):
+                value = to_value(m.group(0))
+                if value is None:
+                    continue
+                result.append(text[last : m.start()])
+                result.append(SLOT_MARKS[slot_type])
+                values[slot_type].append(value)
+                last = m.end()
+            result.append(text[last:])
+            return "".join(result)
+
+        # 字段名中可能含有数字(如"一年内到期的非流动负债"), 先替换字段名
+        if self.field_pattern is not None:
+            text = sub("C", self.field_pattern, text, lambda s: s)
+        text = sub("Y", re.compile(r"(?<!\d)(19|20)\d{2}(?!\d)"), text, lambda s: s)
+        text = sub("N", self.number_pattern, text, self._parse_amount)
+        text = sub("K", self.rank_pattern, text, lambda s: zh_to_int(s))
+        return QuestionSlots(key=text, values=values)
+
+    @staticmethod
+    def _parse_amount(text: str) -> Optional[str]:
+        numbers = AnswerGeneratorSql.get_number_from_question(text)
+        return numbers[0] if len(numbers) == 1 else None
+
+    def get(self, question: str) -> Optional[str]:
+        slots = self.parse_question(question)
+        skeleton = self.templates.get(slots.key)
+        if skeleton is None:
+            self.stats["miss"] += 1
+            return None
+        self.stats["hit"] += 1
+        return SqlTemplateCache._instantiate(skeleton, slots.values)
+
+    def learn(self, question: str, sql: str) -> bool:
+        """
+        由模型生成的sql学习模板, 返回是否成功缓存
+        """
+        slots = self.parse_question(question)
+        if slots.key in self.templates:
+            return True
+        if self.validate_sql is not None and not self.validate_sql(sql):
+            self.stats["invalid"] += 1
+            return False
+        skeleton = self._build_skeleton(sql, slots.values)
+        if (
+            skeleton is None
+            or SqlTemplateCache._instantiate(skeleton, slots.values) != sql
+        ):
+            self.stats["rejected"] += 1
+            return False
+        self.templates[slots.key] = skeleton
+        self.stats["learned"] += 1
+        return True
+
+    def _build_skeleton(
+        self, sql: str, values: Dict[str, List[str]]
+    ) -> Optional[List[Tuple[str, str, int, int]]]:
+        skeleton = []
+        used = set()
+        k_usage: Dict[int, Set[str]] = {}
+        for token in SQL_TOKEN_PATTERN.split(sql):
+            if token == "":
+                continue
+            candidates = []
+            prev = skeleton[-1][0] if len(skeleton) > 0 else ""
+            if token[0] in "'\"":
+                candidates = [
+                    ("Y", i, 0) for i, v in enumerate(values["Y"]) if token[1:-1] == v
+                ]
+            elif token.isdigit():
+                candidates += [
+                    ("Y", i, 0) for i, v in enumerate(values["Y"]) if token == v
+                ]
+                candidates += [
+                    ("N", i, 0) for i, v in enumerate(values["N"]) if token == v
+                ]
+                if re.search(r"\bOFFSET\s*$", prev, re.IGNORECASE):
+                    candidates += [
+                        ("K", i, -1)
+                        for i, v in enumerate(values["K"])
+                        if int(token) == v - 1
+                    ]
+                elif re.search(r"\bLIMIT\s*$", prev, re.IGNORECASE):
+                    candidates += [
+                        ("K", i, 0)
+                        for i, v in enumerate(values["K"])
+                        if int(token) == v
+                    ]
+            elif re.match(r"^[\u4e00-\u9fa5]+$", token):
+                candidates = [
+                    ("C", i, 0) for i, v in enumerate(values["C"]) if token == v
+                ]
+
+            if len(candidates) > 1:
+                # 同一个值对应多个槽位, 无法确定
+                return None
+            if len(candidates) == 0:
+                skeleton.append((token, "", 0, 0))
+                continue
+            slot_type, idx, offset = candidates[0]
+            used.add((slot_type, idx))
+            if slot_type == "K":
+                k_usage.setdefault(idx, set()).add(offset)
+            skeleton.append((token, slot_type, idx, offset))
+
+        # 问题中的每个槽位都必须体现在sql中, 否则换了槽位值的问题会得到同样的sql
+        for slot_type, slot_values in values.items():
+            for idx in range(len(slot_values)):
+                if (slot_type, idx) not in used:
+                    return None
+        # 名次同时出现在LIMIT和OFFSET中(如第1名), 无法区分哪个是常量
+        if any([len(usage) > 1 for usage in k_usage.values()]):
+            return None
+        return skeleton
+
+    @staticmethod
+    def _instantiate(
+        skeleton: List[Tuple[str, str, int, int]], values: Dict[str, List[str]]
+    ) -> str:
+        parts = []
+        for token, slot_type, idx, offset in skeleton:
+            if slot_type == "":
+                parts.append(token)
+            elif slot_type == "K":
+                parts.append(str(values["K"][idx] + offset))
+            elif token[0] in "'\"":
+                parts.append(token[0] + values[slot_type][idx] + token[-1])
+            else:
+                parts.append(values[slot_type][idx])
+        return "".join(parts)
+
+    def report(self) -> Dict[str, int]:
+        total = self.stats["hit"] + self.stats["miss"]
+        hit_rate = self.stats["hit"] / total if total > 0 else 0
+        logger.info(
+            "sql模板缓存命中{hit}次, 未命中{miss}次, 学习模板{learned}个, 拒绝{rejected}个, sql无效{invalid}个".format(
+                **self.stats
+            )
+            + ", 命中率{:.2%}".format(hit_rate)
+        )
+        return self.stats
+
+
+def test_sql_template_cache():
+    """
+    用nl2sql数据集的标注sql模拟模型输出, 统计模板命中率及实例化结果与标注一致的比例
+    """
+    from ._prompt import nl2sql_fields
+
+    dataset_dir = os.path.join(
+        os.path.dirname(__file__), "..", "resources", "dataset", "nl2sql"
+    )
+    rows = []
+    for name in ["train.jsonl", "test.jsonl"]:
+        with open(os.path.join(dataset_dir, name), "r", encoding="utf-8") as f:
+            rows.extend([json.loads(line) for line in f])
+
+    cache = SqlTemplateCache(nl2sql_fields())
+    hit, correct = 0, 0
+    for row in rows:
+        sql = cache.get(row["question"])
+        if sql is None:
+            cache.learn(row["question"], row["label"])
+            continue
+        hit += 1
+        correct += int(sql == row["label"])
+    cache.report()
+    print(f"{len(rows)}个问题, 模板命中{hit}个, 其中与标注完全一致{correct}个")
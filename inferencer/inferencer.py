@@ -1,61 +1,29 @@
 from loguru import logger
 import json
 import os
+import hashlib
 from typing import *
 import re
 from ._model import InferenceModel
-from enum import Enum
 from tqdm import tqdm
 from ._prompt import *
 import copy
 import pandas as pd
-from dataloader import DataLoader
-import traceback
+from dataloader import DataLoader, Text2VecEncoder
 from ._answer_generator_type1 import AnswerGeneratorType1
 from ._answer_generator_type2 import AnswerGeneratorType2
 from ._answer_generator_type3 import AnswerGeneratorType3
 from ._answer_generator_sql import AnswerGeneratorSql
 from ._answer_generator import AnswerGenerator
+from ._answer_scheduler import AnswerScheduler
+from ._cls_rules import ClsResult, ClsRuleEngine
+from ._sql_template import SqlTemplateCache
+from ._query_planner import QueryPlanner
+from ._column_index import SchemaPruner
 from pathlib import Path
 from vllm import LLM
 
 
-class ClsResult(Enum):
-    # 公司基本信息, type 1
-    COMPANY_BASIC_INFO = "A"
-    # 员工信息, type 1
-    EMPLOYEE_INFO = "B"
-    # 财务报表相关信息, type 1
-    FINANCIAL_REPORT = "C"
-    # 计算题, type 2
-    CALCULATION = "D"
-    # 统计题, type 2
-    STATISTICS = "E"
-    # 开放性问题
-    OPEN = "F"  # type 3
-    # 未知问题
-    UNKNOWN = "G"  # type 1
-
-    """
-    type 1: 基本信息处理
-    type 2: 统计计算
-    type 3: 总结推理
-    """
-
-    @staticmethod
-    def from_value(value: str):
-        for member in ClsResult:
-            v = value.strip().upper().encode("utf-8").decode("utf-8")
-            if member.value == v:
-                return member
-        logger.error(f"Unknown cls result value: '{v}', encode: {v}")
-        return ClsResult.UNKNOWN
-
-    @staticmethod
-    def is_member(value: str):
-        return value in [member.value for member in ClsResult]
-
-
 class Inferencer:
     def __init__(
         self,
@@ -66,7 +34,21 @@ class Inferencer:
         nl2sql_model: InferenceModel = None,
         generic_model: InferenceModel = None,
         default_model: InferenceModel = None,
+        fingerprint: bool = False,
+        sql_template: bool = True,
+        query_planner: bool = True,
+        schema_pruning: bool = False,
+        dense_retrieval: bool = False,
     ):
+        """
+        fingerprint: 持久化时为每条结果记录输入指纹(模型, prompt模板版本, 上游结果等),
+            断点续跑时只重新计算指纹发生变化的问题
+        sql_template: nl2sql阶段对只有年份, 名次, 数值, 字段名不同的问题复用已生成的sql模板
+        query_planner: 常见统计题(第N高, 前N名, 按注册地计数/汇总)在答案阶段由规则生成sql并直接作答,
+            规则查询失败时仍使用nl2sql阶段模型生成的sql
+        schema_pruning: nl2sql prompt只列出与问题及其关键词相关的字段
+        dense_retrieval: 年报文本召回时同时用text2vec向量检索, 与bm25结果按RRF融合, 需预处理时已建好向量索引
+        """
         self.cls_model = cls_model
         self.keywords_model = keywords_model
         self.nl2sql_model = nl2sql_model
@@ -74,66 +56,86 @@ class Inferencer:
         self.generic_model = generic_model
 
         self.dataloader = DataLoader(ctx_dir=ctx_dir, inference_dir=inference_dir)
+        if dense_retrieval:
+            self.dataloader.dense_encoder = Text2VecEncoder()
 
         self.ctx_dir: Path = ctx_dir
         self.inference_dir: Path = inference_dir
+        self.fingerprint = fingerprint
+        self.sql_template = sql_template
+        # {lora_name: 模板缓存}, 不同模型生成的模板不混用
+        self.sql_template_caches: Dict[str, SqlTemplateCache] = {}
+        self.query_planner = QueryPlanner(self.dataloader) if query_planner else None
+        self.schema_pruner = SchemaPruner(nl2sql_fields()) if schema_pruning else None
 
         self.classification_map = {}
         self.keywords_map = {}
         self.nl2sql_map = {}
+        # {问题id: 答案生成完成的时刻}, 只包含最近一次答案生成中实际计算的问题
+        self.answer_finish_times: Dict[int, float] = {}
 
         self.inference_dir.mkdir(parents=True, exist_ok=True)
 
     def _get_related_companies(self, question):
         question = re.sub(r"[\(\)（）]", "", question)
 
-        related_companies = []
-        for k, md in self.dataloader.load_pdf_metadata_map().items():
-            company = md["company"]
-            abbr = md["abbr"]
-            if company in question:
-                related_companies.append(company)
-            if abbr in question:
-                related_companies.append(abbr)
-        return related_companies
+        return self.dataloader.load_entity_index().find_related_companies(question)
 
     def do_classification(
-        self, questions: List[Dict], persist=False, unload_on_done=True
+        self, questions: List[Dict], persist=False, unload_on_done=True, resume=True
     ) -> List[Dict]:
         model = self.cls_model or self.default_model
+        Inferencer._begin_stage(model, "classification")
+        out_file_path = os.path.join(self.inference_dir, "classification.jsonl")
+
+        prompts = {q["id"]: classify_prompt(q["question"]) for q in questions}
+        # 分类规则改动也会改变结果, 一并计入指纹
+        fingerprints = self._fingerprints(
+            model,
+            "",
+            {k: [v, ClsRuleEngine.OPEN_KEYWORDS] for k, v in prompts.items()},
+        )
+        done, todo = self._resume(
+            out_file_path, questions, persist and resume, fingerprints
+        )
 
-        entries = []
-        for q in tqdm(
-            questions, total=len(questions), desc="inferencing for classification"
-        ):
+        # 先执行模型前规则, 只有规则无法确定的问题才交给分类模型
+        rules = ClsRuleEngine()
+        related_map = {
+            q["id"]: self._get_related_companies(q["question"]) for q in todo
+        }
+        rule_results = {
+            q["id"]: rules.before_model(q["question"], related_map[q["id"]])
+            for q in todo
+        }
+        model_questions = [q for q in todo if rule_results[q["id"]] is None]
+        model_answers = model.chat_batch(
+            [prompts[q["id"]] for q in model_questions], max_tokens=1
+        )
+        model_answer_map = {q["id"]: a for q, a in zip(model_questions, model_answers)}
+        rules.report()
+
+        for q in tqdm(todo, total=len(todo), desc="inferencing for classification"):
             question_id = q["id"]
             question = q["question"]
 
-            related_comp_names = self._get_related_companies(question)
-
-            model_answer = model.chat(classify_prompt(question), max_tokens=1)
-            cls_result = ClsResult.from_value(model_answer)
-
-            if re.findall("(状况|简要介绍|简要分析|概述|具体描述|审计意见)", question):
-                cls_result = ClsResult.OPEN
-
-            if re.findall("(什么是|指什么|什么意思|定义|含义|为什么)", question):
-                cls_result = ClsResult.OPEN
-
-            if model_answer in ["A", "B", "C", "D"] and len(related_comp_names) == 0:
-                cls_result = ClsResult.OPEN
-
-            if model_answer in ["E"] and len(related_comp_names) > 0:
-                cls_result = ClsResult.UNKNOWN
+            cls_result = rule_results[question_id]
+            if cls_result is None:
+                cls_result = rules.after_model(
+                    question, related_map[question_id], model_answer_map[question_id]
+                )
 
             entry = {"id": question_id, "question": question, "class": cls_result.value}
-            entries.append(entry)
+            self._set_fingerprint(entry, fingerprints)
+            done[question_id] = entry
             if persist:
-                out_file_path = os.path.join(self.inference_dir, "classification.jsonl")
                 Inferencer.dump_as_jsonl([entry], out_file_path)
+        entries = [done[q["id"]] for q in questions]
+        Inferencer._end_stage(model, "classification")
         if unload_on_done:
             model.unload()
         self.classification_map = {e["id"]: e["class"] for e in entries}
+        self.dataloader.merge_classification_map(self.classification_map)
         return entries
 
     def do_keywords_generation(
@@ -142,30 +144,46 @@ class Inferencer:
         persist=False,
         lora_name="",
         unload_on_done=False,
+        resume=True,
     ) -> List[Dict]:
         model = self.keywords_model or self.default_model
-        entries = []
-        for q in tqdm(questions, total=len(questions), desc="inferencing for keywords"):
+        Inferencer._begin_stage(model, "keywords")
+        out_file_path = os.path.join(self.inference_dir, "keywords.jsonl")
+
+        prompts = {q["id"]: keywords_prompt(q["question"]) for q in questions}
+        fingerprints = self._fingerprints(model, lora_name, prompts)
+        done, todo = self._resume(
+            out_file_path, questions, persist and resume, fingerprints
+        )
+
+        model_answers = model.chat_batch(
+            [prompts[q["id"]] for q in todo], max_tokens=128, lora_name=lora_name
+        )
+
+        for q, model_answer in tqdm(
+            zip(todo, model_answers),
+            total=len(todo),
+            desc="inferencing for keywords",
+        ):
             question_id = q["id"]
             question = q["question"]
 
-            model_answer = model.chat(
-                keywords_prompt(question), max_tokens=128, lora_name=lora_name
-            )
-            keywords = model_answer.strip("```").split(",")
-            keywords = [kw.strip() for kw in keywords]
+            keywords = parse_keywords(model_answer)
             if len(keywords) == 0:
-                logger.warning("问题{}的关键词为空".format(question["question"]))
+                logger.warning("问题{}的关键词为空".format(question))
 
             entry = {"id": question_id, "question": question, "keywords": keywords}
-            entries.append(entry)
+            self._set_fingerprint(entry, fingerprints)
+            done[question_id] = entry
 
             if persist:
-                out_file_path = os.path.join(self.inference_dir, "keywords.jsonl")
                 Inferencer.dump_as_jsonl([entry], out_file_path)
+        entries = [done[q["id"]] for q in questions]
+        Inferencer._end_stage(model, "keywords")
         if unload_on_done:
             model.unload()
         self.keywords_map = {e["id"]: e["keywords"] for e in entries}
+        self.dataloader.merge_keywords_map(self.keywords_map)
         return entries
 
     def do_sql_generation(
@@ -174,57 +192,190 @@ class Inferencer:
         persist=False,
         lora_name="",
         unload_on_done=False,
+        resume=True,
     ) -> List[Dict]:
         model = self.nl2sql_model or self.default_model
-        entries = []
-
-        classification_map = (
-            self.classification_map
-            if len(self.classification_map) > 0
-            else self.dataloader.load_classification_map()
+        Inferencer._begin_stage(model, "nl2sql")
+        out_file_path = os.path.join(self.inference_dir, "nl2sql.jsonl")
+
+        classification_map = self.dataloader.load_classification_map()
+
+        # 只有统计题需要生成sql, 一次性提交所有prompt
+        keywords_map = self.dataloader.keywords_map or {}
+        prompts = {
+            q["id"]: nl2sql_prompt(
+                q["question"],
+                fields=(
+                    self.schema_pruner.prune(q["question"], keywords_map.get(q["id"]))
+                    if self.schema_pruner is not None
+                    else None
+                ),
+            )
+            for q in questions
+            if classification_map.get(q["id"]) == ClsResult.STATISTICS.value
+        }
+        fingerprints = self._fingerprints(
+            model,
+            lora_name,
+            {
+                q["id"]: [classification_map.get(q["id"]), prompts.get(q["id"])]
+                for q in questions
+            },
+        )
+        done, todo = self._resume(
+            out_file_path, questions, persist and resume, fingerprints
         )
-        logger.debug(classification_map)
 
-        for q in tqdm(questions, total=len(questions), desc="inferencing for nl2sql"):
+        # 规则可解析的问题也生成sql, 规则查询失败或无结果时在答案阶段使用
+        sql_questions = [q for q in todo if q["id"] in prompts]
+        sql_answer_map = self._generate_sql(model, sql_questions, prompts, lora_name)
+
+        for q in tqdm(todo, total=len(todo), desc="inferencing for nl2sql"):
             question_id = q["id"]
             question = q["question"]
 
             clssification = classification_map.get(question_id)
             if clssification is None:
                 logger.warning("问题{}没有分类结果".format(question_id))
-                entries.append({"id": question_id, "question": question, "sql": None})
+                done[question_id] = {
+                    "id": question_id,
+                    "question": question,
+                    "sql": None,
+                }
                 continue
             if clssification != ClsResult.STATISTICS.value:
-                entries.append({"id": question_id, "question": question, "sql": None})
+                done[question_id] = {
+                    "id": question_id,
+                    "question": question,
+                    "sql": None,
+                }
                 continue
 
-            model_answer = model.chat(
-                nl2sql_prompt(question), max_tokens=2200, lora_name=lora_name
-            )
+            model_answer = sql_answer_map[question_id]
             entry = {"id": question_id, "question": question, "sql": model_answer}
-            entries.append(entry)
+            self._set_fingerprint(entry, fingerprints)
+            done[question_id] = entry
 
             if persist:
-                out_file_path = os.path.join(self.inference_dir, "nl2sql.jsonl")
                 Inferencer.dump_as_jsonl([entry], out_file_path)
+        entries = [done[q["id"]] for q in questions]
+        Inferencer._end_stage(model, "nl2sql")
         if unload_on_done:
             model.unload()
         self.nl2sql_map = {e["id"]: e["sql"] for e in entries}
+        self.dataloader.merge_nl2sql_map(self.nl2sql_map)
         return entries
 
+    def _generate_sql(
+        self,
+        model: InferenceModel,
+        questions: List[Dict],
+        prompts: Dict[int, str],
+        lora_name: str,
+    ) -> Dict[int, str]:
+        """
+        return: {question_id: 模型输出的sql}
+        开启sql模板时, 同一模板的问题只让模型生成一个, 其余由模板实例化, 无法实例化的再交给模型
+        """
+
+        def chat(qs: List[Dict]) -> Dict[int, str]:
+            answers = model.chat_batch(
+                [prompts[q["id"]] for q in qs], max_tokens=2200, lora_name=lora_name
+            )
+            return {q["id"]: a for q, a in zip(qs, answers)}
+
+        if not self.sql_template:
+            return chat(questions)
+
+        cache = self.load_sql_template_cache(lora_name)
+        groups: Dict[str, List[Dict]] = {}
+        for q in questions:
+            key = cache.parse_question(q["question"]).key
+            groups.setdefault(key, []).append(q)
+
+        answer_map = {}
+        leaders = []
+        for qs in groups.values():
+            sql = cache.get(qs[0]["question"])
+            if sql is None:
+                leaders.append(qs[0])
+            else:
+                answer_map[qs[0]["id"]] = sql
+        answer_map.update(chat(leaders))
+        for q in leaders:
+            cache.learn(q["question"], answer_map[q["id"]])
+
+        retry = []
+        for qs in groups.values():
+            for q in qs[1:]:
+                sql = cache.get(q["question"])
+                if sql is None:
+                    retry.append(q)
+                else:
+                    answer_map[q["id"]] = sql
+        answer_map.update(chat(retry))
+        logger.info(
+            "nl2sql共{}个问题, 模型生成{}个, 模板实例化{}个".format(
+                len(questions),
+                len(leaders) + len(retry),
+                len(questions) - len(leaders) - len(retry),
+            )
+        )
+        cache.report()
+        return answer_map
+
+    def load_sql_template_cache(self, lora_name: str) -> SqlTemplateCache:
+        if lora_name not in self.sql_template_caches:
+            fields = list(
+                self.dataloader.load_company_table(remove_column_prefix=True).columns
+            )
+            self.sql_template_caches[lora_name] = SqlTemplateCache(
+                fields,
+                validate_sql=lambda sql: self.dataloader.explain_sql(sql) is None,
+            )
+        return self.sql_template_caches[lora_name]
+
     def do_answer_generation(
         self,
         questions: List[Dict],
         persist=False,
         unload_on_done=True,
+        resume=True,
     ) -> List[Dict]:
         model = self.generic_model or self.default_model
+        Inferencer._begin_stage(model, "answer")
         out_file_path = os.path.join(self.inference_dir, "answers.jsonl")
 
+        fingerprints = None
+        if self.fingerprint:
+            # 答案依赖上游各阶段的结果及所有答案生成用到的prompt模板
+            classification_map = self.dataloader.load_classification_map()
+            keywords_map = self.dataloader.load_keywords_map()
+            nl2sql_map = self.dataloader.load_nl2sql_map()
+            fingerprints = self._fingerprints(
+                model,
+                "",
+                {
+                    q["id"]: [
+                        prompt_version(),
+                        q["question"],
+                        classification_map.get(q["id"]),
+                        keywords_map.get(q["id"]),
+                        nl2sql_map.get(q["id"]),
+                    ]
+                    for q in questions
+                },
+            )
+        done, todo = self._resume(
+            out_file_path, questions, persist and resume, fingerprints
+        )
+
         ag1 = AnswerGeneratorType1(dataloader=self.dataloader, model=model)
         ag2 = AnswerGeneratorType2(dataloader=self.dataloader, model=model)
         ag3 = AnswerGeneratorType3(dataloader=self.dataloader, model=model)
-        ag_sql = AnswerGeneratorSql(dataloader=self.dataloader, model=model)
+        ag_sql = AnswerGeneratorSql(
+            dataloader=self.dataloader, model=model, planner=self.query_planner
+        )
 
         switcher: Dict[str, AnswerGenerator] = {
             "A": ag1,
@@ -236,33 +387,137 @@ class Inferencer:
             "G": ag1,
         }
 
-        entries = []
-        for q in tqdm(questions, desc="Answer Generation", total=len(questions)):
+        steps_list = []
+        for q in todo:
             question_id = q["id"]
             question = q["question"]
 
             question_type = ag1.get_question_type(question_id)
             generator = switcher[question_type]
-            if generator is None:
-                logger.error("问题{}没有分类结果".format(question_id))
-                continue
-
-            try:
-                answer = generator.generate_answer(question_id, question, question_type)
-
-            except Exception as e:
-                traceback.print_exc()
-
-            logger.debug(f"问题{question_id}的答案为: '{answer}'")
-            entry = {"id": question_id, "question": question, "answer": answer}
-            entries.append(entry)
+            steps_list.append(
+                generator.generate_answer_steps(question_id, question, question_type)
+            )
 
+        def on_done(idx: int, answer: str):
+            q = todo[idx]
+            logger.debug(f"问题{q['id']}的答案为: '{answer}'")
+            entry = {"id": q["id"], "question": q["question"], "answer": answer}
+            self._set_fingerprint(entry, fingerprints)
+            done[q["id"]] = entry
             if persist:
                 Inferencer.dump_as_jsonl([entry], out_file_path)
+
+        scheduler = AnswerScheduler(model=model)
+        scheduler.run(steps_list, on_done=on_done)
+        self.answer_finish_times = {
+            todo[idx]["id"]: t for idx, t in scheduler.finish_times.items()
+        }
+        entries = [done[q["id"]] for q in questions]
+        self.dataloader.report_stats()
+        if self.query_planner is not None:
+            self.query_planner.report()
+
+        Inferencer._end_stage(model, "answer")
         if unload_on_done:
             model.unload()
         return entries
 
+    def _fingerprints(
+        self, model: InferenceModel, lora_name: str, inputs: Dict[int, Any]
+    ) -> Optional[Dict[int, str]]:
+        """
+        inputs: {问题id: 该问题在本阶段的输入(如渲染后的prompt)}
+        return: {问题id: 输入指纹}, 未开启指纹时返回None
+        """
+        if not self.fingerprint:
+            return None
+        model_id = [model.model_name, lora_name, model.lora_path(lora_name)]
+        return {
+            question_id: hashlib.sha256(
+                json.dumps([model_id, value], ensure_ascii=False).encode("utf-8")
+            ).hexdigest()[:16]
+            for question_id, value in inputs.items()
+        }
+
+    @staticmethod
+    def _set_fingerprint(entry: Dict, fingerprints: Optional[Dict[int, str]]):
+        if fingerprints is not None:
+            entry["fingerprint"] = fingerprints[entry["id"]]
+
+    @staticmethod
+    def _resume(
+        file_path: str,
+        questions: List[Dict],
+        resume: bool,
+        fingerprints: Optional[Dict[int, str]] = None,
+    ) -> Tuple[Dict[int, Dict], List[Dict]]:
+        """
+        断点续跑: 读取阶段输出文件中已有的结果, 跳过已完成的问题
+        - 同一id出现多次时保留最后一条, 并压缩重写文件
+        - 传入fingerprints时, 指纹不一致的结果视为输入已变化, 从文件中移除并重新计算
+        return: ({问题id: 已完成的结果}, 待处理的问题)
+        """
+        if not resume or not os.path.exists(file_path):
+            return {}, questions
+
+        entries: Dict[int, Dict] = {}
+        line_count = 0
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line_count += 1
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 进程中断时最后一行可能不完整
+                    logger.warning(f"跳过{file_path}中无法解析的行: {line.strip()}")
+                    continue
+                entries[entry["id"]] = entry
+
+        stale = 0
+        if fingerprints is not None:
+            for question_id in list(entries.keys()):
+                if (
+                    question_id in fingerprints
+                    and entries[question_id].get("fingerprint")
+                    != fingerprints[question_id]
+                ):
+                    entries.pop(question_id)
+                    stale += 1
+
+        if len(entries) != line_count:
+            tmp_path = file_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for entry in entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, file_path)
+
+        done = {q["id"]: entries[q["id"]] for q in questions if q["id"] in entries}
+        todo = [q for q in questions if q["id"] not in entries]
+        logger.info(
+            "{}: 已完成{}个问题, 待处理{}个, 输入变化需重算{}个, 文件压缩{}行->{}行".format(
+                os.path.basename(file_path),
+                len(done),
+                len(todo),
+                stale,
+                line_count,
+                len(entries),
+            )
+        )
+        return done, todo
+
+    @staticmethod
+    def _begin_stage(model: InferenceModel, stage: str):
+        model.stage = stage
+        if model.response_cache is not None:
+            model.response_cache.stage = stage
+
+    @staticmethod
+    def _end_stage(model: InferenceModel, stage: str):
+        if model.response_cache is not None:
+            model.response_cache.report(stage)
+        if model.prefix_stats is not None:
+            model.prefix_stats.report(stage)
+
     @staticmethod
     def dump_as_jsonl(entries, file_path):
         with open(file_path, "a", encoding="utf-8") as f:
@@ -5,6 +5,7 @@ import os
 import json
 import pandas as pd
 from tqdm import tqdm
+from dataloader import CompanyTableStore, build_company_db
 
 table_names = [
     "basic_info",
@@ -106,12 +107,19 @@ class PreprocessorTableBuilder(object):
         final_df.sort_values(by=["公司全称", "年份"], inplace=True)
         final_df.rename(columns=rename_map, inplace=True)
         if persist:
+            csv_path = os.path.join(self.ctx_dir, "CompanyTable.csv")
             final_df.to_csv(
-                os.path.join(self.ctx_dir, "CompanyTable.csv"),
+                csv_path,
                 sep="\t",
                 index=False,
                 encoding="utf-8",
             )
+            # 同时生成类型化并建好索引的sqlite文件, 推理时直接只读打开
+            # 从csv重新读取, 保证与推理时读到的表完全一致
+            build_company_db(
+                CompanyTableStore(csv_path).get(remove_column_prefix=True),
+                os.path.join(self.ctx_dir, "CompanyTable.db"),
+            )
         return final_df
 
 
@@ -1,16 +1,7 @@
 import re
 from loguru import logger
 from typing import *
-
-alias = {
-    "在职员工的数量合计": "职工总人数",
-    "负债合计": "总负债",
-    "资产总计": "总资产",
-    "流动负债合计": "流动负债",
-    "非流动负债合计": "非流动负债",
-    "流动资产合计": "流动资产",
-    "非流动资产合计": "非流动资产",
-}
+from dataloader._field_alias import alias
 
 
 def get_unit(pdf_key, table, pages):
@@ -17,6 +17,7 @@ from ._table_builder import PreprocessorTableBuilder
 from tqdm import tqdm
 from ._checker import PreprocessorChecker
 from ._pdf2txt import process_all_pdfs_in_folder
+from dataloader import DataLoader, Text2VecEncoder
 
 module_path = os.path.dirname(__file__)
 
@@ -204,6 +205,63 @@ class Preprocessor:
             for r in tqdm(results, total=len(args), desc="converting pdfs to txts"):
                 r.wait()
 
+    def compile_pdf_texts(self, num_processors=4):
+        """
+        把alltxts的jsonl编译为可内存映射的二进制格式, 推理时不再逐行解析json和表格行
+        """
+        args = [(self.ctx_dir, k) for k in self.pdf_metadata.keys()]
+        with Pool(processes=num_processors) as pool:
+            results = [pool.starmap_async(compile_pdf_text, [arg]) for arg in args]
+            for r in tqdm(results, total=len(args), desc="compiling pdf texts"):
+                r.wait()
+
+    def build_chunk_stores(self, num_processors=4):
+        """
+        为每份年报保存清洗后的文本行(去掉页眉页脚和空行)到chunks目录, 推理时按行号切片
+        """
+        args = [(self.ctx_dir, k) for k in self.pdf_metadata.keys()]
+        with Pool(processes=num_processors) as pool:
+            results = [pool.starmap_async(build_chunk_store, [arg]) for arg in args]
+            for r in tqdm(results, total=len(args), desc="building chunk stores"):
+                r.wait()
+
+    def build_bm25_indexes(self, num_processors=4):
+        """
+        为每份年报的alltxts文本行建立bm25模型并持久化到bm25目录, 推理时直接加载
+        """
+        args = [(self.ctx_dir, k) for k in self.pdf_metadata.keys()]
+        with Pool(processes=num_processors) as pool:
+            results = [pool.starmap_async(build_bm25_index, [arg]) for arg in args]
+            for r in tqdm(results, total=len(args), desc="building bm25 indexes"):
+                r.wait()
+
+    def build_dense_index(self, dtype="float16", device=None):
+        """
+        把每份年报的文本行切块, 用text2vec编码后写入dense目录的向量索引
+        模型占用显存, 在主进程中按批编码
+        """
+        loader = DataLoader(ctx_dir=self.ctx_dir, inference_dir=self.ctx_dir)
+        loader.build_pdf_dense(
+            list(self.pdf_metadata.keys()),
+            encoder=Text2VecEncoder(device=device),
+            dtype=dtype,
+        )
+
+
+def compile_pdf_text(ctx_dir: str, key: str):
+    loader = DataLoader(ctx_dir=ctx_dir, inference_dir=ctx_dir)
+    loader.compile_pdf_text(key)
+
+
+def build_chunk_store(ctx_dir: str, key: str):
+    loader = DataLoader(ctx_dir=ctx_dir, inference_dir=ctx_dir)
+    loader.build_pdf_chunks(key)
+
+
+def build_bm25_index(ctx_dir: str, key: str):
+    loader = DataLoader(ctx_dir=ctx_dir, inference_dir=ctx_dir)
+    loader.build_pdf_bm25(key)
+
 
 """
 Tests